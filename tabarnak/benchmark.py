@@ -0,0 +1,336 @@
+"""
+tabarnak benchmark: measure tabarnak overhead and encode performance on synthetic media
+generated with ffmpeg lavfi testsrc and sine sources.
+
+usage: python -m tabarnak.benchmark --output benchmark.json [--baseline previous.json]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from tabarnak import tabarnak
+
+BENCHMARK_VERSION = 1
+
+# configurations encoding audio only sources
+AUDIO_CONFIGS = ["opus", "flac"]
+
+# source video codec for each output configuration. Sources are never in the output codec.
+SOURCE_VIDEO_CODECS = {"h264": "mpeg4", "hevc": "libx264", "av1": "libx264", "vp9": "libx264"}
+DEFAULT_SOURCE_VIDEO_CODEC = "libx264"
+
+def generate_media(path:str, duration:float, size:str, frame_rate:int, video_codec:str = DEFAULT_SOURCE_VIDEO_CODEC, video:bool = True):
+    """
+    generate a synthetic media file with a testsrc video and a sine audio track
+    """
+    cmd = [tabarnak.ffmpeg_path, "-v", "error", "-y"]
+    if video is True:
+        cmd += ["-f", "lavfi", "-i", "testsrc=size=%s:rate=%d:duration=%s" % (size, frame_rate, duration)]
+    cmd += ["-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000:duration=%s" % (duration)]
+
+    if video is True:
+        cmd += ["-c:v", video_codec, "-pix_fmt", "yuv420p"]
+    cmd += [path]
+
+    results = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    if results.returncode != 0:
+        raise RuntimeError("Cannot generate %s error: %s" % (path, results.stderr.decode("utf-8", errors="replace")))
+
+def summarize(values:list) -> dict:
+    """
+    return statistics of a list of measures
+    """
+    values = sorted(values)
+    return dict(count=len(values),
+                mean=statistics.mean(values),
+                median=statistics.median(values),
+                min=values[0],
+                max=values[-1],
+                p95=values[min(len(values) - 1, int(round(len(values) * 0.95)))])
+
+class Benchmark:
+    """
+    benchmark run: generates media in a work directory and runs tabarnak on it
+    """
+    def __init__(self, args):
+        self.args = args
+        self.work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="tabarnak-benchmark-")
+        os.makedirs(self.work_dir, exist_ok=True)
+
+    def path(self, *names) -> str:
+        """
+        return a path in the work directory
+        """
+        return os.path.join(self.work_dir, *names)
+
+    def generate_dir(self, name:str, count:int, duration:float, size:str, video_codec:str, ext:str = ".mkv", video:bool = True) -> str:
+        """
+        generate a directory of synthetic media files and return its path
+        """
+        input_dir = self.path(name)
+        os.makedirs(input_dir, exist_ok=True)
+        for i in range(count):
+            generate_media(os.path.join(input_dir, "%s-%03d%s" % (name, i, ext)), duration, size, self.args.frame_rate, video_codec, video)
+        return input_dir
+
+    def run_tabarnak(self, name:str, input_dir:str, output_dir:str, argv:list = None) -> tuple:
+        """
+        run tabarnak on a directory and return its results and wall time
+        """
+        cmd = ["--input-dir", input_dir, "--output-dir", output_dir,
+               "--log-path", self.path(name + ".log"),
+               "--stdout-path", self.path(name + "-stdout.txt"),
+               "--stderr-path", self.path(name + "-stderr.txt"),
+               "--progress-interval", "0", "--pipeline-stats-interval", "0"]
+        cmd += argv if argv is not None else []
+
+        start_time = time.monotonic()
+        results = tabarnak.main(cmd)
+        wall_time = time.monotonic() - start_time
+
+        if results.status() is False:
+            raise RuntimeError("tabarnak failed running benchmark %s see %s" % (name, self.path(name + ".log")))
+
+        return results, wall_time
+
+    def bench_probe(self) -> dict:
+        """
+        measure ffprobe latency of a single pass media probe
+        """
+        media_path = self.path("probe.mkv")
+        generate_media(media_path, self.args.duration, self.args.size, self.args.frame_rate)
+
+        latencies = []
+        for _ in range(self.args.probe_count):
+            start_time = time.monotonic()
+            tabarnak.probe_media(media_path)
+            latencies.append(time.monotonic() - start_time)
+
+        return dict(latency_seconds=summarize(latencies))
+
+    def bench_overhead(self) -> dict:
+        """
+        measure tabarnak per file overhead: skipping files already in the output codec
+        and transcoding tiny files, excluding ffmpeg encode time
+        """
+        count = self.args.overhead_files
+
+        skip_dir = self.generate_dir("overhead-skip", count, 0.2, "64x64", "libx265")
+        _, skip_wall_time = self.run_tabarnak("overhead-skip", skip_dir, self.path("overhead-skip-out"))
+
+        transcode_dir = self.generate_dir("overhead-transcode", count, 0.2, "64x64", DEFAULT_SOURCE_VIDEO_CODEC)
+        results, transcode_wall_time = self.run_tabarnak("overhead-transcode", transcode_dir, self.path("overhead-transcode-out"))
+        encode_time = sum(file_result.get_progress().get_elapsed_time() for file_result in results.file_results)
+
+        return dict(skip_per_file_seconds=skip_wall_time / count,
+                    transcode_per_file_seconds=max(transcode_wall_time - encode_time, 0.0) / count)
+
+    def bench_encode(self, config_name:str) -> dict:
+        """
+        measure encode speed of a configuration and the verification cost of its output
+        """
+        name = "encode-" + config_name
+        video = config_name not in AUDIO_CONFIGS
+        input_dir = self.generate_dir(name, 1, self.args.duration, self.args.size,
+                                      SOURCE_VIDEO_CODECS.get(config_name, DEFAULT_SOURCE_VIDEO_CODEC),
+                                      ".mkv" if video else ".wav", video)
+        output_dir = self.path(name + "-out")
+
+        results, wall_time = self.run_tabarnak(name, input_dir, output_dir, ["--" + config_name])
+        file_result = results.file_results[0]
+        encode_time = max(file_result.get_progress().get_elapsed_time(), 0.001)
+
+        encode = dict(encode_seconds=encode_time,
+                      wall_seconds=wall_time,
+                      speed=self.args.duration / encode_time,
+                      output_size=file_result.transcoder_file_stats.output_file_size)
+        if video is True:
+            encode["fps"] = self.args.duration * self.args.frame_rate / encode_time
+
+        # existing outputs are verified against their source. results are reset by this run.
+        _, encode["verify_seconds"] = self.run_tabarnak(name + "-verify", input_dir, output_dir, ["--" + config_name])
+        return encode
+
+    def bench_throughput(self) -> dict:
+        """
+        measure whole run throughput transcoding a directory with concurrent jobs
+        """
+        count = self.args.throughput_files
+        input_dir = self.generate_dir("throughput", count, self.args.duration, self.args.size, DEFAULT_SOURCE_VIDEO_CODEC)
+
+        _, wall_time = self.run_tabarnak("throughput", input_dir, self.path("throughput-out"),
+                                         ["--jobs", str(self.args.jobs), "--probe-jobs", str(self.args.jobs)])
+
+        return dict(wall_seconds=wall_time,
+                    files_per_hour=count / wall_time * 3600.0,
+                    media_speed=count * self.args.duration / wall_time)
+
+    def generate_tree(self, name:str, count:int, files_per_dir:int) -> str:
+        """
+        generate a directory tree of empty files and return its path
+        """
+        tree_dir = self.path(name)
+        for i in range(count):
+            dir_path = os.path.join(tree_dir, "dir-%04d" % (i // files_per_dir // files_per_dir), "dir-%04d" % (i // files_per_dir))
+            if i % files_per_dir == 0:
+                os.makedirs(dir_path, exist_ok=True)
+            with open(os.path.join(dir_path, "file-%06d.mkv" % (i)), "w", encoding="utf-8"):
+                pass
+        return tree_dir
+
+    def bench_scan(self) -> dict:
+        """
+        measure the directory walker speed on a generated tree without probing
+        """
+        count = self.args.scan_files
+        tree_dir = self.generate_tree("scan", count, self.args.scan_files_per_dir)
+
+        args = tabarnak.parse_args(["--input-dir", tree_dir, "--output-dir", self.path("scan-out"), "--keep-relative-path", "--no-journal"])
+        transcode_args = tabarnak.TranscoderArgs(args, tabarnak.TranscoderConfiguration())
+
+        start_time = time.monotonic()
+        jobs = sum(1 for _ in tabarnak.walk_jobs(transcode_args))
+        scan_time = max(time.monotonic() - start_time, 0.000001)
+
+        start_time = time.monotonic()
+        entries = sum(len(files) for _, _, files in os.walk(tree_dir, topdown=False))
+        os_walk_time = max(time.monotonic() - start_time, 0.000001)
+
+        return dict(files=jobs,
+                    scan_seconds=scan_time,
+                    entries_per_second=jobs / scan_time,
+                    os_walk_entries_per_second=entries / os_walk_time)
+
+    def run(self) -> dict:
+        """
+        run all benchmarks and return the report
+        """
+        configs = self.args.configs if self.args.configs else list(tabarnak.TranscoderConfiguration().configs.keys())
+
+        if self.args.scan_only is True:
+            results = dict(scan=self.bench_scan())
+        else:
+            results = dict(probe=self.bench_probe(),
+                           overhead=self.bench_overhead(),
+                           encode={config_name: self.bench_encode(config_name) for config_name in configs},
+                           throughput=self.bench_throughput())
+
+        ffmpeg_version = subprocess.run([tabarnak.ffmpeg_path, "-version"], stdout=subprocess.PIPE, check=False).stdout.decode("utf-8").split("\n")[0]
+
+        return dict(version=BENCHMARK_VERSION,
+                    date=datetime.datetime.now().isoformat(),
+                    host=dict(platform=platform.platform(), python=platform.python_version(), cpu_count=os.cpu_count(), ffmpeg=ffmpeg_version),
+                    parameters=dict(duration=self.args.duration, size=self.args.size, frame_rate=self.args.frame_rate, jobs=self.args.jobs,
+                                    probe_count=self.args.probe_count, overhead_files=self.args.overhead_files, throughput_files=self.args.throughput_files,
+                                    scan_only=self.args.scan_only, scan_files=self.args.scan_files, scan_files_per_dir=self.args.scan_files_per_dir),
+                    results=results)
+
+    def close(self):
+        """
+        remove the work directory unless kept
+        """
+        if self.args.keep is False and self.args.work_dir is None:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+def flatten(results:dict, prefix:str = "") -> dict:
+    """
+    flatten nested results into dotted metric names
+    """
+    metrics = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            metrics.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[name] = value
+    return metrics
+
+def is_lower_better(name:str) -> bool:
+    """
+    return True if a lower value of a metric is better
+    """
+    return "seconds" in name or name.endswith("output_size")
+
+def compare(report:dict, baseline:dict, threshold:float) -> list:
+    """
+    compare a report to a baseline report and return regressed metric names.
+    A metric regresses when it is worse than the baseline by more than threshold percent.
+    """
+    metrics = flatten(report["results"])
+    baseline_metrics = flatten(baseline["results"])
+
+    regressions = []
+    for name in sorted(metrics):
+        if name not in baseline_metrics or baseline_metrics[name] == 0 or name.endswith(".count"):
+            continue
+
+        change = (metrics[name] - baseline_metrics[name]) / abs(baseline_metrics[name]) * 100.0
+        regressed = -change > threshold
+        if is_lower_better(name):
+            regressed = change > threshold
+
+        print("%-60s %12.4f %12.4f %+8.2f%%%s" % (name, baseline_metrics[name], metrics[name], change, " REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+
+    return regressions
+
+def parse_args(argv):
+    """
+    parse benchmark arguments
+    """
+    parser = argparse.ArgumentParser(description="tabarnak benchmark: measure overhead and encode performance on synthetic media")
+    parser.add_argument("--output", type=str, default="tabarnak-benchmark.json", dest="output", help="json report path")
+    parser.add_argument("--baseline", type=str, default=None, dest="baseline", help="compare the report to a previous json report")
+    parser.add_argument("--regression-threshold", type=float, default=10.0, dest="regression_threshold", help="percent a metric may worsen compared to the baseline")
+    parser.add_argument("--work-dir", type=str, default=None, dest="work_dir", help="directory where media are generated (default: temporary directory)")
+    parser.add_argument("--keep", default=False, action="store_true", dest="keep", help="keep the temporary work directory")
+    parser.add_argument("--duration", type=float, default=10.0, dest="duration", help="duration in seconds of generated media")
+    parser.add_argument("--size", type=str, default="640x360", dest="size", help="resolution of generated media")
+    parser.add_argument("--frame-rate", type=int, default=25, dest="frame_rate", help="frame rate of generated media")
+    parser.add_argument("--configs", type=str, nargs="*", default=None, dest="configs", help="configurations to benchmark (default: all)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), dest="jobs", help="concurrent jobs of the throughput benchmark")
+    parser.add_argument("--probe-count", type=int, default=20, dest="probe_count", help="number of probes of the probe latency benchmark")
+    parser.add_argument("--overhead-files", type=int, default=20, dest="overhead_files", help="number of tiny files of the overhead benchmark")
+    parser.add_argument("--throughput-files", type=int, default=4, dest="throughput_files", help="number of files of the throughput benchmark")
+    parser.add_argument("--scan-only", default=False, action="store_true", dest="scan_only", help="only measure the directory walker on a generated tree of empty files")
+    parser.add_argument("--scan-files", type=int, default=100000, dest="scan_files", help="number of files of the scan benchmark tree")
+    parser.add_argument("--scan-files-per-dir", type=int, default=100, dest="scan_files_per_dir", help="number of files per directory of the scan benchmark tree")
+    return parser.parse_args(argv)
+
+def main(argv:list = None) -> dict:
+    """
+    main function: argv is used for tests. returns the report.
+    """
+    args = parse_args(argv)
+
+    benchmark = Benchmark(args)
+    try:
+        report = benchmark.run()
+    finally:
+        benchmark.close()
+
+    with open(args.output, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=4)
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.regression_threshold)
+
+    if regressions and argv is None:
+        sys.exit(1) # pragma: no cover
+
+    report["regressions"] = regressions
+    return report
+
+if __name__ == "__main__":
+    main() # pragma: no cover
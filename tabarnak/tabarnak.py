@@ -9,15 +9,32 @@ tabarnak - transcode all basically accessible resolutely not all Klingon transco
 # pylint: disable=too-many-lines
 
 import argparse
+import collections
+import ctypes
+import ctypes.util
+import dataclasses
 import datetime
+import hashlib
+import http.server
 import json
 import logging
 import math
 import os
+import queue
+import select
 import signal
+import socket
+import sqlite3
+import stat
+import struct
 import sys
 import subprocess
 import shutil
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 import yaml
 
 # python 3.7 required due to subprocess
@@ -41,17 +58,12 @@ if ffmpeg_path is None:
 
 # probe command
 probe_cmd = [ffprobe_path, "-v", "error"]
-probe_of = ["-of" , "default=noprint_wrappers=1:nokey=1"]
-probe_vstream = ["-select_streams",  "v:0"]
-probe_astream = ["-select_streams",  "a:0"]
 
-# fetch codec name command
-probe_video_codec_cmd = probe_cmd + probe_vstream + ["-show_entries", "stream=codec_name"] + probe_of
-probe_audio_codec_cmd = probe_cmd + probe_astream + ["-show_entries", "stream=codec_name"] + probe_of
+# fetch all streams and format information in a single pass
+probe_media_cmd = probe_cmd + ["-show_streams", "-show_format", "-of", "json"]
 
-
-# fetch duration in frames
-probe_duration_cmd = probe_cmd + ["-show_entries", "format=duration"] + probe_of
+# report encode progress as key=value lines on stdout instead of stats on stderr
+ffmpeg_progress_args = ["-nostats", "-progress", "pipe:1"]
 
 #
 # videc & audio codec constants
@@ -64,6 +76,313 @@ AUDIO_CODECS = ["aac", "mp3", "alac", "vorbis", "opus", "flac", "pcm_s16le", "pc
 # extensions to ignore
 skip_ext = [".srt", ".jpg", ".txt", ".py", ".pyc"]
 
+# media container magic bytes as (offset, bytes) read by the prefilter
+MEDIA_MAGIC_SIZE = 512
+MEDIA_MAGICS = [
+    (0, b"\x1a\x45\xdf\xa3"),                 # EBML: matroska, webm
+    (4, b"ftyp"), (4, b"moov"), (4, b"mdat"),    # ISO-BMFF, quicktime
+    (4, b"free"), (4, b"wide"), (4, b"skip"),
+    (0, b"OggS"),                                # ogg
+    (0, b"fLaC"),                                # flac
+    (0, b"ID3"),                                 # mp3 with id3 tag
+    (0, b"\x30\x26\xb2\x75\x8e\x66\xcf\x11"), # ASF: wmv, wma
+    (0, b"FLV\x01"),                             # flv
+    (0, b"\x00\x00\x01\xba"),                   # MPEG-PS
+]
+
+# maximum number of probed jobs waiting for the encoder
+PROBE_QUEUE_SIZE = 1024
+
+# number of ffmpeg output lines kept in memory for error reports
+FFMPEG_OUTPUT_TAIL_LINES = 50
+
+# outputs are written to a hidden partial file and renamed once verified
+PARTIAL_OUTPUT_SUFFIX = ".tabarnak-partial"
+
+# seconds between the soft cpu time limit sending SIGXCPU and the hard limit killing ffmpeg
+RLIMIT_CPU_GRACE = 5
+
+# ffmpeg and encoder errors reported when they run out of memory or cpu time
+RESOURCE_ERRORS = ["cannot allocate memory", "out of memory", "memory allocation failure", "malloc of size", "std::bad_alloc", "received signal 24"]
+
+# ffmpeg stream specifiers of stream types passed through or encoded with per stream copy
+STREAM_SPECIFIERS = {"video": "v", "audio": "a", "subtitle": "s"}
+
+# codecs of mp4 text subtitles remuxed to containers that do not support them
+REMUX_SUBTITLE_CODECS = {".mkv": "ass", ".webm": "webvtt"}
+
+# ionice scheduling classes
+IONICE_CLASSES = {"best-effort": "2", "idle": "3"}
+
+# encoded segments are kept in a hidden directory next to the output until concatenated
+SEGMENT_WORK_DIR_SUFFIX = ".tabarnak-segments"
+
+# forecast samples are encoded to a hidden file next to the output
+FORECAST_SAMPLE_SUFFIX = ".tabarnak-forecast"
+
+# ffmpeg cpu time per encoded pixel used to estimate avoided cpu time until files are transcoded
+DEFAULT_CPU_TIME_PER_PIXEL = 1.5e-7
+
+#
+# media info classes
+#
+def parse_float(value, default:float = 0.0) -> float:
+    """
+    parse a float value reported by ffprobe
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def parse_int(value, default:int = 0) -> int:
+    """
+    parse an int value reported by ffprobe
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def parse_frame_rate(value) -> float:
+    """
+    parse a frame rate reported by ffprobe as a fraction such as 30000/1001
+    """
+    if value is None:
+        return 0.0
+
+    numerator, _, denominator = str(value).partition("/")
+    if denominator == "":
+        return parse_float(numerator)
+
+    denominator = parse_float(denominator)
+    if denominator == 0.0:
+        return 0.0
+    return parse_float(numerator) / denominator
+
+def parse_tag_duration(value) -> float:
+    """
+    parse a duration tag formatted as HH:MM:SS.nnnnnnnnn as muxed by matroska
+    """
+    if value is None:
+        return 0.0
+
+    duration = 0.0
+    for part in str(value).split(":"):
+        duration = duration * 60.0 + parse_float(part)
+    return duration
+
+@dataclasses.dataclass(eq=False)
+class MediaStreamInfo:
+    """
+    media stream information as reported by ffprobe
+    """
+
+    YAMLTag = u"!MediaStreamInfo"
+
+    index : int = 0
+    codec_type : str = ""
+    codec_name : str = ""
+    duration : float = 0.0
+    bit_rate : int = 0
+    width : int = 0
+    height : int = 0
+    frame_rate : float = 0.0
+    packet_count : int = 0
+    channels : int = 0
+    sample_rate : int = 0
+
+    @staticmethod
+    def from_ffprobe(stream:dict):
+        """
+        build a MediaStreamInfo from a ffprobe json stream entry
+        """
+        tags = stream.get("tags", {})
+
+        # matroska only reports stream duration and bitrate in tags
+        duration = parse_float(stream.get("duration"))
+        if duration == 0.0:
+            duration = parse_tag_duration(tags.get("DURATION"))
+
+        bit_rate = parse_int(stream.get("bit_rate"))
+        if bit_rate == 0:
+            bit_rate = parse_int(tags.get("BPS"))
+
+        packet_count = parse_int(stream.get("nb_read_packets"))
+        if packet_count == 0:
+            packet_count = parse_int(stream.get("nb_frames"))
+
+        return MediaStreamInfo(index=parse_int(stream.get("index")),
+                               codec_type=stream.get("codec_type", ""),
+                               codec_name=stream.get("codec_name", ""),
+                               duration=duration,
+                               bit_rate=bit_rate,
+                               width=parse_int(stream.get("width")),
+                               height=parse_int(stream.get("height")),
+                               frame_rate=parse_frame_rate(stream.get("avg_frame_rate")),
+                               packet_count=packet_count,
+                               channels=parse_int(stream.get("channels")),
+                               sample_rate=parse_int(stream.get("sample_rate")))
+
+    @staticmethod
+    def from_dict(stream_dict:dict):
+        """
+        build a MediaStreamInfo from a dict returned by as_dict
+        """
+        return MediaStreamInfo(**stream_dict)
+
+    def as_dict(self):
+        """
+        return object as a dict
+        """
+        return dict(index=self.index,
+                    codec_type=self.codec_type,
+                    codec_name=self.codec_name,
+                    duration=self.duration,
+                    bit_rate=self.bit_rate,
+                    width=self.width,
+                    height=self.height,
+                    frame_rate=self.frame_rate,
+                    packet_count=self.packet_count,
+                    channels=self.channels,
+                    sample_rate=self.sample_rate)
+
+    def is_video(self) -> bool:
+        """
+        return True if the stream is a video stream
+        """
+        return self.codec_type == "video"
+
+    def is_audio(self) -> bool:
+        """
+        return True if the stream is an audio stream
+        """
+        return self.codec_type == "audio"
+
+    @staticmethod
+    def to_yaml(dumper, data):
+        """
+        dump the file to yaml
+        """
+        return dumper.represent_mapping(data.YAMLTag, data.as_dict())
+
+yaml.add_representer(MediaStreamInfo, MediaStreamInfo.to_yaml, Dumper=yaml.SafeDumper)
+
+@dataclasses.dataclass(eq=False)
+class MediaInfo:
+    """
+    media file information gathered from a single ffprobe pass
+    """
+
+    YAMLTag = u"!MediaInfo"
+
+    path : str
+    format_name : str = ""
+    duration : float = 0.0
+    size : int = 0
+    bit_rate : int = 0
+    streams : list = dataclasses.field(default_factory=list)
+
+    @staticmethod
+    def from_ffprobe(path:str, probe:dict):
+        """
+        build a MediaInfo from ffprobe -show_streams -show_format json output
+        """
+        media_format = probe.get("format", {})
+        streams = [MediaStreamInfo.from_ffprobe(stream) for stream in probe.get("streams", [])]
+
+        return MediaInfo(path,
+                         format_name=media_format.get("format_name", ""),
+                         duration=parse_float(media_format.get("duration")),
+                         size=parse_int(media_format.get("size")),
+                         bit_rate=parse_int(media_format.get("bit_rate")),
+                         streams=streams)
+
+    @staticmethod
+    def from_dict(media_dict:dict):
+        """
+        build a MediaInfo from a dict returned by as_dict
+        """
+        streams = [MediaStreamInfo.from_dict(stream) for stream in media_dict.get("streams", [])]
+        return MediaInfo(media_dict["path"],
+                         format_name=media_dict.get("format_name", ""),
+                         duration=media_dict.get("duration", 0.0),
+                         size=media_dict.get("size", 0),
+                         bit_rate=media_dict.get("bit_rate", 0),
+                         streams=streams)
+
+    def as_dict(self):
+        """
+        return object as a dict
+        """
+        return dict(path=self.path,
+                    format_name=self.format_name,
+                    duration=self.duration,
+                    size=self.size,
+                    bit_rate=self.bit_rate,
+                    streams=[stream.as_dict() for stream in self.streams])
+
+    def get_streams(self, codec_type:str = None) -> [MediaStreamInfo]:
+        """
+        return all streams or the streams of a codec type (video, audio, subtitle...)
+        """
+        if codec_type is None:
+            return self.streams
+        return [stream for stream in self.streams if stream.codec_type == codec_type]
+
+    def get_video_stream(self) -> MediaStreamInfo:
+        """
+        return the first video stream or None
+        """
+        streams = self.get_streams("video")
+        return streams[0] if streams else None
+
+    def get_audio_stream(self) -> MediaStreamInfo:
+        """
+        return the first audio stream or None
+        """
+        streams = self.get_streams("audio")
+        return streams[0] if streams else None
+
+    def get_video_codec(self) -> str:
+        """
+        return the first video stream codec name
+        """
+        stream = self.get_video_stream()
+        return stream.codec_name if stream is not None else ""
+
+    def get_audio_codec(self) -> str:
+        """
+        return the first audio stream codec name
+        """
+        stream = self.get_audio_stream()
+        return stream.codec_name if stream is not None else ""
+
+    def get_duration(self) -> float:
+        """
+        return the duration in seconds using the format duration or the longest stream
+        """
+        if self.duration > 0.0:
+            return self.duration
+
+        durations = [stream.duration for stream in self.streams]
+        return max(durations) if durations else 0.0
+
+    def get_duration_in_frames(self) -> int:
+        """
+        return the duration rounded up as returned by fetch_duration_in_frames
+        """
+        return int(math.ceil(self.get_duration()))
+
+    @staticmethod
+    def to_yaml(dumper, data):
+        """
+        dump the file to yaml
+        """
+        return dumper.represent_mapping(data.YAMLTag, data.as_dict())
+
+yaml.add_representer(MediaInfo, MediaInfo.to_yaml, Dumper=yaml.SafeDumper)
+
 #
 # stats classes
 #
@@ -87,6 +406,13 @@ class TranscoderFileStats:
                     save_in_bytes=self.get_save_in_bytes(),
                     save_in_percent=self.get_save_in_percent())
 
+    @staticmethod
+    def from_dict(stats_dict:dict):
+        """
+        build a TranscoderFileStats from a dict returned by as_dict
+        """
+        return TranscoderFileStats(stats_dict["input_file_size"], stats_dict["output_file_size"])
+
     def get_input_file_size(self) -> int:
         """
         return the input file size in bytes
@@ -120,6 +446,72 @@ class TranscoderFileStats:
 
 yaml.add_representer(TranscoderFileStats, TranscoderFileStats.to_yaml, Dumper=yaml.SafeDumper)
 
+@dataclasses.dataclass(eq=False)
+class TranscodeForecast:
+    """
+    output size and encode time of a file extrapolated from short samples encoded across its duration
+    """
+
+    YAMLTag = u"!TranscodeForecast"
+
+    input_file_size : int
+    duration : float
+    samples : int = 0
+    sample_duration : float = 0.0
+    input_sample_size : int = 0
+    output_sample_size : int = 0
+    sample_encode_time : float = 0.0
+
+    def as_dict(self):
+        """
+        return object as a dict
+        """
+        return dict(input_file_size=self.input_file_size,
+                    duration=self.duration,
+                    samples=self.samples,
+                    sample_duration=self.sample_duration,
+                    input_sample_size=self.input_sample_size,
+                    output_sample_size=self.output_sample_size,
+                    sample_encode_time=self.sample_encode_time,
+                    output_file_size=self.get_output_file_size(),
+                    save_in_percent=self.get_save_in_percent(),
+                    encode_time=self.get_encode_time())
+
+    @staticmethod
+    def from_dict(forecast_dict:dict):
+        """
+        build a TranscodeForecast from a dict returned by as_dict
+        """
+        return TranscodeForecast(forecast_dict["input_file_size"], forecast_dict["duration"], forecast_dict["samples"], forecast_dict["sample_duration"],
+                                 forecast_dict["input_sample_size"], forecast_dict["output_sample_size"], forecast_dict["sample_encode_time"])
+
+    def get_output_file_size(self) -> int:
+        """
+        return the predicted output file size in bytes
+        """
+        return int(self.input_file_size * self.output_sample_size / max(self.input_sample_size, 1))
+
+    def get_save_in_percent(self) -> float:
+        """
+        return the predicted saved space in percent
+        """
+        return (1. - float(self.output_sample_size) / float(max(self.input_sample_size, 1))) * 100.
+
+    def get_encode_time(self) -> float:
+        """
+        return the predicted encode time in seconds
+        """
+        return self.sample_encode_time * self.duration / max(self.sample_duration, 0.001)
+
+    @staticmethod
+    def to_yaml(dumper, data):
+        """
+        dump the forecast to yaml
+        """
+        return dumper.represent_mapping(data.YAMLTag, data.as_dict())
+
+yaml.add_representer(TranscodeForecast, TranscodeForecast.to_yaml, Dumper=yaml.SafeDumper)
+
 class TranscoderStats:
     """
     transcoder Stats class
@@ -130,12 +522,19 @@ class TranscoderStats:
     def __init__(self):
         # define collected stats
         self.total_saved = 0.0
+        self.triaged_files = 0
+        self.triaged_cost = 0.0
+        self.low_yield_files = 0
+        self.encoded_cost = 0.0
+        self.encode_cpu_time = 0.0
+        self.lock = threading.Lock()
 
     def increment_total_saved(self, value):
         """
         increment total saved value in bytes
         """
-        self.total_saved += value
+        with self.lock:
+            self.total_saved += value
 
     def get_total_saved(self):
         """
@@ -143,11 +542,60 @@ class TranscoderStats:
         """
         return self.total_saved
 
+    def add_triaged(self, cost:float):
+        """
+        count a file triaged as already efficient with its estimated encode cost in pixels
+        """
+        with self.lock:
+            self.triaged_files += 1
+            self.triaged_cost += cost
+
+    def add_low_yield(self):
+        """
+        count a file skipped because its forecast saving is out of range
+        """
+        with self.lock:
+            self.low_yield_files += 1
+
+    def add_encoded(self, cost:float, cpu_time:float):
+        """
+        count the estimated encode cost in pixels and the ffmpeg cpu time of a transcoded file
+        """
+        with self.lock:
+            self.encoded_cost += cost
+            self.encode_cpu_time += cpu_time
+
+    def get_triaged_files(self) -> int:
+        """
+        fetch number of files triaged as already efficient
+        """
+        return self.triaged_files
+
+    def get_low_yield_files(self) -> int:
+        """
+        fetch number of files skipped because of their forecast saving
+        """
+        return self.low_yield_files
+
+    def get_avoided_cpu_time(self) -> float:
+        """
+        estimate the cpu time in seconds avoided by triage from the cpu time per pixel of transcoded
+        files, or a default rate if none was transcoded
+        """
+        with self.lock:
+            cpu_time_per_pixel = DEFAULT_CPU_TIME_PER_PIXEL
+            if self.encoded_cost > 0.0 and self.encode_cpu_time > 0.0:
+                cpu_time_per_pixel = self.encode_cpu_time / self.encoded_cost
+            return self.triaged_cost * cpu_time_per_pixel
+
     def as_dict(self):
         """
         return object as a dict
         """
-        return dict(total_saved=self.total_saved)
+        return dict(total_saved=self.total_saved,
+                    triaged_files=self.triaged_files,
+                    low_yield_files=self.low_yield_files,
+                    avoided_cpu_time=self.get_avoided_cpu_time())
 
     @staticmethod
     def to_yaml(dumper, data):
@@ -158,6 +606,185 @@ class TranscoderStats:
 
 yaml.add_representer(TranscoderStats, TranscoderStats.to_yaml, Dumper=yaml.SafeDumper)
 
+def format_duration(seconds:float) -> str:
+    """
+    format a duration in seconds as H:MM:SS
+    """
+    return str(datetime.timedelta(seconds=int(max(0.0, seconds))))
+
+class TranscodeProgress:
+    """
+    transcode job progress parsed from ffmpeg -progress output
+    """
+
+    YAMLTag = u"!TranscodeProgress"
+
+    def __init__(self, duration:float):
+        self.duration = duration
+        self.out_time = 0.0
+        self.fps = 0.0
+        self.speed = 0.0
+        self.total_size = 0
+        self.start_time : float = None
+        self.end_time : float = None
+        self.cpu_time = 0.0
+        self.segments = []
+        self.parent : TranscodeProgress = None
+
+    def add_segment(self, duration:float) -> "TranscodeProgress":
+        """
+        add the progress of a segment encoded in parallel and return it
+        """
+        segment = TranscodeProgress(duration)
+        segment.parent = self
+        self.segments.append(segment)
+        return segment
+
+    def update_from_segments(self):
+        """
+        sum segment progresses into this progress
+        """
+        running = [segment for segment in self.segments if segment.is_running()]
+        self.out_time = sum(segment.get_done_duration() for segment in self.segments)
+        self.fps = sum(segment.fps for segment in running)
+        self.speed = sum(segment.speed for segment in running)
+        self.total_size = sum(segment.total_size for segment in self.segments)
+
+    def start(self):
+        """
+        mark the start of the encode
+        """
+        self.start_time = time.monotonic()
+
+    def reset(self):
+        """
+        forget the progress of a failed encode before it is retried
+        """
+        self.out_time = 0.0
+        self.fps = 0.0
+        self.speed = 0.0
+        self.total_size = 0
+        self.start_time = None
+        self.end_time = None
+        self.cpu_time = 0.0
+        self.segments = []
+
+    def add_cpu_time(self, cpu_time:float):
+        """
+        add the cpu time in seconds of a finished ffmpeg process
+        """
+        self.cpu_time += cpu_time
+
+    def get_cpu_time(self) -> float:
+        """
+        return the cpu time in seconds of the ffmpeg processes of the encode and its segments
+        """
+        return self.cpu_time + sum(segment.get_cpu_time() for segment in self.segments)
+
+    def finish(self):
+        """
+        mark the end of the encode
+        """
+        self.end_time = time.monotonic()
+
+        if self.parent is not None:
+            self.parent.update_from_segments()
+
+    def is_running(self) -> bool:
+        """
+        return True if the encode started and is not finished
+        """
+        return self.start_time is not None and self.end_time is None
+
+    def parse_line(self, line:str):
+        """
+        parse a key=value line of ffmpeg -progress output
+        """
+        key, _, value = line.strip().partition("=")
+
+        if key == "out_time_us":
+            self.out_time = max(0.0, parse_float(value) / 1000000.0)
+        elif key == "out_time" and value != "N/A":
+            self.out_time = max(0.0, parse_tag_duration(value))
+        elif key == "fps":
+            self.fps = parse_float(value)
+        elif key == "speed":
+            self.speed = parse_float(value.rstrip("x"))
+        elif key == "total_size":
+            self.total_size = parse_int(value)
+
+        if self.parent is not None:
+            self.parent.update_from_segments()
+
+    def get_done_duration(self) -> float:
+        """
+        return the encoded media duration in seconds
+        """
+        if self.end_time is not None:
+            return self.duration
+        return min(self.out_time, self.duration)
+
+    def get_elapsed_time(self) -> float:
+        """
+        return the encode wall time in seconds
+        """
+        if self.start_time is None:
+            return 0.0
+        end_time = self.end_time if self.end_time is not None else time.monotonic()
+        return end_time - self.start_time
+
+    def get_percent(self) -> float:
+        """
+        return the encode progress in percent
+        """
+        if self.duration <= 0.0:
+            return 0.0
+        return self.get_done_duration() / self.duration * 100.
+
+    def get_eta(self) -> float:
+        """
+        return the estimated remaining encode time in seconds or None if unknown
+        """
+        remaining = self.duration - self.get_done_duration()
+        if self.speed > 0.0:
+            return remaining / self.speed
+
+        done = self.get_done_duration()
+        if done > 0.0:
+            return remaining * self.get_elapsed_time() / done
+        return None
+
+    def format(self) -> str:
+        """
+        format progress for logging
+        """
+        eta = self.get_eta()
+        eta_fmt = format_duration(eta) if eta is not None else "N/A"
+        return "%2.1f percent fps: %2.1f speed: %2.2fx size: %s elapsed: %s eta: %s" % (self.get_percent(), self.fps, self.speed, format_size(self.total_size),
+                                                                                          format_duration(self.get_elapsed_time()), eta_fmt)
+
+    def as_dict(self):
+        """
+        return object as a dict
+        """
+        return dict(duration=self.duration,
+                    out_time=self.out_time,
+                    percent=self.get_percent(),
+                    fps=self.fps,
+                    speed=self.speed,
+                    total_size=self.total_size,
+                    elapsed_time=self.get_elapsed_time(),
+                    cpu_time=self.get_cpu_time())
+
+    @staticmethod
+    def to_yaml(dumper, data):
+        """
+        dump the file to yaml
+        """
+        return dumper.represent_mapping(data.YAMLTag, data.as_dict())
+
+yaml.add_representer(TranscodeProgress, TranscodeProgress.to_yaml, Dumper=yaml.SafeDumper)
+
 #
 # result classes
 #
@@ -176,6 +803,9 @@ class TrancodeFileResult:
         self.warnings: [str] = []
         self.exceptions: [str] = []
         self.fails_on_tolerance: [str] = []
+        self.progress : TranscodeProgress = None
+        self.forecast : TranscodeForecast = None
+        self.remuxed = False
 
     def as_dict(self):
         """
@@ -183,12 +813,51 @@ class TrancodeFileResult:
         """
         return dict(path=self.path,
                     stats=self.transcoder_file_stats,
+                    progress=self.progress,
+                    forecast=self.forecast,
+                    remuxed=self.remuxed,
                     infos=self.infos,
                     warnings=self.warnings,
                     errors=self.errors,
                     exception=self.exceptions,
                     fails_on_tolerance=self.fails_on_tolerance)
 
+    def set_progress(self, progress: TranscodeProgress):
+        """
+        set the transcode progress of the file
+        """
+        self.progress = progress
+
+    def get_progress(self) -> TranscodeProgress:
+        """
+        return the transcode progress of the file or None
+        """
+        return self.progress
+
+    def set_remuxed(self, remuxed: bool):
+        """
+        mark the file as remuxed to the output container instead of transcoded
+        """
+        self.remuxed = remuxed
+
+    def is_remuxed(self) -> bool:
+        """
+        return True if the file is remuxed to the output container instead of transcoded
+        """
+        return self.remuxed
+
+    def set_forecast(self, forecast: TranscodeForecast):
+        """
+        set the size and encode time forecast of the file
+        """
+        self.forecast = forecast
+
+    def get_forecast(self) -> TranscodeForecast:
+        """
+        return the size and encode time forecast of the file or None
+        """
+        return self.forecast
+
     def get_path(self) -> str:
         """
         returns the transcoding input path
@@ -253,6 +922,9 @@ class TranscoderResults:
     YAMLTag = u"!TranscoderResults"
 
     def __init__(self):
+        # the current file result is kept per thread so concurrent jobs report in their own file result
+        self.context = threading.local()
+        self.lock = threading.Lock()
         self.infos = []
         self.errors = []
         self.warnings = []
@@ -262,6 +934,17 @@ class TranscoderResults:
         self.stats = TranscoderStats()
         self.start_time = datetime.datetime.now()
 
+    @property
+    def file_result(self) -> TrancodeFileResult:
+        """
+        current file result of the calling thread
+        """
+        return getattr(self.context, "file_result", None)
+
+    @file_result.setter
+    def file_result(self, file_result: TrancodeFileResult):
+        self.context.file_result = file_result
+
     def __enter__(self):
         pass
 
@@ -286,15 +969,63 @@ class TranscoderResults:
         set current file result
         """
         self.file_result = file_result
-        self.file_results.append(file_result)
+        self.add_file_result(file_result)
 
-    def get_transcoder_stats(self) -> TranscoderStats:
+    def add_file_result(self, file_result: TrancodeFileResult):
         """
-        return global transcoder stats
+        add a file result without making it current
         """
-        return self.stats
+        with self.lock:
+            self.file_results.append(file_result)
 
-    def as_dict(self):
+    def remove_file_result(self, file_result: TrancodeFileResult):
+        """
+        remove an added file result of a job that was not run
+        """
+        with self.lock:
+            if file_result in self.file_results:
+                self.file_results.remove(file_result)
+
+    def use_file_result(self, file_result: TrancodeFileResult):
+        """
+        make an added file result current for the calling thread
+        """
+        self.file_result = file_result
+
+    def get_transcoder_stats(self) -> TranscoderStats:
+        """
+        return global transcoder stats
+        """
+        return self.stats
+
+    def get_running_progresses(self) -> list:
+        """
+        return (path, progress) of running transcode jobs
+        """
+        with self.lock:
+            file_results = list(self.file_results)
+        return [(result.get_path(), result.get_progress()) for result in file_results if result.get_progress() is not None and result.get_progress().is_running()]
+
+    def format_progress(self) -> str:
+        """
+        format the whole run progress: encoded media duration over queued media duration and ETA
+        """
+        with self.lock:
+            progresses = [result.get_progress() for result in self.file_results if result.get_progress() is not None]
+
+        total = sum(progress.duration for progress in progresses)
+        done = sum(progress.get_done_duration() for progress in progresses)
+        finished = len([progress for progress in progresses if progress.end_time is not None])
+
+        elapsed = (datetime.datetime.now() - self.start_time).total_seconds()
+        eta_fmt = "N/A"
+        if done > 0.0:
+            eta_fmt = format_duration((total - done) * elapsed / done)
+
+        percent = done / total * 100. if total > 0.0 else 0.0
+        return "%2.1f percent files: %d/%d media: %s/%s eta: %s" % (percent, finished, len(progresses), format_duration(done), format_duration(total), eta_fmt)
+
+    def as_dict(self):
         """
         return object as a dict
         """
@@ -389,6 +1120,7 @@ class TranscoderResults:
 
         num_success = 0
         num_fails = 0
+        num_remuxed = 0
         elapsed = self.get_elapsed_time()
 
         error_input_paths = []
@@ -397,6 +1129,7 @@ class TranscoderResults:
         for result in self.file_results:
             if result.status() is True:
                 num_success += 1
+                num_remuxed += 1 if result.is_remuxed() else 0
                 success_input_paths.append(result.get_path())
             else:
                 num_fails += 1
@@ -404,7 +1137,15 @@ class TranscoderResults:
 
         file_summary = "\n\nSuccesses:\n\n{0}\n\nFailures:\n\n{1}".format("\n".join(success_input_paths), "\n".join(error_input_paths))
 
-        summary = "\nSummary\n\nSuccesses:{0} Failures:{1}\nElapsed Time {2}\n{3}\n\nCheck logs for details.\n".format(num_success, num_fails, elapsed, file_summary)
+        counts_summary = ""
+        if num_remuxed > 0:
+            counts_summary += " Remuxed:{0}".format(num_remuxed)
+        if self.stats.get_low_yield_files() > 0:
+            counts_summary += " Low Yield:{0}".format(self.stats.get_low_yield_files())
+        if self.stats.get_triaged_files() > 0:
+            counts_summary += "\nTriaged:{0} CPU Time Avoided {1}".format(self.stats.get_triaged_files(), format_duration(self.stats.get_avoided_cpu_time()))
+
+        summary = "\nSummary\n\nSuccesses:{0} Failures:{1}{2}\nElapsed Time {3}\n{4}\n\nCheck logs for details.\n".format(num_success, num_fails, counts_summary, elapsed, file_summary)
 
         print(summary, file=stdout)
 
@@ -414,573 +1155,4288 @@ yaml.add_representer(TranscoderResults, TranscoderResults.to_yaml, Dumper=yaml.S
 transcoder_results = TranscoderResults()
 
 #
-# configuration class
+# metrics class
 #
-DEFAULT_H264_VIDEO_CONFIG = {
-    "default_ext": ".mkv",
-    "encoder_args" : {
-        "-c:v": "libx264",
-        "-crf": "30"
-    }
-}
+class TranscoderMetrics:
+    """
+    transcoder prometheus metrics. Methods do nothing until metrics are enabled.
+    """
 
-DEFAULT_HEVC_VIDEO_CONFIG = {
-    "default_ext": ".mkv",
-    "encoder_args" : {
-        "-c:v": "libx265",
-        "-crf": "28",
-        "-preset": "medium"
-    }
-}
+    ENCODE_SECONDS_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0, 7200.0, 14400.0, float("inf"))
+    PROBE_SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
 
-DEFAULT_AV1_VIDEO_CONFIG = {
-    "default_ext": ".mkv",
-    "encoder_args" : {
-        "-c:v": "libaom-av1",
-        "-crf": "30",
-        "-b:v": "2000k",
-        "-strict": "experimental",
-        "-row-mt": "1",
-        "-tile-columns": "4",
-        "-tile-rows": ""
-    }
-}
+    # file outcomes
+    TRANSCODED = "transcoded"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+    EXISTS = "exists"
+    COPIED = "copied"
+    LOW_YIELD = "low_yield"
+    TRIAGED = "triaged"
+    REMUXED = "remuxed"
 
-DEFAULT_VP9_VIDEO_CONFIG = {
-    "default_ext": ".webm",
-    "encoder_args" : {
-        "-c:v": "libvpx-vp9",
-        "-crf": "30",
-        "-b:v": "2000k"
-    }
-}
+    def __init__(self):
+        self.enabled = False
+        self.http_ports = set()
+        self.metrics = {}
+
+    def enable(self):
+        """
+        create metrics in the prometheus default registry. Raises ImportError if prometheus_client is missing.
+        """
+        if self.enabled is True:
+            return
 
+        from prometheus_client import REGISTRY, Counter, Gauge, Histogram
 
-DEFAULT_OPUS_AUDIO_CONFIG = {
-    "default_ext": ".ogg",
-    "encoder_args" : {
-        "-c:a": "libopus",
-    }
-}
+        self.metrics["input_bytes"] = Counter("tabarnak_input_bytes", "Size of transcoded input files.", registry=REGISTRY)
+        self.metrics["output_bytes"] = Counter("tabarnak_output_bytes", "Size of transcoded output files.", registry=REGISTRY)
+        self.metrics["remuxed_bytes"] = Counter("tabarnak_remuxed_bytes", "Size of input files remuxed to the output container.", registry=REGISTRY)
+        self.metrics["saved_bytes"] = Gauge("tabarnak_saved_bytes", "Bytes saved by transcoding (input minus output size).", registry=REGISTRY)
+        self.metrics["encode_seconds"] = Histogram("tabarnak_encode_seconds", "Encode wall time per file by output codec.", ["codec"], buckets=self.ENCODE_SECONDS_BUCKETS, registry=REGISTRY)
+        self.metrics["encoded_media_seconds"] = Counter("tabarnak_encoded_media_seconds", "Media duration encoded by output codec.", ["codec"], registry=REGISTRY)
+        self.metrics["files"] = Counter("tabarnak_files", "Files processed by outcome.", ["outcome"], registry=REGISTRY)
+        self.metrics["probe_seconds"] = Histogram("tabarnak_ffprobe_seconds", "ffprobe latency.", buckets=self.PROBE_SECONDS_BUCKETS, registry=REGISTRY)
+        self.metrics["jobs_in_flight"] = Gauge("tabarnak_jobs_in_flight", "Number of running ffmpeg encode jobs.", registry=REGISTRY)
+        self.metrics["queue_depth"] = Gauge("tabarnak_pipeline_queue_depth", "Number of jobs waiting in a pipeline stage queue.", ["stage"], registry=REGISTRY)
 
-DEFAULT_FLAC_AUDIO_CONFIG = {
-    "default_ext": ".flac",
-    "encoder_args" : {
-        "-c:a": "flac",
-    }
-}
+        encode_fps = Gauge("tabarnak_encode_fps", "Sum of the current encode fps of running jobs.", registry=REGISTRY)
+        encode_fps.set_function(lambda: sum(progress.fps for _, progress in transcoder_results.get_running_progresses()))
 
-class TranscoderConfiguration:
-    """
-    transcoder configuration
-    """
-    YAMLTag = "!TranscoderConfiguration"
+        encode_speed = Gauge("tabarnak_encode_speed", "Sum of the current encode speed of running jobs (media seconds per second).", registry=REGISTRY)
+        encode_speed.set_function(lambda: sum(progress.speed for _, progress in transcoder_results.get_running_progresses()))
 
-    def __init__(self, configs:dict = None):
-        # use default config if none specified
-        if configs is None:
-            self.configs = {
-                "h264": DEFAULT_H264_VIDEO_CONFIG,
-                "hevc" : DEFAULT_HEVC_VIDEO_CONFIG,
-                "av1" : DEFAULT_AV1_VIDEO_CONFIG,
-                "vp9" : DEFAULT_VP9_VIDEO_CONFIG,
-                "opus" : DEFAULT_OPUS_AUDIO_CONFIG,
-                "flac" : DEFAULT_FLAC_AUDIO_CONFIG
-            }
-        else:
-            self.configs = configs
+        self.enabled = True
 
-    def get_container_ext(self, config_name:str) -> str:
+    def start_http_server(self, port:int):
         """
-        return container extension based on config name
+        serve metrics over http on port
         """
-        return self.configs.get(config_name).get("default_ext")
+        if port in self.http_ports:
+            return
 
-    def get_encoder_args(self, config_name:str) -> str:
+        from prometheus_client import REGISTRY, start_http_server
+        start_http_server(port, registry=REGISTRY)
+        self.http_ports.add(port)
+        logging.info("Serving prometheus metrics on port %d", port)
+
+    def observe_probe(self, seconds:float):
         """
-        return encoder args based on config name
+        observe a ffprobe run latency
         """
-        video_config_encoder_args = self.configs.get(config_name).get("encoder_args")
-        encoder_args = ""
-        for key, value in video_config_encoder_args.items():
-            encoder_args += key + " " + value + " "
-        return encoder_args
+        if self.enabled:
+            self.metrics["probe_seconds"].observe(seconds)
 
-    def as_dict(self):
+    def file_done(self, outcome:str):
         """
-        return object as a dict
+        count a processed file by outcome
         """
-        return dict(configs=self.configs)
+        if self.enabled:
+            self.metrics["files"].labels(outcome).inc()
 
-    def from_dict(self, config_dict:dict):
+    def file_transcoded(self, codec:str, transcoder_file_stats:TranscoderFileStats, progress:TranscodeProgress = None):
         """
-        override config from dict
+        count bytes and encode time of a transcoded file
         """
-        self.configs = config_dict["configs"]
+        if not self.enabled:
+            return
 
-    @staticmethod
-    def to_yaml(dumper, data):
+        self.metrics["input_bytes"].inc(transcoder_file_stats.get_input_file_size())
+        self.metrics["output_bytes"].inc(transcoder_file_stats.get_output_file_size())
+        self.metrics["saved_bytes"].inc(transcoder_file_stats.get_save_in_bytes())
+
+        if progress is not None:
+            self.metrics["encode_seconds"].labels(codec).observe(progress.get_elapsed_time())
+            self.metrics["encoded_media_seconds"].labels(codec).inc(progress.duration)
+
+    def file_remuxed(self, transcoder_file_stats:TranscoderFileStats):
         """
-        dump the file to yaml
+        count bytes of a remuxed file
         """
-        return dumper.represent_mapping(data.YAMLTag, data.as_dict())
+        if self.enabled:
+            self.metrics["remuxed_bytes"].inc(transcoder_file_stats.get_input_file_size())
 
-    @staticmethod
-    def from_yaml(loader, node):
+    def job_started(self):
         """
-        build a TranscoderConfiguration from a yml loader and node
+        count a started encode job
         """
-        node_map = loader.construct_mapping(node)
-        return TranscoderConfiguration(configs=node_map["configs"])
+        if self.enabled:
+            self.metrics["jobs_in_flight"].inc()
 
-yaml.add_representer(TranscoderConfiguration, TranscoderConfiguration.to_yaml, Dumper=yaml.SafeDumper)
-yaml.add_constructor(TranscoderConfiguration.YAMLTag, TranscoderConfiguration.from_yaml, Loader=yaml.SafeLoader)
+    def job_finished(self):
+        """
+        count a finished encode job
+        """
+        if self.enabled:
+            self.metrics["jobs_in_flight"].dec()
 
-class TranscoderEncoderArgs:
+    def watch_pipeline_stages(self, stages:list):
+        """
+        report queue depths of pipeline stages
+        """
+        if not self.enabled:
+            return
+
+        for stage in stages:
+            self.metrics["queue_depth"].labels(stage.name).set_function(stage.get_depth)
+
+# transcoder metrics
+transcoder_metrics = TranscoderMetrics()
+
+#
+# cache class
+#
+class TranscoderCache:
     """
-    transcoder encoder args
+    persistent probe and verification cache stored in a sqlite database.
+    entries are keyed by path and invalidated when the file size, mtime or inode changes.
     """
-    def __init__(self, args: dict, config: TranscoderConfiguration):
-        self.encoder_args = ""
-        self.output_main_codec = "hevc"
 
-        if args.map_args is not None:
-            self.encoder_args += args.map_args
-        elif args.default_map is False:
-            self.encoder_args += " -map 0 "
+    DEFAULT_NAME = ".tabarnak.cache"
 
-        if args.strip_metadata is True:
-            self.encoder_args += " -map_metadata -1 "
+    # entry kinds
+    PROBE = "probe"
+    SKIP = "skip"
+    VERIFY = "verify"
+    FORECAST = "forecast"
 
-        if args.config_name is not None:
-            self.encoder_args += config.get_encoder_args(args.config_name)
-            self.output_main_codec = args.config_name
-        elif args.encoder_args is not None:
-            self.encoder_args += args.encoder_args
-        else:
-            self.encoder_args += config.get_encoder_args(self.output_main_codec)
+    def __init__(self, path:str, rebuild:bool = False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-    def get_output_main_codec(self):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        if rebuild is True:
+            self.connection.execute("DROP TABLE IF EXISTS entries")
+
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (kind TEXT, path TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, value TEXT, PRIMARY KEY (kind, path))")
+        self.connection.commit()
+
+    @staticmethod
+    def file_key(path:str, stat_result:os.stat_result = None) -> tuple:
         """
-        return output video code name
+        return the (size, mtime, inode) key of a file or None if it does not exist
         """
-        return self.output_main_codec
+        if stat_result is None:
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                return None
+        return (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino)
+
+    def get(self, kind:str, path:str, key:tuple) -> dict:
+        """
+        return the cached value of an entry or None if missing or invalidated
+        """
+        if key is None:
+            return None
+
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime_ns, inode, value FROM entries WHERE kind=? AND path=?", (kind, path)).fetchone()
+
+            if row is None or tuple(row[0:3]) != tuple(key):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+        return json.loads(row[3])
 
-    def get_args(self):
+    def put(self, kind:str, path:str, key:tuple, value:dict):
         """
-        return encoder ffmpeg encoder args
+        store an entry value for a file key
         """
-        return self.encoder_args
+        if key is None:
+            return
 
-class TranscoderInputOutputArgs:
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", (kind, path, key[0], key[1], key[2], json.dumps(value)))
+            self.connection.commit()
+
+    def remove(self, kind:str, path:str):
+        """
+        remove an entry
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM entries WHERE kind=? AND path=?", (kind, path))
+            self.connection.commit()
+
+    def close(self):
+        """
+        close the cache database
+        """
+        with self.lock:
+            self.connection.close()
+        logging.info("Cache %s hits: %d misses: %d", self.path, self.hits, self.misses)
+
+class TranscoderJournal:
     """
-    transcoder configuration
+    write-ahead journal of transcode job states stored as json lines.
+    Each state change is flushed to disk before the job moves on so an interrupted
+    run knows which outputs were left unfinished.
     """
-    def __init__(self, args):
-        self.input_dir = args.input_dir
-        self.output_dir = args.output_dir
-        self.output_suffix = args.output_suffix
-        self.keep_relative_path = args.keep_relative_path
 
-    def get_input_dir(self) -> str:
+    DEFAULT_NAME = ".tabarnak.journal"
+
+    # job states
+    QUEUED = "queued"
+    RUNNING = "running"
+    VERIFIED = "verified"
+    FAILED = "failed"
+    # claimed by a worker on another host
+    SKIPPED = "skipped"
+
+    UNFINISHED_STATES = [QUEUED, RUNNING]
+
+    def __init__(self, path:str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.journal_file = None
+        self.entries = {}
+
+        self.load()
+
+    def load(self):
         """
-        return input directory
+        load job states from an existing journal. The last record of each output wins.
         """
-        return self.input_dir
+        try:
+            with open(self.path, "r", encoding="utf-8") as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line of a journal interrupted while writing
+                        logging.warning("Journal %s ignoring invalid entry: %s", self.path, line.strip())
+                        continue
+                    self.entries[entry["output_file"]] = entry
+        except FileNotFoundError:
+            pass
+
+    def get_unfinished(self) -> list:
+        """
+        return entries of jobs interrupted before their output was verified
+        """
+        with self.lock:
+            return [entry for entry in self.entries.values() if entry["state"] in TranscoderJournal.UNFINISHED_STATES]
 
-    def get_output_dir(self, input_dir:str, root_path:str) -> str:
+    def get_state(self, output_file:str) -> str:
         """
-        return output directory
+        return the last recorded state of an output or None
         """
-        if self.keep_relative_path is True:
-            rel_path = os.path.relpath(root_path, input_dir)
-            output_dir = os.path.join(self.output_dir, rel_path)
-            return output_dir
-        return self.output_dir
+        with self.lock:
+            entry = self.entries.get(output_file)
+        return entry["state"] if entry is not None else None
 
-    def get_output_suffix(self) -> str:
+    def record(self, output_file:str, source_filename:str, state:str):
         """
-        return output suffix
+        append a job state to the journal and sync it to disk
         """
-        return self.output_suffix
+        entry = dict(output_file=output_file, source_filename=source_filename, state=state, time=time.time())
+
+        with self.lock:
+            if self.journal_file is None:
+                self.compact()
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                # kept open for the whole run so each record is a single append and fsync. It is closed by close()
+                self.journal_file = open(self.path, "a", encoding="utf-8") # pylint: disable=consider-using-with
+
+            self.journal_file.write(json.dumps(entry) + "\n")
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+            self.entries[output_file] = entry
+
+    def compact(self):
+        """
+        rewrite the journal keeping only unfinished jobs. The journal is removed if none are left.
+        """
+        unfinished = [entry for entry in self.entries.values() if entry["state"] in TranscoderJournal.UNFINISHED_STATES]
+
+        if not unfinished:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+
+        compact_path = self.path + ".compact"
+        with open(compact_path, "w", encoding="utf-8") as compact_file:
+            for entry in unfinished:
+                compact_file.write(json.dumps(entry) + "\n")
+            compact_file.flush()
+            os.fsync(compact_file.fileno())
+        os.replace(compact_path, self.path)
+
+    def close(self):
+        """
+        close the journal. It is compacted so only interrupted jobs remain.
+        """
+        with self.lock:
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+                self.compact()
 
-class TranscoderArgs:
+class TranscoderClaims:
     """
-    transcoder arguments and options
+    shared queue of claimed outputs stored as lock files in a directory on a shared filesystem.
+    Workers on several hosts claim an output before encoding it so each file is encoded once.
+    Claims are leases renewed by a heartbeat thread. Claims not renewed for the lease time
+    belong to a dead worker and are reclaimed.
     """
-    def __init__(self, args, config:TranscoderConfiguration, stdout=sys.stdout, stderr=sys.stderr):
-        self.args = args
 
-        self.input_output_args = TranscoderInputOutputArgs(args)
-        self.config = config
-        self.encoder_args = TranscoderEncoderArgs(args, self.config)
+    DEFAULT_NAME = ".tabarnak.claims"
+    LOCK_EXT = ".lock"
 
-        self.stdout = stdout
-        self.stderr = stderr
+    def __init__(self, path:str, output_dir:str, lease_time:float):
+        self.path = path
+        self.output_dir = output_dir
+        self.lease_time = lease_time
+        self.worker = "%s:%d" % (socket.gethostname(), os.getpid())
 
-    def get_input_dir(self) -> str:
+        # lock file modification times are compared to the shared filesystem clock
+        self.clock_path = os.path.join(path, ".clock-%s-%d" % (socket.gethostname(), os.getpid()))
+
+        self.lock = threading.Lock()
+        self.claims = {}
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+
+        os.makedirs(path, exist_ok=True)
+
+    def get_lock_path(self, output_file:str) -> str:
         """
-        return transcoder input dir
+        return the lock file of an output. Outputs are identified by their path relative to the
+        output directory so hosts may mount the shared filesystem at different paths.
         """
-        return self.input_output_args.get_input_dir()
+        rel_path = os.path.relpath(os.path.abspath(output_file), os.path.abspath(self.output_dir))
+        return os.path.join(self.path, hashlib.sha1(os.fsencode(rel_path)).hexdigest() + TranscoderClaims.LOCK_EXT)
 
-    def get_output_dir(self, input_dir:str, root_path:str) -> str:
+    def get_shared_time(self) -> float:
         """
-        return transcoder output dir
+        return the current time of the shared filesystem to avoid clock skew between hosts
         """
-        return self.input_output_args.get_output_dir(input_dir, root_path)
+        with open(self.clock_path, "a", encoding="utf-8"):
+            pass
+        os.utime(self.clock_path)
+        return os.stat(self.clock_path).st_mtime
 
-    def get_output_suffix(self) -> str:
+    def is_expired(self, lock_path:str) -> bool:
         """
-        return transcoder output suffix
+        return True if a lock file was not renewed for the lease time
         """
-        return self.input_output_args.get_output_suffix()
+        try:
+            mtime = os.stat(lock_path).st_mtime
+        except FileNotFoundError:
+            return True
+        return self.get_shared_time() - mtime > self.lease_time
 
-    def get_output_main_codec(self):
+    def is_claimed(self, output_file:str) -> bool:
         """
-        return output video codec name from encoder args
+        return True if an output is claimed by a live worker
         """
-        return self.encoder_args.get_output_main_codec()
+        lock_path = self.get_lock_path(output_file)
+        return os.path.exists(lock_path) is True and self.is_expired(lock_path) is False
 
-    def get_container_ext(self):
+    @staticmethod
+    def read_owner(lock_path:str) -> str:
         """
-        return container extension based on transcoder args
+        return the worker owning a lock file
         """
-        return self.config.get_container_ext(self.get_output_main_codec())
+        try:
+            with open(lock_path, "r", encoding="utf-8") as lock_file:
+                return json.loads(lock_file.read()).get("worker", "")
+        except (OSError, ValueError):
+            return ""
 
-    def get_encoder_args(self):
+    def create(self, lock_path:str, output_file:str, source_filename:str) -> bool:
         """
-        fetch encoder arguments for ffmpeg
+        create a lock file exclusively. return False if it already exists.
         """
-        return self.encoder_args.get_args()
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
 
-    def get_diff_tolerance_in_frames(self):
+        with os.fdopen(fd, "w", encoding="utf-8") as lock_file:
+            lock_file.write(json.dumps(dict(worker=self.worker, output_file=output_file, source_filename=source_filename, time=time.time())))
+        return True
+
+    def reclaim(self, lock_path:str) -> bool:
         """
-        fetch diff tolerance in frames
+        remove an expired lock file. return False if another worker renewed or reclaimed it first.
         """
-        return self.args.duration_diff_tolerance_in_frames
+        # only one worker can rename the lock file away
+        stale_path = "%s.%s.stale" % (lock_path, self.worker)
+        try:
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            return True
+
+        if self.is_expired(stale_path) is False:
+            # the lock was replaced by another worker since it was checked: give it back
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
 
-    def get_percent_tolerance(self):
+        logging.warning("Reclaiming %s expired claim of %s", lock_path, self.read_owner(stale_path))
+        os.remove(stale_path)
+        return True
+
+    def claim(self, output_file:str, source_filename:str) -> bool:
         """
-        fetch percent tolerance
+        claim an output for this worker. return False if another live worker holds it.
         """
-        return self.args.percent_tolerance
+        lock_path = self.get_lock_path(output_file)
 
+        claimed = self.create(lock_path, output_file, source_filename)
+        if claimed is False and self.is_expired(lock_path) is True and self.reclaim(lock_path) is True:
+            claimed = self.create(lock_path, output_file, source_filename)
 
+        if claimed is False:
+            logging.info("Skipping %s claimed by %s", output_file, self.read_owner(lock_path))
+            return False
 
-def setup_logging(args):
-    """
-    setup logging. Add file & console logging handlers.
-    If we are using prometheus setup prometheus logging.
-    """
+        with self.lock:
+            self.claims[output_file] = lock_path
+            if self.heartbeat_thread is None:
+                self.heartbeat_thread = threading.Thread(target=self.heartbeat, name="heartbeat", daemon=True)
+                self.heartbeat_thread.start()
+        return True
 
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+    def release(self, output_file:str):
+        """
+        release a claimed output once it is produced or failed
+        """
+        with self.lock:
+            lock_path = self.claims.pop(output_file, None)
 
-    # create formatter and add it to the handlers
+        if lock_path is not None:
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                logging.warning("Claim of %s was lost before it was released", output_file)
+
+    def heartbeat(self):
+        """
+        heartbeat thread loop: renew claims every third of the lease time
+        """
+        while not self.stopped.wait(self.lease_time / 3):
+            with self.lock:
+                claims = list(self.claims.items())
+
+            for output_file, lock_path in claims:
+                try:
+                    os.utime(lock_path)
+                except FileNotFoundError:
+                    logging.warning("Claim of %s was lost: lease expired", output_file)
+
+    def close(self):
+        """
+        stop the heartbeat and release remaining claims
+        """
+        self.stopped.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+        for output_file in list(self.claims.keys()):
+            self.release(output_file)
+
+        if os.path.exists(self.clock_path):
+            os.remove(self.clock_path)
+
+class TranscoderEncodeGate:
+    """
+    gate of running encodes. Encodes run concurrently except retries of encodes that ran out
+    of memory or cpu time: they wait for running encodes and run alone.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.running = 0
+        self.exclusive = False
+        self.waiting_exclusive = 0
+
+    def acquire(self, exclusive:bool = False):
+        """
+        wait until an encode can run. Exclusive encodes run alone and new encodes wait for them.
+        """
+        with self.condition:
+            if exclusive is True:
+                self.waiting_exclusive += 1
+                while self.exclusive is True or self.running > 0:
+                    self.condition.wait()
+                self.waiting_exclusive -= 1
+                self.exclusive = True
+            else:
+                while self.exclusive is True or self.waiting_exclusive > 0:
+                    self.condition.wait()
+                self.running += 1
+
+    def release(self, exclusive:bool = False):
+        """
+        mark an encode as finished
+        """
+        with self.condition:
+            if exclusive is True:
+                self.exclusive = False
+            else:
+                self.running -= 1
+            self.condition.notify_all()
+
+class TranscoderCpuSlots:
+    """
+    cpus of the process split among concurrent encode jobs. A job runs on the cpus of the slot
+    it acquired so concurrent ffmpeg processes do not compete for the same cores. Where cpu
+    affinity is not available, slots only limit the encoder threads of their job.
+    """
+    def __init__(self, num_slots:int):
+        if hasattr(os, "sched_setaffinity"):
+            self.cpus = sorted(os.sched_getaffinity(0))
+        else:
+            logging.warning("Cpu affinity is not available: ffmpeg is not pinned and only its encoder threads are limited")
+            self.cpus = list(range(get_cpu_count()))
+        self.slots = queue.Queue()
+        for cpus in TranscoderCpuSlots.split(self.cpus, max(1, num_slots)):
+            self.slots.put(cpus)
+
+    @staticmethod
+    def split(cpus:list, count:int) -> list:
+        """
+        split cpus in count groups of contiguous cpus. Groups share cpus if there are fewer cpus than groups.
+        """
+        if count >= len(cpus):
+            return [[cpus[index % len(cpus)]] for index in range(count)]
+
+        size, remainder = divmod(len(cpus), count)
+        groups = []
+        start = 0
+        for index in range(count):
+            end = start + size + (1 if index < remainder else 0)
+            groups.append(cpus[start:end])
+            start = end
+        return groups
+
+    def acquire(self) -> list:
+        """
+        wait for a free slot and return its cpus
+        """
+        return self.slots.get()
+
+    def release(self, cpus:list):
+        """
+        free the slot of cpus
+        """
+        self.slots.put(cpus)
+
+class TranscoderAdmission:
+    """
+    admission control of encode jobs. New encodes are held back while the load average is above
+    a threshold or while the available memory of the host or of the memory cgroup of the process
+    is below a threshold. Without pressure, encodes are admitted immediately. After a hold back,
+    the next admission is spaced by the check interval so the load and memory of the encode
+    admitted when pressure dropped are accounted before another one starts.
+    """
+
+    LOADAVG_PATH = "/proc/loadavg"
+    MEMINFO_PATH = "/proc/meminfo"
+    CGROUP_PATH = "/proc/self/cgroup"
+    CGROUP_ROOT = "/sys/fs/cgroup"
+
+    # cgroup v2 and v1 memory limit, usage and reclaimable page cache
+    CGROUP_V2_MEMORY = ("memory.max", "memory.current", "inactive_file")
+    CGROUP_V1_MEMORY = ("memory.limit_in_bytes", "memory.usage_in_bytes", "total_inactive_file")
+
+    def __init__(self, max_load:float, min_available_memory:int, interval:float):
+        self.max_load = max_load
+        self.min_available_memory = min_available_memory
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.last_admit_time = None
+        self.held_back = False
+        self.memory_cgroup = TranscoderAdmission.find_memory_cgroup()
+
+    @staticmethod
+    def find_memory_cgroup() -> tuple:
+        """
+        return the memory cgroup directory of the process and its memory file names or None
+        """
+        try:
+            with open(TranscoderAdmission.CGROUP_PATH, "r", encoding="utf-8") as cgroup_file:
+                lines = cgroup_file.read().splitlines()
+        except OSError:
+            return None
+
+        for line in lines:
+            hierarchy, controllers, path = line.split(":", 2)
+            if hierarchy == "0":
+                cgroup_dirs = [os.path.join(TranscoderAdmission.CGROUP_ROOT, path.lstrip("/")), TranscoderAdmission.CGROUP_ROOT]
+                memory_files = TranscoderAdmission.CGROUP_V2_MEMORY
+            elif "memory" in controllers.split(","):
+                cgroup_dirs = [os.path.join(TranscoderAdmission.CGROUP_ROOT, "memory", path.lstrip("/")), os.path.join(TranscoderAdmission.CGROUP_ROOT, "memory")]
+                memory_files = TranscoderAdmission.CGROUP_V1_MEMORY
+            else:
+                continue
+
+            # containers may only see their own cgroup mounted at the root
+            for cgroup_dir in cgroup_dirs:
+                if os.path.exists(os.path.join(cgroup_dir, memory_files[0])):
+                    return cgroup_dir, memory_files
+        return None
+
+    @staticmethod
+    def read_load() -> float:
+        """
+        return the one minute load average
+        """
+        with open(TranscoderAdmission.LOADAVG_PATH, "r", encoding="utf-8") as loadavg_file:
+            return float(loadavg_file.read().split()[0])
+
+    def read_available_memory(self) -> int:
+        """
+        return the memory available in bytes to new processes or None if unknown
+        """
+        available = None
+        with open(TranscoderAdmission.MEMINFO_PATH, "r", encoding="utf-8") as meminfo_file:
+            for line in meminfo_file:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+
+        if self.memory_cgroup is None:
+            return available
+
+        cgroup_dir, (limit_name, usage_name, inactive_name) = self.memory_cgroup
+        try:
+            with open(os.path.join(cgroup_dir, limit_name), "r", encoding="utf-8") as limit_file:
+                limit = limit_file.read().strip()
+            with open(os.path.join(cgroup_dir, usage_name), "r", encoding="utf-8") as usage_file:
+                usage = int(usage_file.read())
+            with open(os.path.join(cgroup_dir, "memory.stat"), "r", encoding="utf-8") as stat_file:
+                for line in stat_file:
+                    name, value = line.split()
+                    if name == inactive_name:
+                        usage -= int(value)
+        except (OSError, ValueError):
+            return available
+
+        if limit == "max":
+            return available
+
+        cgroup_available = max(0, int(limit) - usage)
+        return cgroup_available if available is None else min(available, cgroup_available)
+
+    def get_pressure(self) -> str:
+        """
+        return why new encodes are held back or None if they are admitted
+        """
+        try:
+            if self.max_load > 0:
+                load = self.read_load()
+                if load > self.max_load:
+                    return "load %.2f above %.2f" % (load, self.max_load)
+
+            if self.min_available_memory > 0:
+                available = self.read_available_memory()
+                if available is not None and available < self.min_available_memory:
+                    return "available memory %s below %s" % (format_size(available), format_size(self.min_available_memory))
+        except (OSError, ValueError) as error:
+            logging.warning("Admission control cannot read system pressure: %s", error)
+        return None
+
+    def wait(self, name:str):
+        """
+        wait until an encode can be admitted
+        """
+        with self.lock:
+            if self.held_back is True:
+                self.held_back = False
+                delay = self.last_admit_time + self.interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            start_time = time.monotonic()
+            pressure = self.get_pressure()
+            if pressure is not None:
+                self.held_back = True
+                logging.info("Holding back %s: %s", name, pressure)
+                while pressure is not None:
+                    time.sleep(self.interval)
+                    pressure = self.get_pressure()
+                logging.info("Admitting %s after %s", name, format_duration(time.monotonic() - start_time))
+
+            self.last_admit_time = time.monotonic()
+
+#
+# configuration class
+#
+DEFAULT_H264_VIDEO_CONFIG = {
+    "default_ext": ".mkv",
+    "encoder_args" : {
+        "-c:v": "libx264",
+        "-crf": "30"
+    },
+    "triage": {
+        "efficient_codecs": ["hevc", "av1", "vp9"],
+        "efficient_bits_per_pixel": 0.06,
+        "efficient_video_bit_rates": {"480": 700000, "576": 1000000, "720": 1700000, "1080": 3500000, "2160": 12000000}
+    },
+    "stream_copy": {
+        "codecs": ["h264", "aac", "opus", "vorbis", "mp3", "ac3", "eac3", "dts", "subrip", "ass", "ssa", "webvtt", "hdmv_pgs_subtitle", "dvd_subtitle", "dvb_subtitle"],
+        "encoder_args": {
+            "-c:a": "libopus",
+            "-c:s": "ass"
+        }
+    }
+}
+
+DEFAULT_HEVC_VIDEO_CONFIG = {
+    "default_ext": ".mkv",
+    "encoder_args" : {
+        "-c:v": "libx265",
+        "-crf": "28",
+        "-preset": "medium"
+    },
+    "triage": {
+        "efficient_codecs": ["av1", "vp9"],
+        "efficient_bits_per_pixel": 0.04,
+        "efficient_video_bit_rates": {"480": 500000, "576": 700000, "720": 1200000, "1080": 2500000, "2160": 8000000}
+    },
+    "stream_copy": {
+        "codecs": ["hevc", "aac", "opus", "vorbis", "mp3", "ac3", "eac3", "dts", "subrip", "ass", "ssa", "webvtt", "hdmv_pgs_subtitle", "dvd_subtitle", "dvb_subtitle"],
+        "encoder_args": {
+            "-c:a": "libopus",
+            "-c:s": "ass"
+        }
+    }
+}
+
+DEFAULT_AV1_VIDEO_CONFIG = {
+    "default_ext": ".mkv",
+    "encoder_args" : {
+        "-c:v": "libaom-av1",
+        "-crf": "30",
+        "-b:v": "2000k",
+        "-strict": "experimental",
+        "-row-mt": "1",
+        "-tile-columns": "4",
+        "-tile-rows": ""
+    },
+    "triage": {
+        "efficient_codecs": ["hevc", "vp9"],
+        "efficient_bits_per_pixel": 0.03,
+        "efficient_video_bit_rates": {"480": 400000, "576": 550000, "720": 1000000, "1080": 2000000, "2160": 6500000}
+    },
+    "stream_copy": {
+        "codecs": ["av1", "aac", "opus", "vorbis", "mp3", "ac3", "eac3", "dts", "subrip", "ass", "ssa", "webvtt", "hdmv_pgs_subtitle", "dvd_subtitle", "dvb_subtitle"],
+        "encoder_args": {
+            "-c:a": "libopus",
+            "-c:s": "ass"
+        }
+    }
+}
+
+DEFAULT_VP9_VIDEO_CONFIG = {
+    "default_ext": ".webm",
+    "encoder_args" : {
+        "-c:v": "libvpx-vp9",
+        "-crf": "30",
+        "-b:v": "2000k"
+    },
+    "triage": {
+        "efficient_codecs": ["hevc", "av1"],
+        "efficient_bits_per_pixel": 0.04,
+        "efficient_video_bit_rates": {"480": 500000, "576": 700000, "720": 1200000, "1080": 2500000, "2160": 8000000}
+    },
+    "stream_copy": {
+        "codecs": ["vp9", "opus", "vorbis", "webvtt"],
+        "encoder_args": {
+            "-c:a": "libopus",
+            "-c:s": "webvtt"
+        }
+    }
+}
+
+
+DEFAULT_OPUS_AUDIO_CONFIG = {
+    "default_ext": ".ogg",
+    "encoder_args" : {
+        "-c:a": "libopus",
+    },
+    "triage": {
+        "efficient_codecs": [],
+        "efficient_audio_bit_rate": 96000
+    },
+    "stream_copy": {
+        "codecs": ["opus"],
+        "encoder_args": {}
+    }
+}
+
+DEFAULT_FLAC_AUDIO_CONFIG = {
+    "default_ext": ".flac",
+    "encoder_args" : {
+        "-c:a": "flac",
+    },
+    "triage": {
+        "efficient_codecs": ["aac", "mp3", "vorbis", "opus", "ac3", "eac3", "wmav2"]
+    },
+    "stream_copy": {
+        "codecs": ["flac"],
+        "encoder_args": {}
+    }
+}
+
+# files with a media extension are probed, others only if they start with container magic bytes
+DEFAULT_PREFILTER_CONFIG = {
+    "enabled": True,
+    "magic": True,
+    "media_ext": [".mkv", ".mka", ".webm", ".mp4", ".m4v", ".m4a", ".mov", ".3gp", ".avi", ".wav", ".aiff", ".aif",
+                  ".ogg", ".ogv", ".oga", ".opus", ".flac", ".mp3", ".aac", ".ac3", ".dts", ".wma", ".wmv", ".asf",
+                  ".flv", ".ts", ".m2ts", ".mts", ".mpg", ".mpeg", ".vob", ".dv", ".mxf"]
+}
+
+class TranscoderConfiguration:
+    """
+    transcoder configuration
+    """
+    YAMLTag = "!TranscoderConfiguration"
+
+    def __init__(self, configs:dict = None, prefilter:dict = None):
+        # use default config if none specified
+        if configs is None:
+            self.configs = {
+                "h264": DEFAULT_H264_VIDEO_CONFIG,
+                "hevc" : DEFAULT_HEVC_VIDEO_CONFIG,
+                "av1" : DEFAULT_AV1_VIDEO_CONFIG,
+                "vp9" : DEFAULT_VP9_VIDEO_CONFIG,
+                "opus" : DEFAULT_OPUS_AUDIO_CONFIG,
+                "flac" : DEFAULT_FLAC_AUDIO_CONFIG
+            }
+        else:
+            self.configs = configs
+
+        self.prefilter = prefilter if prefilter is not None else DEFAULT_PREFILTER_CONFIG
+
+    def get_prefilter(self) -> dict:
+        """
+        return the media prefilter configuration
+        """
+        return self.prefilter
+
+    def get_triage(self, config_name:str) -> dict:
+        """
+        return the triage thresholds of a config or None
+        """
+        return self.configs.get(config_name, {}).get("triage")
+
+    def get_stream_copy(self, config_name:str) -> dict:
+        """
+        return the codecs passed through and the encoder args of other streams of a config or None
+        """
+        return self.configs.get(config_name, {}).get("stream_copy")
+
+    def get_container_ext(self, config_name:str) -> str:
+        """
+        return container extension based on config name
+        """
+        return self.configs.get(config_name).get("default_ext")
+
+    def get_encoder_args(self, config_name:str) -> str:
+        """
+        return encoder args based on config name
+        """
+        video_config_encoder_args = self.configs.get(config_name).get("encoder_args")
+        encoder_args = ""
+        for key, value in video_config_encoder_args.items():
+            encoder_args += key + " " + value + " "
+        return encoder_args
+
+    def as_dict(self):
+        """
+        return object as a dict
+        """
+        return dict(configs=self.configs, prefilter=self.prefilter)
+
+    def from_dict(self, config_dict:dict):
+        """
+        override config from dict
+        """
+        self.configs = config_dict["configs"]
+        self.prefilter = config_dict.get("prefilter", DEFAULT_PREFILTER_CONFIG)
+
+    @staticmethod
+    def to_yaml(dumper, data):
+        """
+        dump the file to yaml
+        """
+        return dumper.represent_mapping(data.YAMLTag, data.as_dict())
+
+    @staticmethod
+    def from_yaml(loader, node):
+        """
+        build a TranscoderConfiguration from a yml loader and node
+        """
+        node_map = loader.construct_mapping(node)
+        return TranscoderConfiguration(configs=node_map["configs"], prefilter=node_map.get("prefilter"))
+
+yaml.add_representer(TranscoderConfiguration, TranscoderConfiguration.to_yaml, Dumper=yaml.SafeDumper)
+yaml.add_constructor(TranscoderConfiguration.YAMLTag, TranscoderConfiguration.from_yaml, Loader=yaml.SafeLoader)
+
+class TranscoderEncoderArgs:
+    """
+    transcoder encoder args
+    """
+    # encoders limited with their own thread pool parameters instead of -threads
+    THREAD_PARAMS = {
+        "libx265": ("-x265-params", "pools=%d"),
+        "libsvtav1": ("-svtav1-params", "lp=%d"),
+    }
+
+    def __init__(self, args: dict, config: TranscoderConfiguration):
+        self.map_args = ""
+        self.codec_args = ""
+        self.output_main_codec = "hevc"
+
+        # segment encoding remaps streams itself unless a custom mapping is specified
+        self.custom_map = args.map_args is not None
+        self.map_all = args.map_args is None and args.default_map is False
+        self.strip_metadata = args.strip_metadata
+
+        if args.map_args is not None:
+            self.map_args += args.map_args
+        elif args.default_map is False:
+            self.map_args += " -map 0 "
+
+        if args.strip_metadata is True:
+            self.map_args += " -map_metadata -1 "
+
+        if args.config_name is not None:
+            self.codec_args += config.get_encoder_args(args.config_name)
+            self.output_main_codec = args.config_name
+        elif args.encoder_args is not None:
+            self.codec_args += args.encoder_args
+        else:
+            self.codec_args += config.get_encoder_args(self.output_main_codec)
+
+        self.encoder_args = self.map_args + self.codec_args
+
+        # per stream copy needs output streams in source order
+        self.stream_copy = None
+        if args.stream_copy is True and self.map_all is True:
+            self.stream_copy = config.get_stream_copy(self.output_main_codec)
+
+    def get_output_main_codec(self):
+        """
+        return output video code name
+        """
+        return self.output_main_codec
+
+    def get_args(self, threads:int = 0, media_info:MediaInfo = None):
+        """
+        return encoder ffmpeg encoder args limited to threads threads if specified.
+        With per stream copy, streams of media_info already in an output codec are passed through.
+        """
+        args = self.encoder_args
+        if threads > 0:
+            args = self.map_args + self.get_codec_args(threads)
+        if self.stream_copy is not None and media_info is not None:
+            args += " " + self.get_stream_copy_args(media_info)
+        return args
+
+    def get_stream_copy_args(self, media_info:MediaInfo) -> str:
+        """
+        return ffmpeg args encoding streams of a media file that are not passed through
+        with the stream copy encoder args and copying the others
+        """
+        args = ""
+        for key, value in self.stream_copy.get("encoder_args", {}).items():
+            args += key + " " + value + " "
+
+        # stream specifiers override the codec of their stream only
+        for codec_type, specifier in STREAM_SPECIFIERS.items():
+            for index, stream in enumerate(media_info.get_streams(codec_type)):
+                if stream.codec_name in self.stream_copy["codecs"]:
+                    args += "-c:%s:%d copy " % (specifier, index)
+        return args
+
+    def get_encoded_streams(self, media_info:MediaInfo) -> list:
+        """
+        return the streams of a media file that are encoded with per stream copy or
+        an empty list if per stream copy is disabled
+        """
+        if self.stream_copy is None or media_info is None:
+            return []
+        return [stream for stream in media_info.streams if stream.codec_type in STREAM_SPECIFIERS and stream.codec_name not in self.stream_copy["codecs"]]
+
+    def is_video_copied(self, media_info:MediaInfo) -> bool:
+        """
+        return True if the first video stream of a media file is passed through with per stream copy
+        """
+        video_stream = media_info.get_video_stream() if media_info is not None else None
+        return self.stream_copy is not None and video_stream is not None and video_stream.codec_name in self.stream_copy["codecs"]
+
+    def get_codec_args(self, threads:int = 0):
+        """
+        return ffmpeg encoder args without stream mapping and metadata args
+        limited to threads threads if specified
+        """
+        if threads > 0:
+            return TranscoderEncoderArgs.add_thread_args(self.codec_args, threads)
+        return self.codec_args
+
+    @staticmethod
+    def add_thread_args(codec_args:str, threads:int) -> str:
+        """
+        return codec args limiting the encoder threads unless they are already limited.
+        Encoders with their own thread pool are limited with their parameters, others with -threads.
+        """
+        args = split_args(codec_args)
+
+        encoder = ""
+        for option, value in zip(args, args[1:]):
+            if option in ["-c:v", "-vcodec", "-codec:v"]:
+                encoder = value
+
+        params_option, param = TranscoderEncoderArgs.THREAD_PARAMS.get(encoder, ("-threads", None))
+        if param is None:
+            if "-threads" not in args:
+                args += ["-threads", str(threads)]
+        elif params_option in args[:-1]:
+            index = args.index(params_option) + 1
+            if param.split("=")[0] + "=" not in args[index]:
+                args[index] += ":" + param % (threads)
+        else:
+            args += [params_option, param % (threads)]
+
+        return " ".join(args)
+
+class TranscoderInputOutputArgs:
+    """
+    transcoder configuration
+    """
+    def __init__(self, args):
+        self.input_dir = args.input_dir
+        self.output_dir = args.output_dir
+        self.output_suffix = args.output_suffix
+        self.keep_relative_path = args.keep_relative_path
+
+        # output directories created so far
+        self.output_dirs_lock = threading.Lock()
+        self.output_dirs = set()
+
+    def get_input_dir(self) -> str:
+        """
+        return input directory
+        """
+        return self.input_dir
+
+    def get_output_dir(self, input_dir:str, root_path:str) -> str:
+        """
+        return output directory
+        """
+        if self.keep_relative_path is True:
+            rel_path = os.path.relpath(root_path, input_dir)
+            output_dir = os.path.join(self.output_dir, rel_path)
+            return output_dir
+        return self.output_dir
+
+    def get_output_suffix(self) -> str:
+        """
+        return output suffix
+        """
+        return self.output_suffix
+
+    def make_output_dir(self, output_dir:str):
+        """
+        create an output directory once before its first file is written
+        """
+        with self.output_dirs_lock:
+            if output_dir in self.output_dirs:
+                return
+            os.makedirs(output_dir, exist_ok=True)
+            self.output_dirs.add(output_dir)
+
+# every option is read through a getter of TranscoderArgs
+class TranscoderArgs: # pylint: disable=too-many-public-methods
+    """
+    transcoder arguments and options
+    """
+    def __init__(self, args, config:TranscoderConfiguration, stdout=sys.stdout, stderr=sys.stderr):
+        self.args = args
+
+        self.input_output_args = TranscoderInputOutputArgs(args)
+        self.config = config
+        self.encoder_args = TranscoderEncoderArgs(args, self.config)
+
+        self.stdout = stdout
+        self.stderr = stderr
+        self.output_lock = threading.Lock()
+
+        self.cache = None
+        if args.use_cache is True or args.rebuild_cache is True:
+            cache_path = args.cache_path
+            if cache_path is None:
+                cache_path = os.path.join(args.output_dir, TranscoderCache.DEFAULT_NAME)
+            self.cache = TranscoderCache(cache_path, rebuild=args.rebuild_cache)
+
+        self.journal = None
+        if args.use_journal is True:
+            journal_path = args.journal_path
+            if journal_path is None and args.shared_queue is True:
+                # each host resumes its own interrupted jobs
+                journal_path = os.path.join(args.output_dir, "%s.%s" % (TranscoderJournal.DEFAULT_NAME, socket.gethostname()))
+            elif journal_path is None:
+                journal_path = os.path.join(args.output_dir, TranscoderJournal.DEFAULT_NAME)
+            self.journal = TranscoderJournal(journal_path)
+
+        self.cpu_slots = None
+        if args.pin_cpus is True:
+            self.cpu_slots = TranscoderCpuSlots(args.jobs)
+
+        # ffmpeg runs with a lower cpu and io priority
+        self.priority_cmd = get_ffmpeg_priority_cmd(args.nice, args.ionice)
+
+        # limits of each ffmpeg process
+        self.resource_limits = get_ffmpeg_resource_limits(args.max_memory, args.max_cpu_time)
+        self.encode_gate = TranscoderEncodeGate()
+
+        self.admission = None
+        if args.max_load > 0 or args.min_available_memory > 0:
+            self.admission = TranscoderAdmission(args.max_load, args.min_available_memory * 1024 * 1024, args.admission_interval)
+
+        self.claims = None
+        if args.shared_queue is True:
+            claim_dir = args.claim_dir
+            if claim_dir is None:
+                claim_dir = os.path.join(args.output_dir, TranscoderClaims.DEFAULT_NAME)
+            self.claims = TranscoderClaims(claim_dir, args.output_dir, self.get_lease_time())
+
+    def close(self):
+        """
+        release resources held by transcoder arguments
+        """
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+        if self.claims is not None:
+            self.claims.close()
+            self.claims = None
+
+    def get_cache(self) -> TranscoderCache:
+        """
+        return the probe and verification cache or None if disabled
+        """
+        return self.cache
+
+    def get_journal(self) -> TranscoderJournal:
+        """
+        return the job journal or None if disabled
+        """
+        return self.journal
+
+    def get_cpu_slots(self) -> TranscoderCpuSlots:
+        """
+        return the cpu slots of concurrent jobs or None if jobs are not pinned
+        """
+        return self.cpu_slots
+
+    def get_priority_cmd(self) -> list:
+        """
+        return the nice and ionice command prefixed to ffmpeg commands
+        """
+        return self.priority_cmd
+
+    def get_resource_limits(self) -> list:
+        """
+        return (resource name, (soft, hard)) limits applied to each ffmpeg process
+        """
+        return self.resource_limits
+
+    def get_resource_retries(self) -> int:
+        """
+        fetch number of retries of encodes that ran out of memory or cpu time
+        """
+        return self.args.resource_retries
+
+    def get_encode_gate(self) -> TranscoderEncodeGate:
+        """
+        return the gate of running encodes
+        """
+        return self.encode_gate
+
+    def get_admission(self) -> TranscoderAdmission:
+        """
+        return the encode admission control or None if disabled
+        """
+        return self.admission
+
+    def get_claims(self) -> TranscoderClaims:
+        """
+        return the shared queue claims or None if disabled
+        """
+        return self.claims
+
+    def get_input_dir(self) -> str:
+        """
+        return transcoder input dir
+        """
+        return self.input_output_args.get_input_dir()
+
+    def get_output_dir(self, input_dir:str, root_path:str) -> str:
+        """
+        return transcoder output dir
+        """
+        return self.input_output_args.get_output_dir(input_dir, root_path)
+
+    def make_output_dir(self, output_dir:str):
+        """
+        create an output directory once before its first file is written
+        """
+        self.input_output_args.make_output_dir(output_dir)
+
+    def get_output_suffix(self) -> str:
+        """
+        return transcoder output suffix
+        """
+        return self.input_output_args.get_output_suffix()
+
+    def get_output_main_codec(self):
+        """
+        return output video codec name from encoder args
+        """
+        return self.encoder_args.get_output_main_codec()
+
+    def get_container_ext(self):
+        """
+        return container extension based on transcoder args
+        """
+        return self.config.get_container_ext(self.get_output_main_codec())
+
+    def get_encoder_args(self, threads:int = 0, media_info:MediaInfo = None):
+        """
+        fetch encoder arguments for ffmpeg limited to threads threads if specified.
+        With per stream copy, they are built for the streams of media_info if specified.
+        """
+        return self.encoder_args.get_args(threads, media_info)
+
+    def get_prefilter(self) -> dict:
+        """
+        fetch the media prefilter configuration
+        """
+        return self.config.get_prefilter()
+
+    def get_remux(self) -> bool:
+        """
+        return True if files already in the output codec are remuxed to the output container
+        """
+        return self.args.remux
+
+    def get_triage(self) -> dict:
+        """
+        fetch the triage thresholds of the output config or None if triage is disabled
+        """
+        if self.args.triage is False:
+            return None
+        return self.config.get_triage(self.get_output_main_codec())
+
+    def get_transcoder_encoder_args(self) -> TranscoderEncoderArgs:
+        """
+        fetch encoder arguments with their stream mapping and codec parts
+        """
+        return self.encoder_args
+
+    def get_diff_tolerance_in_frames(self):
+        """
+        fetch diff tolerance in frames
+        """
+        return self.args.duration_diff_tolerance_in_frames
+
+    def get_percent_tolerance(self):
+        """
+        fetch percent tolerance
+        """
+        return self.args.percent_tolerance
+
+    def get_probe_jobs(self) -> int:
+        """
+        fetch number of concurrent ffprobe jobs
+        """
+        return self.args.probe_jobs
+
+    def get_jobs(self) -> int:
+        """
+        fetch number of concurrent transcode jobs
+        """
+        return self.args.jobs
+
+    def get_ffmpeg_log_dir(self) -> str:
+        """
+        fetch directory where per job ffmpeg outputs are written or None
+        """
+        return self.args.ffmpeg_log_dir
+
+    def get_progress_interval(self) -> float:
+        """
+        fetch interval in seconds between progress logs
+        """
+        return self.args.progress_interval
+
+    def get_pipeline_stats_interval(self) -> float:
+        """
+        fetch interval in seconds between pipeline queue depths logs
+        """
+        return self.args.pipeline_stats_interval
+
+    def get_dry_run(self) -> bool:
+        """
+        return True if jobs are planned in a manifest without transcoding
+        """
+        return self.args.dry_run
+
+    def get_manifest_path(self) -> str:
+        """
+        fetch path where the dry run manifest is written
+        """
+        if self.args.manifest_path is None:
+            return os.path.join(self.args.output_dir, TranscodeManifest.DEFAULT_NAME)
+        return self.args.manifest_path
+
+    def get_from_manifest(self) -> str:
+        """
+        fetch path of the manifest to execute or None
+        """
+        return self.args.from_manifest
+
+    def get_manifest_shard(self) -> tuple:
+        """
+        fetch the zero based index and the count of the manifest shard to execute
+        """
+        shard, _, count = self.args.manifest_shard.partition("/")
+        shard_index = int(shard) - 1
+        shard_count = int(count)
+        if shard_count < 1 or shard_index < 0 or shard_index >= shard_count:
+            raise ValueError("Invalid manifest shard %s" % (self.args.manifest_shard))
+        return shard_index, shard_count
+
+    def get_order(self) -> str:
+        """
+        fetch the order in which probed jobs are dispatched
+        """
+        return self.args.order
+
+    def get_segments(self) -> int:
+        """
+        fetch number of segments encoded in parallel or 0 if segment encoding is disabled
+        """
+        if self.args.segment_encode is False:
+            return 0
+        return self.args.segments
+
+    def get_segment_min_duration(self) -> float:
+        """
+        fetch minimum input duration in seconds for segment encoding
+        """
+        return self.args.segment_min_duration
+
+    def get_forecast(self) -> bool:
+        """
+        return True if outputs are forecast from encoded samples before transcoding
+        """
+        return self.args.forecast
+
+    def get_forecast_samples(self) -> int:
+        """
+        fetch number of samples encoded to forecast outputs
+        """
+        return max(self.args.forecast_samples, 1)
+
+    def get_forecast_sample_duration(self) -> float:
+        """
+        fetch duration in seconds of forecast samples
+        """
+        return self.args.forecast_sample_duration
+
+    def get_forecast_min_saving(self) -> float:
+        """
+        fetch minimum forecast saving in percent to transcode a file
+        """
+        return self.args.forecast_min_saving
+
+    def get_lease_time(self) -> float:
+        """
+        fetch time in seconds after which jobs of a worker that stopped reporting are reclaimed
+        """
+        return self.args.lease_time
+
+    def get_serve_port(self) -> int:
+        """
+        fetch the job server port or None if not serving jobs
+        """
+        return self.args.serve_port
+
+    def get_serve_host(self) -> str:
+        """
+        fetch the address the job server listens on
+        """
+        return self.args.serve_host
+
+    def get_worker_url(self) -> str:
+        """
+        fetch the url of the job server to pull jobs from or None
+        """
+        return self.args.worker_url
+
+    def get_worker_idle_timeout(self) -> float:
+        """
+        fetch time in seconds a worker waits for jobs before exiting or 0 to wait until interrupted
+        """
+        return self.args.worker_idle_timeout
+
+    def get_watch(self) -> bool:
+        """
+        fetch if the input directory is watched for new files instead of walked
+        """
+        return self.args.watch
+
+    def get_watch_settle_time(self) -> float:
+        """
+        fetch time in seconds a new file must stop growing before it is transcoded
+        """
+        return self.args.watch_settle_time
+
+    def get_watch_duration(self) -> float:
+        """
+        fetch time in seconds the input directory is watched or 0 to watch until interrupted
+        """
+        return self.args.watch_duration
+
+
+
+#
+# job class
+#
+class TranscodeJob:
+    """
+    transcode job of a single input file
+    """
+    # actions
+    SKIP = "skip"
+    COPY = "copy"
+    EXISTS = "exists"
+    TRANSCODE = "transcode"
+    REMUX = "remux"
+
+    def __init__(self, name:str, source_filename:str, output_dir:str):
+        self.name = name
+        self.source_filename = source_filename
+        self.output_dir = output_dir
+
+        # walk order and directory entry
+        self.index = 0
+        self.dir_entry : os.DirEntry = None
+
+        # probe results
+        self.source_key : tuple = None
+        self.skip_decision : dict = None
+        self.media_info : MediaInfo = None
+        self.probe_error : Exception = None
+
+        # dispatch results
+        self.action : str = None
+        self.codec_name = ""
+        self.output_file : str = None
+        self.file_result : TrancodeFileResult = None
+
+        # encode results
+        self.cmd : list = None
+
+    def get_stat(self) -> os.stat_result:
+        """
+        return the source stat cached in its directory entry or None if it does not exist
+        """
+        try:
+            if self.dir_entry is not None:
+                return self.dir_entry.stat()
+            return os.stat(self.source_filename)
+        except OSError:
+            return None
+
+    def get_codec_name(self) -> str:
+        """
+        return the source codec name planned in a manifest, cached in a skip decision or probed
+        """
+        if self.action is not None:
+            # planned in a manifest
+            return self.codec_name
+        if self.skip_decision is not None:
+            return self.skip_decision["codec_name"]
+        if self.media_info is not None:
+            return fetch_codec_name(self.source_filename, self.media_info)
+        # jobs without media info were not probed: they are not media files
+        return ""
+
+    def get_size(self) -> int:
+        """
+        return the source file size in bytes
+        """
+        if self.media_info is not None and self.media_info.size > 0:
+            return self.media_info.size
+        stat_result = self.get_stat()
+        return stat_result.st_size if stat_result is not None else 0
+
+    def as_dict(self):
+        """
+        return the job decision as a dict
+        """
+        return dict(name=self.name,
+                    source_filename=self.source_filename,
+                    output_dir=self.output_dir,
+                    output_file=self.output_file,
+                    action=self.action,
+                    codec_name=self.codec_name,
+                    duration=self.media_info.get_duration() if self.media_info is not None else 0.0,
+                    size=self.get_size(),
+                    media_info=self.media_info.as_dict() if self.media_info is not None else None)
+
+    @staticmethod
+    def from_dict(job_dict:dict):
+        """
+        build a planned TranscodeJob from a dict returned by as_dict
+        """
+        job = TranscodeJob(job_dict["name"], job_dict["source_filename"], job_dict["output_dir"])
+        job.output_file = job_dict.get("output_file")
+        job.action = job_dict["action"]
+        job.codec_name = job_dict.get("codec_name", "")
+        if job_dict.get("media_info") is not None:
+            job.media_info = MediaInfo.from_dict(job_dict["media_info"])
+        return job
+
+class TranscodeManifest:
+    """
+    plan of transcode jobs written by a dry run and executed with --from-manifest
+    """
+
+    DEFAULT_NAME = ".tabarnak.manifest.json"
+    VERSION = 1
+
+    def __init__(self, jobs:list = None, output_codec:str = ""):
+        self.jobs : [TranscodeJob] = jobs if jobs is not None else []
+        self.output_codec = output_codec
+        self.lock = threading.Lock()
+
+    def add_job(self, job:TranscodeJob):
+        """
+        add a planned job
+        """
+        with self.lock:
+            self.jobs.append(job)
+
+    def get_jobs(self, shard_index:int = 0, shard_count:int = 1) -> [TranscodeJob]:
+        """
+        return planned jobs to execute. Skipped jobs are left out and jobs
+        are distributed round robin between shards.
+        """
+        jobs = [job for job in self.jobs if job.action != TranscodeJob.SKIP]
+        return jobs[shard_index::shard_count]
+
+    def get_action_counts(self) -> dict:
+        """
+        return the number of planned jobs per action
+        """
+        return dict(collections.Counter(job.action for job in self.jobs))
+
+    def as_dict(self):
+        """
+        return object as a dict
+        """
+        return dict(version=TranscodeManifest.VERSION,
+                    output_codec=self.output_codec,
+                    actions=self.get_action_counts(),
+                    jobs=[job.as_dict() for job in self.jobs])
+
+    @staticmethod
+    def from_dict(manifest_dict:dict):
+        """
+        build a TranscodeManifest from a dict returned by as_dict
+        """
+        if manifest_dict.get("version") != TranscodeManifest.VERSION:
+            raise RuntimeError("Unsupported manifest version %s" % (manifest_dict.get("version")))
+
+        jobs = [TranscodeJob.from_dict(job_dict) for job_dict in manifest_dict["jobs"]]
+        return TranscodeManifest(jobs, manifest_dict.get("output_codec", ""))
+
+    def write(self, path:str):
+        """
+        write the manifest as json
+        """
+        partial_path = path + PARTIAL_OUTPUT_SUFFIX
+        with open(partial_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(self.as_dict(), manifest_file, indent=4)
+        os.replace(partial_path, path)
+
+    @staticmethod
+    def read(path:str):
+        """
+        read a manifest written by a dry run
+        """
+        with open(path, "r", encoding="utf-8") as manifest_file:
+            return TranscodeManifest.from_dict(json.load(manifest_file))
+
+#
+# job ordering
+#
+
+# job orders: walk order or estimated encode cost and savings from probe data
+JOB_ORDERS = ["walk", "longest", "shortest", "savings"]
+
+# estimated fraction of the source size saved by transcoding, per source codec
+SAVINGS_RATIO_BY_CODEC = {
+    "hevc": 0.0, "vp9": 0.1, "av1": 0.0, "h264": 0.4, "vp8": 0.4,
+    "mpeg4": 0.6, "msmpeg4v3": 0.6, "dvvideo": 0.9, "dnxhd": 0.9,
+    "opus": 0.0, "aac": 0.1, "mp3": 0.1, "vorbis": 0.1, "alac": 0.5,
+    "flac": 0.5, "pcm_s16le": 0.6, "pcm_s24le": 0.6
+}
+DEFAULT_SAVINGS_RATIO = 0.4
+
+# sources above these bits per pixel compress as expected, below they shrink less
+REFERENCE_BITS_PER_PIXEL = 0.1
+
+# audio only files cost about as much as encoding this many pixels per second
+AUDIO_PIXELS_PER_SECOND = 100000.0
+
+def estimate_encode_cost(media_info:MediaInfo) -> float:
+    """
+    estimate the cost of transcoding a media file as the number of pixels to encode
+    """
+    if media_info is None:
+        return 0.0
+
+    duration = media_info.get_duration()
+    video_stream = media_info.get_video_stream()
+    if video_stream is None or video_stream.width == 0 or video_stream.height == 0:
+        return duration * AUDIO_PIXELS_PER_SECOND
+
+    frame_rate = video_stream.frame_rate if video_stream.frame_rate > 0.0 else 25.0
+    return duration * frame_rate * video_stream.width * video_stream.height
+
+def estimate_savings(media_info:MediaInfo) -> float:
+    """
+    estimate the bytes saved by transcoding a media file from its source codec and bits per pixel
+    """
+    if media_info is None:
+        return 0.0
+
+    codec_name = media_info.get_video_codec() or media_info.get_audio_codec()
+    savings = media_info.size * SAVINGS_RATIO_BY_CODEC.get(codec_name, DEFAULT_SAVINGS_RATIO)
+
+    video_stream = media_info.get_video_stream()
+    pixels_per_second = estimate_encode_cost(media_info) / max(media_info.get_duration(), 0.001)
+    if video_stream is not None and media_info.bit_rate > 0 and pixels_per_second > AUDIO_PIXELS_PER_SECOND:
+        bits_per_pixel = media_info.bit_rate / pixels_per_second
+        savings *= min(1.0, bits_per_pixel / REFERENCE_BITS_PER_PIXEL)
+
+    return savings
+
+def get_video_bit_rate(media_info:MediaInfo) -> int:
+    """
+    return the bit rate of the first video stream or the overall bit rate without audio streams if unknown
+    """
+    video_stream = media_info.get_video_stream()
+    if video_stream is not None and video_stream.bit_rate > 0:
+        return video_stream.bit_rate
+    return max(media_info.bit_rate - sum(stream.bit_rate for stream in media_info.get_streams("audio")), 0)
+
+def triage_video(media_info:MediaInfo, video_stream:MediaStreamInfo, triage:dict) -> str:
+    """
+    classify the video stream of a media file with the triage thresholds of the output config.
+    returns why the video is already efficient or None if it should be transcoded
+    """
+    bit_rate = get_video_bit_rate(media_info)
+    if bit_rate == 0:
+        return None
+
+    frame_rate = video_stream.frame_rate if video_stream.frame_rate > 0.0 else 25.0
+    bits_per_pixel = bit_rate / (video_stream.width * video_stream.height * frame_rate)
+    if bits_per_pixel <= triage.get("efficient_bits_per_pixel", 0.0):
+        return "video uses %2.3f bits per pixel" % (bits_per_pixel)
+
+    # bit rate of the smallest listed height at least as high as the video
+    video_bit_rates = sorted((int(height), rate) for height, rate in triage.get("efficient_video_bit_rates", {}).items())
+    efficient_bit_rate = next((rate for height, rate in video_bit_rates if height >= video_stream.height), None)
+    if efficient_bit_rate is not None and bit_rate <= efficient_bit_rate:
+        return "%dp video bit rate is %d kb/s" % (video_stream.height, bit_rate // 1000)
+    return None
+
+def triage_media(media_info:MediaInfo, triage:dict) -> str:
+    """
+    classify a media file from its probe data with the triage thresholds of the output config.
+    returns why the file is already efficient or None if it should be transcoded
+    """
+    if media_info is None or not triage:
+        return None
+
+    codec_name = media_info.get_video_codec() or media_info.get_audio_codec()
+    if codec_name in triage.get("efficient_codecs", []):
+        return "source codec %s is already efficient" % (codec_name)
+
+    video_stream = media_info.get_video_stream()
+    if video_stream is not None and video_stream.width > 0 and video_stream.height > 0:
+        return triage_video(media_info, video_stream, triage)
+
+    audio_stream = media_info.get_audio_stream()
+    if audio_stream is not None:
+        bit_rate = audio_stream.bit_rate or media_info.bit_rate
+        if 0 < bit_rate <= triage.get("efficient_audio_bit_rate", 0):
+            return "audio bit rate is %d kb/s" % (bit_rate // 1000)
+
+    return None
+
+def job_order_key(order:str, job) -> tuple:
+    """
+    return the sort key of a probed job for an order. Ties are kept in walk order.
+    """
+    cost = estimate_encode_cost(job.media_info)
+    if order == "longest":
+        return (-cost, job.index)
+    if order == "shortest":
+        return (cost, job.index)
+    if order == "savings":
+        return (-estimate_savings(job.media_info) / max(cost, 1.0), job.index)
+    return (job.index,)
+
+#
+# pipeline classes
+#
+class PipelineStage:
+    """
+    pipeline stage processing jobs from a bounded queue with worker threads
+    """
+    def __init__(self, name:str, function, num_workers:int, queue_size:int):
+        self.name = name
+        self.function = function
+        self.num_workers = max(1, num_workers)
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.threads = []
+        self.max_depth = 0
+
+    def start(self):
+        """
+        start stage worker threads
+        """
+        for index in range(self.num_workers):
+            thread = threading.Thread(target=self.run, name="%s-%d" % (self.name, index), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, job:TranscodeJob):
+        """
+        queue a job, blocking while the queue is full
+        """
+        self.queue.put(job)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def get_depth(self) -> int:
+        """
+        return the number of jobs waiting in the stage queue
+        """
+        return self.queue.qsize()
+
+    def get_max_depth(self) -> int:
+        """
+        return the maximum number of jobs that waited in the stage queue
+        """
+        return self.max_depth
+
+    def close(self):
+        """
+        stop worker threads once queued jobs are processed
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+
+    def join(self):
+        """
+        wait for worker threads to stop
+        """
+        for thread in self.threads:
+            thread.join()
+
+    def run(self):
+        """
+        worker thread loop
+        """
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+
+            try:
+                self.function(job)
+            except Exception as error: # pylint: disable=broad-except
+                logging.exception("%s stage error on %s: %s", self.name, job.source_filename, error)
+                transcoder_results.exception("%s:%s" % (type(error), error))
+
+def fail_job(job:TranscodeJob, error:Exception):
+    """
+    record the error of a job in its file result so the job is reported as failed.
+    Jobs that are not encoded get a file result for their errors.
+    """
+    logging.error("%s failed: %s", job.source_filename, error)
+    if job.file_result is None:
+        job.file_result = TrancodeFileResult(job.source_filename)
+        transcoder_results.add_file_result(job.file_result)
+    job.file_result.exception("%s:%s" % (type(error), error))
+    transcoder_metrics.file_done(TranscoderMetrics.FAILED)
+
+def start_reporter(interval:float, function, stopped:threading.Event):
+    """
+    call function every interval seconds until stopped is set
+    """
+    if interval <= 0:
+        return
+
+    def report():
+        while not stopped.wait(interval):
+            function()
+
+    threading.Thread(target=report, name="reporter", daemon=True).start()
+
+def report_running_progress():
+    """
+    log progress of running jobs and of the whole run
+    """
+    running_progresses = transcoder_results.get_running_progresses()
+    if not running_progresses:
+        return
+
+    for path, progress in running_progresses:
+        logging.info("Progress %s %s", os.path.basename(path), progress.format())
+    logging.info("Progress total %s", transcoder_results.format_progress())
+
+class TranscodePipeline:
+    """
+    transcode pipeline: scan -> probe -> dispatch -> encode -> verify with a copy stage.
+    Stages run concurrently and are connected by bounded queues. jobs planned in a
+    manifest are executed instead of scanning the input directory if specified.
+    """
+    def __init__(self, transcode_args, copy_others:bool, jobs:list = None):
+        self.transcode_args = transcode_args
+        self.copy_others = copy_others
+        self.jobs = jobs
+
+        # dry run manifest
+        self.manifest : TranscodeManifest = None
+        self.output_main_codec = transcode_args.get_output_main_codec()
+        self.cache = transcode_args.get_cache()
+
+        num_jobs = transcode_args.get_jobs()
+        num_probe_jobs = transcode_args.get_probe_jobs()
+
+        self.probe_stage = PipelineStage("probe", self.probe, num_probe_jobs, num_probe_jobs * 2)
+        self.dispatch_stage = PipelineStage("dispatch", self.dispatch, 1, PROBE_QUEUE_SIZE)
+        self.encode_stage = PipelineStage("encode", self.encode, num_jobs, num_jobs)
+        self.verify_stage = PipelineStage("verify", self.verify, num_probe_jobs, num_jobs * 2)
+        self.copy_stage = PipelineStage("copy", self.copy, 1, PROBE_QUEUE_SIZE)
+        self.stages = [self.probe_stage, self.dispatch_stage, self.encode_stage, self.verify_stage, self.copy_stage]
+
+        # probed jobs are dispatched in walk order
+        self.reorder_lock = threading.Lock()
+        self.reorder_buffer = {}
+        self.next_index = 0
+        self.order = transcode_args.get_order()
+
+        # outputs being produced by encode and verify stages
+        self.outputs_condition = threading.Condition()
+        self.outputs = set()
+
+        # jobs are processed by the next stage in the calling thread until stages run
+        self.staged = False
+        self.stopped = threading.Event()
+
+    def get_queue_depths(self) -> dict:
+        """
+        return the number of jobs waiting in each stage queue
+        """
+        return {stage.name: stage.get_depth() for stage in self.stages}
+
+    def get_max_queue_depths(self) -> dict:
+        """
+        return the maximum number of jobs that waited in each stage queue
+        """
+        return {stage.name: stage.get_max_depth() for stage in self.stages}
+
+    def run(self):
+        """
+        run all stages until every job went through the pipeline
+        """
+        self.staged = True
+        for stage in self.stages:
+            stage.start()
+        transcoder_metrics.watch_pipeline_stages(self.stages)
+
+        start_reporter(self.transcode_args.get_pipeline_stats_interval(), self.report_queue_depths, self.stopped)
+        start_reporter(self.transcode_args.get_progress_interval(), report_running_progress, self.stopped)
+
+        try:
+            self.scan()
+
+            # stop stages once their producers are done
+            self.probe_stage.close()
+            self.probe_stage.join()
+            self.dispatch_in_order()
+            self.dispatch_stage.close()
+            self.dispatch_stage.join()
+            self.encode_stage.close()
+            self.encode_stage.join()
+            # low yield forecasts are copied by the encode stage
+            self.copy_stage.close()
+            self.verify_stage.close()
+            self.verify_stage.join()
+            self.copy_stage.join()
+        finally:
+            self.stopped.set()
+
+        logging.info("Pipeline max queue depths %s", self.get_max_queue_depths())
+
+    def run_job(self, job:TranscodeJob):
+        """
+        dispatch, encode and verify or copy a probed job in the calling thread without running stages
+        """
+        self.dispatch(job)
+
+    def forward(self, stage:PipelineStage, job:TranscodeJob):
+        """
+        queue a job to the next stage or process it in the calling thread if stages do not run
+        """
+        if self.staged is True:
+            stage.put(job)
+        else:
+            stage.function(job)
+
+    def dispatch_in_order(self):
+        """
+        dispatch jobs held until all jobs were probed sorted by the job order
+        """
+        with self.reorder_lock:
+            jobs = sorted(self.reorder_buffer.values(), key=lambda job: job_order_key(self.order, job))
+            self.reorder_buffer = {}
+
+        if jobs:
+            logging.info("Dispatching %d jobs in %s order", len(jobs), self.order)
+
+        for job in jobs:
+            self.dispatch_stage.put(job)
+
+    def report_queue_depths(self):
+        """
+        log stage queue depths to spot the pipeline bottleneck
+        """
+        logging.info("Pipeline queue depths %s", self.get_queue_depths())
+
+    def scan(self):
+        """
+        scan stage: walk the input directory and queue jobs for probing
+        """
+        jobs = self.jobs if self.jobs is not None else walk_jobs(self.transcode_args)
+        for index, job in enumerate(jobs):
+            job.index = index
+            self.probe_stage.put(job)
+
+    def probe(self, job:TranscodeJob):
+        """
+        probe stage: probe the job source and forward it to dispatch in walk order.
+        Jobs planned in a manifest are not probed again.
+        """
+        if job.action is None:
+            probe_job(job, self.transcode_args)
+
+        with self.reorder_lock:
+            self.reorder_buffer[job.index] = job
+
+            # other orders wait for all jobs to be probed
+            if self.order != "walk":
+                return
+
+            while self.next_index in self.reorder_buffer:
+                self.dispatch_stage.put(self.reorder_buffer.pop(self.next_index))
+                self.next_index += 1
+
+    def dispatch(self, job:TranscodeJob):
+        """
+        dispatch stage: decide what to do with each probed job: skip, copy, verify existing output or transcode.
+        On dry runs, decisions are added to the manifest instead.
+        """
+        transcoder_results.use_file_result(None)
+
+        # planned copies are not decided again
+        if job.action != TranscodeJob.COPY:
+            self.decide(job)
+
+        if self.manifest is not None:
+            self.manifest.add_job(job)
+            return
+
+        if job.action == TranscodeJob.SKIP:
+            return
+
+        if job.action == TranscodeJob.COPY:
+            self.forward(self.copy_stage, job)
+            return
+
+        # another input file may be producing the same output
+        self.wait_for_output(job.output_file)
+
+        if os.path.exists(job.output_file) is True:
+            job.action = TranscodeJob.EXISTS
+            self.forward(self.verify_stage, job)
+            return
+
+        if job.action != TranscodeJob.REMUX:
+            job.action = TranscodeJob.TRANSCODE
+        job.file_result = TrancodeFileResult(job.source_filename)
+        job.file_result.set_remuxed(job.action == TranscodeJob.REMUX)
+        job.file_result.set_progress(TranscodeProgress(job.media_info.get_duration() if job.media_info is not None else 0.0))
+        transcoder_results.add_file_result(job.file_result)
+
+        self.acquire_output(job.output_file)
+        record_job_state(self.transcode_args, job.output_file, job.source_filename, TranscoderJournal.QUEUED)
+        self.forward(self.encode_stage, job)
+
+    def decide(self, job:TranscodeJob):
+        """
+        set the job action from its source codec and its output file
+        """
+        source_filename = job.source_filename
+
+        # cached low yield forecast
+        if job.skip_decision is not None and "forecast_saving" in job.skip_decision:
+            logging.info("Skipping %s cached forecast saving %2.2f%% is out of range", job.name, job.skip_decision["forecast_saving"])
+            job.codec_name = job.skip_decision["codec_name"]
+            self.skip_low_yield(job)
+            return
+
+        if job.probe_error is not None:
+            job.action = TranscodeJob.SKIP
+            fail_job(job, job.probe_error)
+            return
+
+        codec_name = job.get_codec_name()
+        job.codec_name = codec_name
+
+        remux = False
+        encoded_streams = self.transcode_args.get_transcoder_encoder_args().get_encoded_streams(job.media_info)
+        if codec_name in self.output_main_codec and encoded_streams:
+            logging.debug("Copying %s codec \"%s\" streams and encoding %s", job.name, codec_name, ", ".join(stream.codec_name for stream in encoded_streams))
+        elif codec_name in self.output_main_codec and job.media_info is not None and use_remux(self.transcode_args, source_filename) is True:
+            logging.debug("Remuxing %s codec \"%s\" to %s", job.name, codec_name, self.transcode_args.get_container_ext())
+            remux = True
+        elif codec_name in self.output_main_codec:
+            job.action = TranscodeJob.COPY if self.copy_others is True else TranscodeJob.SKIP
+            transcoder_metrics.file_done(TranscoderMetrics.SKIPPED)
+
+            logging.debug("Skipping %s codec \"%s\"", job.name, codec_name)
+
+            if self.cache is not None and job.skip_decision is None and job.media_info is not None:
+                self.cache.put(TranscoderCache.SKIP, source_filename, job.source_key, dict(codec_name=codec_name, output_codec=self.output_main_codec))
+            return
+
+        # triage avoids video encodes
+        triage_reason = None
+        if remux is False and self.transcode_args.get_transcoder_encoder_args().is_video_copied(job.media_info) is False:
+            triage_reason = triage_media(job.media_info, self.transcode_args.get_triage())
+        if triage_reason is not None:
+            job.action = TranscodeJob.COPY if self.copy_others is True else TranscodeJob.SKIP
+            transcoder_results.get_transcoder_stats().add_triaged(estimate_encode_cost(job.media_info))
+            transcoder_metrics.file_done(TranscoderMetrics.TRIAGED)
+
+            logging.info("Skipping %s already efficient: %s", job.name, triage_reason)
+            return
+
+        output_filename, _ = os.path.splitext(source_filename)
+        output_filename += self.transcode_args.get_output_suffix() + self.transcode_args.get_container_ext()
+
+        job.output_file = os.path.join(job.output_dir, os.path.basename(output_filename))
+        if os.path.exists(job.output_file) is True:
+            job.action = TranscodeJob.EXISTS
+        else:
+            job.action = TranscodeJob.REMUX if remux is True else TranscodeJob.TRANSCODE
+
+    def encode(self, job:TranscodeJob):
+        """
+        encode stage: run ffmpeg and forward encoded jobs to verification
+        """
+        if self.claim_output(job) is False:
+            return
+
+        transcoder_results.use_file_result(job.file_result)
+
+        if job.action == TranscodeJob.REMUX:
+            with transcoder_results:
+                job.cmd = remux_file(job.source_filename, self.transcode_args, job.output_file, job.file_result.get_progress(), job.media_info)
+        elif self.check_forecast(job) is False:
+            if job.action == TranscodeJob.COPY:
+                self.forward(self.copy_stage, job)
+            return
+        else:
+            with transcoder_results:
+                job.cmd = encode_file(job.source_filename, self.transcode_args, job.output_file, job.file_result.get_progress(), job.media_info)
+
+        if job.cmd is not None:
+            self.forward(self.verify_stage, job)
+        else:
+            transcoder_metrics.file_done(TranscoderMetrics.FAILED)
+            self.release_output(job.output_file)
+
+    def claim_output(self, job:TranscodeJob) -> bool:
+        """
+        claim the job output in the shared queue when its encode starts so idle workers on other
+        hosts take the next jobs. return False if another worker encodes or encoded the output.
+        """
+        claims = self.transcode_args.get_claims()
+        if claims is None:
+            return True
+
+        claimed = claims.claim(job.output_file, job.source_filename)
+        if claimed is True and os.path.exists(job.output_file) is False:
+            return True
+
+        # the job is not encoded by this worker
+        transcoder_results.remove_file_result(job.file_result)
+        record_job_state(self.transcode_args, job.output_file, job.source_filename, TranscoderJournal.SKIPPED)
+        self.release_output(job.output_file)
+
+        if claimed is True:
+            # produced by another worker before it was claimed
+            job.action = TranscodeJob.EXISTS
+            self.forward(self.verify_stage, job)
+        else:
+            job.action = TranscodeJob.SKIP
+            transcoder_metrics.file_done(TranscoderMetrics.SKIPPED)
+        return False
+
+    def check_forecast(self, job:TranscodeJob) -> bool:
+        """
+        forecast the job output from encoded samples if enabled. return False if the forecast
+        saving is too low or beyond the percent tolerance: the job is skipped or copied instead.
+        """
+        if self.transcode_args.get_forecast() is False:
+            return True
+
+        with transcoder_results:
+            forecast = forecast_file(job.source_filename, self.transcode_args, job.output_file, job.media_info)
+            if forecast is None:
+                return True
+            job.file_result.set_forecast(forecast)
+
+            save_in_percent = forecast.get_save_in_percent()
+            if is_forecast_in_range(self.transcode_args, save_in_percent) is True:
+                return True
+
+            logging.info("Skipping %s forecast saving %2.2f%% of %s is out of range. Encode time saved: %s",
+                         job.name, save_in_percent, format_size(job.media_info.size), format_duration(forecast.get_encode_time()))
+
+            record_job_state(self.transcode_args, job.output_file, job.source_filename, TranscoderJournal.SKIPPED)
+            self.release_output(job.output_file)
+
+            # low yield files are counted apart from transcoded files
+            transcoder_results.remove_file_result(job.file_result)
+            transcoder_results.use_file_result(None)
+            job.file_result = None
+            transcoder_results.info("Skipping %s forecast saving %2.2f%% is out of range" % (job.source_filename, save_in_percent))
+            self.skip_low_yield(job)
+
+            # the decision is cached so later runs do not encode samples again
+            if self.cache is not None and job.source_key is not None:
+                self.cache.put(TranscoderCache.SKIP, job.source_filename, job.source_key, dict(codec_name=job.codec_name, output_codec=self.output_main_codec,
+                                                                                               forecast_saving=save_in_percent, forecast_args=get_forecast_args(self.transcode_args)))
+            return False
+
+        # forecast errors are recorded in the file result and the file is not transcoded
+        transcoder_metrics.file_done(TranscoderMetrics.FAILED)
+        self.release_output(job.output_file)
+        job.action = TranscodeJob.SKIP
+        return False
+
+    def skip_low_yield(self, job:TranscodeJob):
+        """
+        skip or copy a job whose forecast saving is out of range
+        """
+        job.action = TranscodeJob.COPY if self.copy_others is True else TranscodeJob.SKIP
+        transcoder_results.get_transcoder_stats().add_low_yield()
+        transcoder_metrics.file_done(TranscoderMetrics.LOW_YIELD)
+
+    def verify(self, job:TranscodeJob):
+        """
+        verify stage: compare encoded or existing outputs with their source
+        """
+        if job.action == TranscodeJob.EXISTS:
+            transcoder_results.use_file_result(None)
+
+            try:
+                transcoder_file_stats = compare_input_output(job, self.transcode_args)
+                logging.info("Skipping %s exists. %s", job.output_file, format_input_output(transcoder_file_stats))
+            except Exception as error: # pylint: disable=broad-except
+                fail_job(job, error)
+                return
+            transcoder_metrics.file_done(TranscoderMetrics.EXISTS)
+            return
+
+        transcoder_results.use_file_result(job.file_result)
+
+        try:
+            with transcoder_results:
+                verify_file(job, self.transcode_args)
+        finally:
+            self.release_output(job.output_file)
+
+        if job.file_result.status() is False:
+            transcoder_metrics.file_done(TranscoderMetrics.FAILED)
+        else:
+            transcoder_metrics.file_done(TranscoderMetrics.REMUXED if job.file_result.is_remuxed() else TranscoderMetrics.TRANSCODED)
+
+    def copy(self, job:TranscodeJob):
+        """
+        copy stage: copy skipped source files to the output directory
+        """
+        transcoder_results.use_file_result(None)
+
+        try:
+            dest_filename = os.path.join(job.output_dir, os.path.basename(job.source_filename))
+            if os.path.exists(dest_filename) is False:
+                self.transcode_args.make_output_dir(job.output_dir)
+                logging.info("Copying %s", dest_filename)
+                shutil.copyfile(job.source_filename, dest_filename)
+                transcoder_metrics.file_done(TranscoderMetrics.COPIED)
+        except Exception as error: # pylint: disable=broad-except
+            fail_job(job, error)
+
+    def acquire_output(self, output_file:str):
+        """
+        mark an output as being produced
+        """
+        with self.outputs_condition:
+            self.outputs.add(output_file)
+
+    def release_output(self, output_file:str):
+        """
+        mark an output as produced
+        """
+        with self.outputs_condition:
+            self.outputs.discard(output_file)
+            self.outputs_condition.notify_all()
+
+        claims = self.transcode_args.get_claims()
+        if claims is not None:
+            claims.release(output_file)
+
+    def wait_for_output(self, output_file:str):
+        """
+        wait until an output is no longer being produced
+        """
+        with self.outputs_condition:
+            while output_file in self.outputs:
+                self.outputs_condition.wait()
+
+def setup_logging(args):
+    """
+    setup logging. Add file & console logging handlers.
+    If we are using prometheus setup prometheus logging.
+    """
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+
+    # create formatter and add it to the handlers
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    # setup prometheus if specified
-    if args.use_prometheus is True:
+    # setup prometheus if specified
+    if args.use_prometheus is True:
+        try:
+            from prometheus_client import REGISTRY, Counter
+
+            log_entries = Counter(
+                'python_logging_messages_total',
+                'Count of log entries by logger and level.',
+                ['logger', 'level'], registry=REGISTRY)
+
+
+            class ExportingLogHandler(logging.Handler):
+                """A LogHandler that exports logging metrics for Prometheus.io."""
+                def emit(self, record):
+                    log_entries.labels(record.name, record.levelname).inc()
+
+
+            def export_stats_on_root_logger():
+                """Attaches an ExportingLogHandler to the root logger.
+                This should be sufficient to get metrics about all logging in a
+                Python application, unless a part of the application defines its
+                own logger and sets this logger's `propagate` attribute to
+                False. The `propagate` attribute is True by default, which means
+                that by default all loggers propagate all their logged messages to
+                the root logger.
+                """
+                logger.addHandler(ExportingLogHandler())
+
+
+            export_stats_on_root_logger()
+
+        except ImportError as error: # pragma: no cover
+            print("Error setting prometheus logging: %s" % (error))
+            sys.exit(1)
+
+    # setup prometheus metrics and exporter if specified
+    if args.use_prometheus is True or args.prometheus_port is not None:
+        try:
+            transcoder_metrics.enable()
+
+            if args.prometheus_port is not None:
+                transcoder_metrics.start_http_server(args.prometheus_port)
+
+        except ImportError as error: # pragma: no cover
+            print("Error setting prometheus metrics: %s" % (error))
+            sys.exit(1)
+
+    # end prometheus
+
+    # create file handler which logs even debug message
+    file_handler = logging.FileHandler(args.log_path)
+    file_handler.setLevel(logging.DEBUG)
+    # set formatter
+    file_handler.setFormatter(formatter)
+    # add handlers
+    logger.addHandler(file_handler)
+
+    # create console handler with a higher log level
+    if args.stdout_path is None and args.stderr_path is None:
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.INFO)
+        # set formatter
+        console_handler.setFormatter(formatter)
+        # set formatter
+        logger.addHandler(console_handler)
+
+def close_logging(args):
+    """
+    close logging. If prometheus is enabaled, dump the REGISTRY to file
+    """
+    if args.use_prometheus:
+        from prometheus_client import REGISTRY, write_to_textfile
+        write_to_textfile(args.prometheus_log_path, REGISTRY)
+
+def signal_handler(signal_number, _):
+    """
+    signal handler for the transcoder
+    """
+    logging.error("Interupted %d", signal_number)
+    transcoder_results.print_summary()
+
+    # SIGUSR1 is used in tests
+    if signal_number != signal.SIGUSR1:
+        sys.exit(1)
+
+def get_priority_tool_cmd(tool:str, tool_args:list) -> list:
+    """
+    return the command of a tool changing the priority of the command it runs.
+    The priority is not changed if the tool is not installed.
+    """
+    tool_path = shutil.which(tool)
+    if tool_path is None:
+        logging.warning("%s not found in path: ffmpeg priority is not changed", tool)
+        return []
+    return [tool_path] + tool_args
+
+def get_ffmpeg_priority_cmd(nice:int, ionice:str) -> list:
+    """
+    return the command running ffmpeg with a niceness adjustment and an io scheduling class if specified
+    """
+    priority_cmd = []
+    if nice != 0:
+        priority_cmd += get_priority_tool_cmd("nice", ["-n", str(nice)])
+    if ionice is not None:
+        priority_cmd += get_priority_tool_cmd("ionice", ["-c", IONICE_CLASSES[ionice]])
+    return priority_cmd
+
+def get_ffmpeg_resource_limits(max_memory:int, max_cpu_time:int) -> list:
+    """
+    return the resource limits of each ffmpeg process as (name, (soft, hard)) tuples.
+    max_memory is in MB and max_cpu_time in seconds, 0 to disable.
+    """
+    resource_limits = []
+    if max_memory > 0:
+        max_memory = max_memory * 1024 * 1024
+        resource_limits.append(("RLIMIT_AS", (max_memory, max_memory)))
+    if max_cpu_time > 0:
+        resource_limits.append(("RLIMIT_CPU", (max_cpu_time, max_cpu_time + RLIMIT_CPU_GRACE)))
+    return resource_limits
+
+def get_cpu_count() -> int:
+    """
+    return the number of cpus this process can run on.
+    Cpu affinity is not available on every platform.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def set_thread_affinity(cpus:list) -> set:
+    """
+    set the cpu affinity of the calling thread and return its previous affinity.
+    Nothing is done if cpus is None or if cpu affinity is not available.
+    """
+    if cpus is None or not hasattr(os, "sched_setaffinity"):
+        return None
+    thread_cpus = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    return thread_cpus
+
+def remove_file(output_file):
+    """
+    remove a file and ignore exception
+    """
+    transcoder_results.info("Removing %s" % (output_file))
+    try:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+    except IsADirectoryError as error:
+        logging.error("Cannot remove %s:%s", output_file, error)
+
+def get_partial_output_file(output_file:str) -> str:
+    """
+    return the hidden temporary file an output is written to until verified.
+    The extension is kept so ffmpeg picks the same container.
+    """
+    directory, name = os.path.split(output_file)
+    name, ext = os.path.splitext(name)
+    return os.path.join(directory, "." + name + PARTIAL_OUTPUT_SUFFIX + ext)
+
+def record_job_state(transcode_args, output_file:str, source_filename:str, state:str):
+    """
+    record a job state in the journal if enabled
+    """
+    journal = transcode_args.get_journal()
+    if journal is not None:
+        journal.record(output_file, source_filename, state)
+
+def commit_output_file(partial_output_file:str, output_file:str):
+    """
+    sync a verified partial output to disk and atomically rename it to its final name
+    """
+    with open(partial_output_file, "rb") as output:
+        os.fsync(output.fileno())
+    os.replace(partial_output_file, output_file)
+
+def discard_interrupted_outputs(transcode_args):
+    """
+    remove partial outputs left by jobs of an interrupted run. Those jobs are transcoded again.
+    """
+    journal = transcode_args.get_journal()
+    if journal is None:
+        return
+
+    claims = transcode_args.get_claims()
+    for entry in journal.get_unfinished():
+        # the job was reclaimed by a live worker on another host
+        if claims is not None and claims.is_claimed(entry["output_file"]) is True:
+            continue
+
+        partial_output_file = get_partial_output_file(entry["output_file"])
+        logging.info("Resuming interrupted job %s state: %s", entry["source_filename"], entry["state"])
+        if os.path.exists(partial_output_file):
+            remove_file(partial_output_file)
+
+def probe_media(path:str) -> MediaInfo:
+    """
+    probe all streams and format of a media file with a single ffprobe run
+    """
+    check_output_cmd = probe_media_cmd.copy()
+    check_output_cmd += [path]
+
+    start_time = time.monotonic()
+    results = subprocess.run(check_output_cmd, stdout=subprocess.PIPE, check=False)
+    transcoder_metrics.observe_probe(time.monotonic() - start_time)
+
+    if results.returncode != 0:
+        raise RuntimeError("Cannot run ffprobe on %s error: %d" % (path, results.returncode))
+
+    try:
+        probe = json.loads(results.stdout.decode('utf-8'))
+    except ValueError as error:
+        raise RuntimeError("Cannot parse ffprobe output on %s error: %s" % (path, error)) from error
+
+    return MediaInfo.from_ffprobe(path, probe)
+
+def try_probe_media(path:str) -> MediaInfo:
+    """
+    probe a media file and report errors in transcoder results instead of raising.
+    return None on error.
+    """
+    try:
+        return probe_media(path)
+    except RuntimeError as error:
+        transcoder_results.error(str(error))
+        logging.error("%s", error)
+    return None
+
+def has_media_magic(path:str) -> bool:
+    """
+    return True if a file starts with the magic bytes of a media container
+    """
+    try:
+        with open(path, "rb") as media_file:
+            header = media_file.read(MEDIA_MAGIC_SIZE)
+    except OSError:
+        return False
+
+    for offset, magic in MEDIA_MAGICS:
+        if header[offset:offset + len(magic)] == magic:
+            return True
+
+    # RIFF containers other than avi and wav are images or documents
+    if header[0:4] == b"RIFF" and header[8:12] in [b"AVI ", b"WAVE"]:
+        return True
+
+    # MPEG-TS packets start with a sync byte every 188 bytes
+    return len(header) > 376 and header[0] == 0x47 and header[188] == 0x47 and header[376] == 0x47
+
+def is_media_file(path:str, prefilter:dict) -> bool:
+    """
+    return True if a file may be a media file and should be probed.
+    Files with a media extension are probed, others only if they start with container magic bytes.
+    """
+    if prefilter.get("enabled", True) is False:
+        return True
+
+    _, ext = os.path.splitext(path)
+    if ext.lower() in prefilter.get("media_ext", []):
+        return True
+
+    return prefilter.get("magic", True) is True and has_media_magic(path)
+
+def fetch_media_info(path:str, cache:TranscoderCache = None, key:tuple = None) -> MediaInfo:
+    """
+    return media info of a media file giving its path or None if the file is not probed.
+    probe results are stored in cache if specified. key is the cache key of the file if already known.
+    Probe errors are not cached: they may be transient.
+    """
+    _, ext = os.path.splitext(path)
+    if ext in skip_ext:
+        return None
+
+    if cache is None:
+        return probe_media(path)
+
+    if key is None:
+        key = cache.file_key(path)
+    cached = cache.get(TranscoderCache.PROBE, path, key)
+    if cached is not None and cached.get("media_info") is not None:
+        return MediaInfo.from_dict(cached["media_info"])
+
+    media_info = probe_media(path)
+    cache.put(TranscoderCache.PROBE, path, key, dict(media_info=media_info.as_dict()))
+    return media_info
+
+def fetch_codec_name(path:str, media_info:MediaInfo = None) -> str:
+    """
+    return codec name of a media file giving its path.
+    media_info is probed if not specified.
+    """
+    if media_info is None:
+        media_info = fetch_media_info(path)
+
+    if media_info is None:
+        return ""
+
+    video_codec = media_info.get_video_codec()
+    audio_codec = media_info.get_audio_codec()
+
+    valid_video_codec = video_codec in VIDEO_CODECS
+    valid_audio_codec = audio_codec in AUDIO_CODECS
+
+    if not valid_audio_codec and not valid_audio_codec:
+        transcoder_results.error("Invalid codec video \"%s\" audio \"%s\" for %s" % (video_codec, audio_codec, path))
+        logging.error("Invalid video codec \"%s\" audio codec \"%s\" for %s", video_codec, audio_codec, path)
+        return ""
+
+    if valid_video_codec:
+        return video_codec
+
+    return audio_codec
+
+def fetch_duration_in_frames(path:str, media_info:MediaInfo = None) -> int:
+    """
+    fetch duration in frames (int) of a media file giving its path.
+    media_info is probed if not specified.
+    """
+    if media_info is None:
+        media_info = try_probe_media(path)
+        if media_info is None:
+            return 0
+
+    frame_duration = media_info.get_duration_in_frames()
+
+    if frame_duration == 0:
+        transcoder_results.error("ffprobe zero duuration for %s" % (path))
+        logging.error("ffprobe zero duuration for %s", path)
+
+    return frame_duration
+
+def format_size(num, suffix='B'):
+    """
+    format num bytes to a readable human format
+    """
+    for unit in ['','K','M','G','T','P','E','Z']:
+        if abs(num) < 1024.0:
+            return "%3.1f%s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, 'Y', suffix) # pragma: no cover
+
+def format_input_output(transcoder_file_stats: TranscoderFileStats):
+    """
+    format input and output size and stats for logging
+    """
+    input_fmt = format_size(transcoder_file_stats.get_input_file_size())
+    output_fmt = format_size(transcoder_file_stats.get_output_file_size())
+    saved_fmt = format_size(transcoder_file_stats.get_save_in_bytes())
+    total_saved_fmt = format_size(transcoder_results.get_transcoder_stats().get_total_saved())
+
+    return "Input Size: %s Output Size: %s Saved: %s %2.2f percent Total %s" % (input_fmt, output_fmt, saved_fmt, transcoder_file_stats.get_save_in_percent(), total_saved_fmt)
+
+
+def compare_input_output(job, transcode_args, output_file:str = None, output_media_info:MediaInfo = None):
+    """
+    compare the source media file of a job to its output media file and returns a tuple of comparison stats.
+    media infos are probed if not specified. Verified stats are cached and reused while
+    input and output files are unchanged. output_file is the file to compare if it is not yet
+    renamed to the job output file. The job output file is used to report and cache stats.
+    """
+    input_file = job.source_filename
+    input_codec_name = job.codec_name
+    input_media_info = job.media_info
+    final_output_file = job.output_file
+
+    if output_file is None:
+        output_file = final_output_file
+
+    cache = transcode_args.get_cache()
+    input_key = None
+    output_key = None
+    if cache is not None:
+        input_key = cache.file_key(input_file)
+        output_key = cache.file_key(output_file)
+        cached = cache.get(TranscoderCache.VERIFY, final_output_file, output_key)
+        if cached is not None and input_key is not None and tuple(cached["input_key"]) == input_key:
+            transcoder_file_stats = TranscoderFileStats.from_dict(cached["stats"])
+            transcoder_results.get_transcoder_stats().increment_total_saved(transcoder_file_stats.get_save_in_bytes())
+            return transcoder_file_stats
+
+    verified = True
+
+    input_duration = fetch_duration_in_frames(input_file, input_media_info)
+    output_duration = fetch_duration_in_frames(output_file, output_media_info)
+
+    input_name = os.path.basename(input_file)
+    output_name = os.path.basename(final_output_file)
+
+    duration_diff = abs(input_duration - output_duration)
+    if duration_diff > transcode_args.get_diff_tolerance_in_frames():
+        delta_in_frames = output_duration - input_duration
+        verified = False
+        transcoder_results.fail_on_tolerance("compare_input_output duration differs input: %s:%d frames output %s:%d frames out duration - in duration:%d frames" % (input_name, input_duration, output_name, output_duration, delta_in_frames))
+        logging.error("compare_input_output duration differs input: %s:%d frames output %s:%d frames out duration - in duration:%d frames",
+                        input_name, input_duration, output_name, output_duration, delta_in_frames )
+
+    input_file_size = 0
+    try:
+        input_file_size = os.path.getsize(input_file)
+    except FileNotFoundError:
+        pass
+
+    output_file_size = 0
+    try:
+        output_file_size = os.path.getsize(output_file)
+    except FileNotFoundError:
+        pass
+
+    transcoder_file_stats = TranscoderFileStats(input_file_size, output_file_size)
+    transcoder_results.get_transcoder_stats().increment_total_saved(transcoder_file_stats.get_save_in_bytes())
+
+    if transcoder_file_stats.get_save_in_percent() > transcode_args.get_percent_tolerance():
+        verified = False
+        transcoder_results.fail_on_tolerance("compare_input_output file size percent difference is too high: %2.2f for file %s  Input codec %s" % (transcoder_file_stats.get_save_in_percent(), output_name, input_codec_name))
+        logging.warning("compare_input_output file size percent difference is too high: %2.2f for file %s  Input codec %s",
+                        transcoder_file_stats.get_save_in_percent(), output_name, input_codec_name)
+
+    if cache is not None and verified is True:
+        cache.put(TranscoderCache.VERIFY, final_output_file, output_key, dict(input_path=input_file, input_key=input_key, stats=transcoder_file_stats.as_dict()))
+
+    return transcoder_file_stats
+
+class ProcessOutputSink:
+    """
+    stream a child process output line by line to a sink and keep a bounded tail in memory
+    """
+    def __init__(self, stream, sink, lock:threading.Lock, tail_size:int = FFMPEG_OUTPUT_TAIL_LINES, line_handler=None):
+        self.stream = stream
+        self.sink = sink
+        self.lock = lock
+        self.line_handler = line_handler
+        self.tail = collections.deque(maxlen=tail_size)
+        self.thread = threading.Thread(target=self.run, name="output-sink", daemon=True)
+
+    def start(self):
+        """
+        start streaming the output
+        """
+        self.thread.start()
+
+    def join(self):
+        """
+        wait until the output is closed
+        """
+        self.thread.join()
+
+    def run(self):
+        """
+        output streaming thread
+        """
+        for line in self.stream:
+            self.tail.append(line)
+
+            if self.line_handler is not None:
+                self.line_handler(line)
+
+            if self.sink is not None:
+                with self.lock:
+                    self.sink.write(line)
+
+    def get_tail(self) -> str:
+        """
+        return the last lines of output
+        """
+        return "".join(self.tail)
+
+def open_job_output(transcode_args, output_file:str, name:str):
+    """
+    open a per job ffmpeg output file if a ffmpeg log directory is specified, otherwise None
+    """
+    log_dir = transcode_args.get_ffmpeg_log_dir()
+    if log_dir is None:
+        return None
+
+    os.makedirs(log_dir, exist_ok=True)
+    log_path = os.path.join(log_dir, "%s.%s.log" % (os.path.basename(output_file), name))
+    return open(log_path, "w", encoding="utf-8")
+
+def run_ffmpeg(cmd:list, transcode_args, output_file:str, progress:TranscodeProgress = None, cpus:list = None) -> tuple:
+    """
+    run ffmpeg streaming its stderr to the transcoder sink or a per job log file.
+    If progress is specified, ffmpeg stdout is expected to be -progress output and parsed.
+    If cpus is specified, ffmpeg runs on these cpus only.
+    returns the return code and the tail of stderr.
+    """
+    job_stderr = open_job_output(transcode_args, output_file, "stderr")
+
+    try:
+        # ffmpeg inherits the cpu affinity of the thread starting it
+        thread_cpus = set_thread_affinity(cpus)
         try:
-            from prometheus_client import REGISTRY, Counter
+            process = subprocess.Popen(transcode_args.get_priority_cmd() + cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8", errors="replace")
+        finally:
+            set_thread_affinity(thread_cpus)
+
+        resource_limits = transcode_args.get_resource_limits()
+        if len(resource_limits) > 0:
+            # resource is only available on unix
+            import resource
+            for name, limits in resource_limits:
+                try:
+                    resource.prlimit(process.pid, getattr(resource, name), limits)
+                except (OSError, AttributeError) as error:
+                    logging.warning("Cannot limit ffmpeg resources: %s", error)
+
+        with process:
+            if progress is not None:
+                stdout_sink = ProcessOutputSink(process.stdout, None, None, line_handler=progress.parse_line)
+            else:
+                stdout_sink = ProcessOutputSink(process.stdout, transcode_args.stdout, transcode_args.output_lock)
+            stderr_sink = ProcessOutputSink(process.stderr, job_stderr or transcode_args.stderr, threading.Lock() if job_stderr else transcode_args.output_lock)
+
+            stdout_sink.start()
+            stderr_sink.start()
+            stdout_sink.join()
+            stderr_sink.join()
+
+            # reap ffmpeg with its resource usage to account its cpu time
+            # where wait4 is available, cpu time is not accounted otherwise
+            if hasattr(os, "wait4"):
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                if progress is not None:
+                    progress.add_cpu_time(usage.ru_utime + usage.ru_stime)
+            else:
+                process.wait()
+            returncode = process.returncode
+    finally:
+        if job_stderr is not None:
+            job_stderr.close()
 
-            log_entries = Counter(
-                'python_logging_messages_total',
-                'Count of log entries by logger and level.',
-                ['logger', 'level'], registry=REGISTRY)
+    return returncode, stderr_sink.get_tail()
 
+def get_segment_work_dir(output_file:str) -> str:
+    """
+    return the hidden directory where segments of an output are kept until concatenated
+    """
+    directory, name = os.path.split(output_file)
+    return os.path.join(directory, "." + name + SEGMENT_WORK_DIR_SUFFIX)
 
-            class ExportingLogHandler(logging.Handler):
-                """A LogHandler that exports logging metrics for Prometheus.io."""
-                def emit(self, record):
-                    log_entries.labels(record.name, record.levelname).inc()
+def use_segment_encode(transcode_args, media_info:MediaInfo) -> bool:
+    """
+    return True if a media file should be split in segments encoded in parallel
+    """
+    if transcode_args.get_segments() < 2 or media_info is None:
+        return False
+
+    if transcode_args.get_transcoder_encoder_args().custom_map is True:
+        logging.debug("Segment encoding disabled with custom stream mapping for %s", media_info.path)
+        return False
+
+    if transcode_args.get_transcoder_encoder_args().is_video_copied(media_info) is True:
+        return False
+
+    return len(media_info.get_streams("video")) == 1 and media_info.get_duration() >= transcode_args.get_segment_min_duration()
+
+def probe_video_packets(path:str) -> tuple:
+    """
+    return the start time of a media file, the presentation times in seconds of its
+    first video stream packets and the times of its key packets
+    """
+    check_output_cmd = probe_cmd + ["-select_streams", "v:0", "-show_entries", "packet=pts_time,flags:format=start_time", "-of", "json", path]
+
+    start_time = time.monotonic()
+    results = subprocess.run(check_output_cmd, stdout=subprocess.PIPE, check=False)
+    transcoder_metrics.observe_probe(time.monotonic() - start_time)
+
+    if results.returncode != 0:
+        raise RuntimeError("Cannot run ffprobe on %s error: %d" % (path, results.returncode))
+
+    try:
+        probe = json.loads(results.stdout.decode('utf-8'))
+    except ValueError as error:
+        raise RuntimeError("Cannot parse ffprobe output on %s error: %s" % (path, error)) from error
+
+    packet_times = []
+    keyframe_times = []
+    for packet in probe.get("packets", []):
+        if packet.get("pts_time") is None:
+            continue
+        pts_time = parse_float(packet["pts_time"])
+        packet_times.append(pts_time)
+        if "K" in packet.get("flags", ""):
+            keyframe_times.append(pts_time)
+
+    return parse_float(probe.get("format", {}).get("start_time")), sorted(packet_times), sorted(keyframe_times)
+
+def plan_segments(path:str, num_segments:int) -> list:
+    """
+    split a video in up to num_segments segments starting at keyframes.
+    returns a list of segment dicts with the seek time, number of frames and duration of each segment.
+    """
+    start_time, packet_times, keyframe_times = probe_video_packets(path)
+    if not packet_times:
+        raise RuntimeError("No video packets found in %s" % (path))
+
+    first_time = packet_times[0]
+    last_time = packet_times[-1]
+
+    # first segment starts at the beginning, others at the first keyframe after an even split
+    split_times = [first_time]
+    for i in range(1, num_segments):
+        target = first_time + (last_time - first_time) * i / num_segments
+        keyframe_time = next((t for t in keyframe_times if t >= target), None)
+        if keyframe_time is not None and keyframe_time > split_times[-1]:
+            split_times.append(keyframe_time)
+
+    frame_duration = (last_time - first_time) / max(len(packet_times) - 1, 1)
+
+    segments = []
+    for i, split_time in enumerate(split_times):
+        end_time = split_times[i + 1] if i + 1 < len(split_times) else last_time + frame_duration
+        frames = sum(1 for t in packet_times if split_time <= t < end_time)
+
+        # seek relative to the file start slightly before the keyframe so it is not dropped
+        seek = max(split_time - start_time - 0.001, 0.0) if i > 0 else None
+        segments.append(dict(seek=seek, frames=frames, duration=end_time - split_time))
+
+    return segments
+
+def prepare_segment_work_dir(source_filename:str, work_dir:str, plan:dict) -> bool:
+    """
+    create the segment work directory. Segments kept by an interrupted encode are
+    reused if they were planned for the same source and arguments. returns True if reused.
+    """
+    plan_path = os.path.join(work_dir, ".plan.json")
+
+    try:
+        with open(plan_path, "r", encoding="utf-8") as plan_file:
+            if json.load(plan_file) == plan:
+                return True
+    except (OSError, ValueError):
+        pass
+
+    if os.path.exists(work_dir):
+        logging.info("Discarding segments of %s planned with other arguments", source_filename)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    os.makedirs(work_dir, exist_ok=True)
+    with open(plan_path, "w", encoding="utf-8") as plan_file:
+        json.dump(plan, plan_file)
+    return False
+
+class TranscodeResourceError(RuntimeError):
+    """
+    ffmpeg was killed or failed for lack of memory or cpu time. threads is the thread budget
+    of the encode that failed.
+    """
+    def __init__(self, message:str, threads:int = 0):
+        super().__init__(message)
+        self.threads = threads
+
+def is_resource_failure(returncode:int, output_tail:str, transcode_args) -> bool:
+    """
+    return True if ffmpeg was killed or failed for lack of memory or cpu time rather than
+    because of a codec error. Crashes are resource failures when ffmpeg memory is limited.
+    """
+    # some signals do not exist on every platform
+    def signaled(names:list) -> bool:
+        return any(returncode == -getattr(signal, name) for name in names if hasattr(signal, name))
+
+    if signaled(["SIGKILL", "SIGXCPU"]) is True:
+        return True
+
+    memory_limited = any(name == "RLIMIT_AS" for name, _ in transcode_args.get_resource_limits())
+    if memory_limited is True and signaled(["SIGSEGV", "SIGBUS", "SIGABRT"]) is True:
+        return True
+
+    output_tail = output_tail.lower()
+    return any(error in output_tail for error in RESOURCE_ERRORS)
+
+def ffmpeg_error(cmd:list, returncode:int, output_tail:str, transcode_args) -> RuntimeError:
+    """
+    return the error to raise for a failed ffmpeg command
+    """
+    if is_resource_failure(returncode, output_tail, transcode_args) is True:
+        return TranscodeResourceError("transcode_file ffmpeg ran out of resources running %s returncode: %d" % (cmd, returncode))
+    return RuntimeError("transcode_file error running %s returncode: %d" % (cmd, returncode))
+
+def get_input_thread_args(threads:int) -> list:
+    """
+    return ffmpeg input args limiting decoder threads if threads is specified
+    """
+    return ["-threads", str(threads)] if threads > 0 else []
+
+def split_args(args:str) -> list:
+    """
+    split a ffmpeg argument string in a list of arguments
+    """
+    return list(filter(lambda a: a != '', args.strip().split(" ")))
+
+def encode_file(source_filename, transcode_args, output_file, progress:TranscodeProgress = None, media_info:MediaInfo = None) -> list:
+    """
+    run ffmpeg to encode a single media file to its partial output file and return the ffmpeg command.
+    Long videos are encoded in segments if enabled and media_info is specified.
+    Encodes that ran out of memory or cpu time are retried alone with half the threads.
+    The partial output is removed and a RuntimeError raised on error.
+    """
+    transcode_args.make_output_dir(os.path.dirname(output_file))
+
+    # a partial output left by an interrupted job is never resumed
+    partial_output_file = get_partial_output_file(output_file)
+    if os.path.exists(partial_output_file):
+        remove_file(partial_output_file)
+
+    if progress is None:
+        progress = TranscodeProgress(0.0)
+
+    # wait for system pressure to drop before starting ffmpeg
+    admission = transcode_args.get_admission()
+    if admission is not None:
+        admission.wait(os.path.basename(source_filename))
+
+    return TranscodeEncoder(source_filename, transcode_args, output_file, progress, media_info).encode()
+
+class TranscodeEncoder:
+    """
+    encode of a single media file to its partial output file, whole or in segments
+    """
+    def __init__(self, source_filename:str, transcode_args, output_file:str, progress:TranscodeProgress, media_info:MediaInfo = None):
+        self.source_filename = source_filename
+        self.transcode_args = transcode_args
+        self.output_file = output_file
+        self.progress = progress
+        self.media_info = media_info
+        self.segment_encode = use_segment_encode(transcode_args, media_info)
+
+    def encode(self) -> list:
+        """
+        run encode attempts until one succeeds and return its ffmpeg command.
+        Attempts that ran out of resources are retried alone with half the threads.
+        """
+        thread_budget = 0
+        retries = self.transcode_args.get_resource_retries()
+        for retry in range(retries + 1):
+            try:
+                return self.encode_attempt(thread_budget)
+            except TranscodeResourceError as error:
+                if retry == retries:
+                    raise
+                thread_budget = max(1, error.threads // 2)
+                self.progress.reset()
+
+                transcoder_results.warning("Retrying %s alone with %d threads: %s" % (self.source_filename, thread_budget, error))
+                logging.warning("Retrying %s alone with %d threads: %s", self.source_filename, thread_budget, error)
+
+        return None # pragma: no cover
+
+    def encode_attempt(self, thread_budget:int = 0) -> list:
+        """
+        run a single encode attempt. Encoder threads are limited to thread_budget if specified.
+        Retries with a thread budget run alone.
+        """
+        transcode_args = self.transcode_args
+        partial_output_file = get_partial_output_file(self.output_file)
+        exclusive = thread_budget > 0
+
+        record_job_state(transcode_args, self.output_file, self.source_filename, TranscoderJournal.RUNNING)
+
+        # pinned jobs run on the cpus of a slot with a matching thread budget
+        cpu_slots = transcode_args.get_cpu_slots()
+        cpus = cpu_slots.acquire() if cpu_slots is not None else None
+        threads = len(cpus) if cpus is not None else 0
+        if thread_budget > 0:
+            threads = min(threads, thread_budget) if threads > 0 else thread_budget
+
+        encode_gate = transcode_args.get_encode_gate()
+        encode_gate.acquire(exclusive)
+
+        encoder_args = split_args(transcode_args.get_encoder_args(threads, self.media_info))
+        cmd = [ffmpeg_path] + get_input_thread_args(threads) + ["-i", self.source_filename] + encoder_args + ffmpeg_progress_args + [partial_output_file]
+        if self.segment_encode is False:
+            transcoder_results.info("transcode_file running %s" % (cmd))
+            logging.info("transcode_file running %s", cmd)
+
+        self.progress.start()
+        transcoder_metrics.job_started()
+        try:
+            if self.segment_encode is True:
+                cmd = self.encode_segments(cpus, threads)
+                returncode = 0
+                output_tail = ""
+            else:
+                returncode, output_tail = run_ffmpeg(cmd, transcode_args, self.output_file, self.progress, cpus)
+        except TranscodeResourceError as error:
+            record_job_state(transcode_args, self.output_file, self.source_filename, TranscoderJournal.FAILED)
+            error.threads = threads if threads > 0 else get_cpu_count()
+            raise
+        except Exception:
+            record_job_state(transcode_args, self.output_file, self.source_filename, TranscoderJournal.FAILED)
+            raise
+        finally:
+            transcoder_metrics.job_finished()
+            self.progress.finish()
+            encode_gate.release(exclusive)
+            if cpu_slots is not None:
+                cpu_slots.release(cpus)
+
+        if returncode != 0:
+            logging.error("transcode_file error running %s returncode: %d output:\n%s", cmd, returncode, output_tail)
+            transcoder_results.error("transcode_file ffmpeg output:\n%s" % (output_tail))
+            remove_file(partial_output_file)
+            record_job_state(transcode_args, self.output_file, self.source_filename, TranscoderJournal.FAILED)
+            error = ffmpeg_error(cmd, returncode, output_tail, transcode_args)
+            if isinstance(error, TranscodeResourceError):
+                error.threads = threads if threads > 0 else get_cpu_count()
+            raise error
+
+        return cmd
+
+    def encode_segments(self, cpus:list = None, thread_budget:int = 0) -> list:
+        """
+        split a video at keyframes, encode its segments in parallel and concatenate them with
+        the audio and subtitle streams of the source in a single pass. Encoded segments are kept
+        until concatenated so an interrupted encode resumes from completed segments.
+        If cpus is specified, they are split among segments. If thread_budget is specified,
+        encoder threads are split among segments. returns the concatenation command.
+        """
+        source_filename = self.source_filename
+        transcode_args = self.transcode_args
+        num_segments = transcode_args.get_segments()
+        segments = plan_segments(source_filename, num_segments)
+        work_dir = get_segment_work_dir(self.output_file)
+
+        source_stat = os.stat(source_filename)
+        plan = dict(source_filename=source_filename, source_key=[source_stat.st_size, source_stat.st_mtime_ns],
+                    codec_args=transcode_args.get_transcoder_encoder_args().get_codec_args(), segments=segments)
+        if prepare_segment_work_dir(source_filename, work_dir, plan) is True:
+            logging.info("Resuming segments of %s from %s", source_filename, work_dir)
+
+        segment_files = []
+        threads = []
+        errors = []
+
+        file_result = transcoder_results.file_result
+
+        segment_cpus = TranscoderCpuSlots.split(cpus, len(segments)) if cpus is not None else [None] * len(segments)
+        segment_threads = max(1, thread_budget // len(segments)) if thread_budget > 0 else 0
+
+        def run_segment(segment_file, segment, segment_progress, cpus):
+            transcoder_results.use_file_result(file_result)
+            try:
+                self.encode_segment(segment_file, segment, segment_progress, cpus, segment_threads)
+            except Exception as error: # pylint: disable=broad-except
+                errors.append(error)
+
+        for i, segment in enumerate(segments):
+            segment_file = os.path.join(work_dir, ".segment-%03d.mkv" % (i))
+            segment_files.append(segment_file)
+            segment_progress = self.progress.add_segment(segment["duration"])
+
+            if os.path.exists(segment_file):
+                segment_progress.total_size = os.path.getsize(segment_file)
+                segment_progress.finish()
+                continue
+
+            thread = threading.Thread(target=run_segment, args=(segment_file, segment, segment_progress, segment_cpus[i]), name="segment-%d" % (i), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        return self.concat_segments(work_dir, segment_files, cpus)
+
+    def encode_segment(self, segment_file:str, segment:dict, progress:TranscodeProgress, cpus:list = None, threads:int = 0) -> list:
+        """
+        encode the video of a segment to segment_file. The segment is written to a temporary
+        file and renamed once complete so an interrupted segment is never reused.
+        Encoder threads are limited to threads if specified or to the number of cpus.
+        """
+        transcode_args = self.transcode_args
+        if threads == 0 and cpus is not None:
+            threads = len(cpus)
+        codec_args = split_args(transcode_args.get_transcoder_encoder_args().get_codec_args(threads))
+        segment_name, ext = os.path.splitext(segment_file)
+        partial_segment_file = segment_name + PARTIAL_OUTPUT_SUFFIX + ext
+
+        cmd = [ffmpeg_path] + get_input_thread_args(threads)
+        if segment["seek"] is not None:
+            cmd += ["-ss", "%.6f" % (segment["seek"])]
+        cmd += ["-i", self.source_filename, "-map", "0:v:0", "-an", "-sn", "-dn", "-map_metadata", "-1", "-map_chapters", "-1"]
+        cmd += codec_args + ["-frames:v", str(segment["frames"]), "-y"] + ffmpeg_progress_args + [partial_segment_file]
+        logging.info("transcode_file running segment %s", cmd)
+
+        progress.start()
+        try:
+            returncode, output_tail = run_ffmpeg(cmd, transcode_args, self.output_file + os.path.basename(segment_name), progress, cpus)
+        finally:
+            progress.finish()
+
+        if returncode != 0:
+            logging.error("transcode_file error running %s returncode: %d output:\n%s", cmd, returncode, output_tail)
+            remove_file(partial_segment_file)
+            raise ffmpeg_error(cmd, returncode, output_tail, transcode_args)
+
+        os.replace(partial_segment_file, segment_file)
+        return cmd
+
+    def concat_segments(self, work_dir:str, segment_files:list, cpus:list = None) -> list:
+        """
+        concatenate encoded video segments losslessly to the partial output file and
+        encode audio and subtitle streams from the source in the same pass.
+        With per stream copy, streams of the source media info already in an output codec are passed through.
+        """
+        transcode_args = self.transcode_args
+        concat_path = os.path.join(work_dir, ".concat.txt")
+        with open(concat_path, "w", encoding="utf-8") as concat_file:
+            for segment_file in segment_files:
+                concat_file.write("file '%s'\n" % (os.path.abspath(segment_file).replace("'", "'\\''")))
+
+        encoder_args = transcode_args.get_transcoder_encoder_args()
+        if encoder_args.map_all is True:
+            map_args = ["-map", "0:v", "-map", "1", "-map", "-1:v"]
+        else:
+            map_args = ["-map", "0:v", "-map", "1:a:0?"]
+        map_args += ["-map_metadata", "-1" if encoder_args.strip_metadata is True else "1", "-map_chapters", "1"]
+
+        codec_args = split_args(encoder_args.get_codec_args(len(cpus) if cpus is not None else 0))
+        if encoder_args.stream_copy is not None and self.media_info is not None:
+            codec_args += split_args(encoder_args.get_stream_copy_args(self.media_info))
+        partial_output_file = get_partial_output_file(self.output_file)
+
+        cmd = [ffmpeg_path, "-f", "concat", "-safe", "0", "-i", concat_path, "-i", self.source_filename] + map_args + codec_args + ["-c:v", "copy", partial_output_file]
+        transcoder_results.info("transcode_file running %s" % (cmd))
+        logging.info("transcode_file running %s", cmd)
+
+        returncode, output_tail = run_ffmpeg(cmd, transcode_args, self.output_file, cpus=cpus)
+        if returncode != 0:
+            logging.error("transcode_file error running %s returncode: %d output:\n%s", cmd, returncode, output_tail)
+            transcoder_results.error("transcode_file ffmpeg output:\n%s" % (output_tail))
+            remove_file(partial_output_file)
+            raise ffmpeg_error(cmd, returncode, output_tail, transcode_args)
+
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return cmd
+
+def use_remux(transcode_args, path:str) -> bool:
+    """
+    return True if a media file already in the output codec should be remuxed to the output container
+    """
+    return transcode_args.get_remux() is True and os.path.splitext(path)[1].lower() != transcode_args.get_container_ext().lower()
+
+def remux_file(source_filename, transcode_args, output_file, progress:TranscodeProgress = None, media_info:MediaInfo = None) -> list:
+    """
+    rewrite a media file already in the output codec to its partial output file in the output
+    container with stream copy and return the ffmpeg command. Text subtitles the container does
+    not support are converted. The partial output is removed and a RuntimeError raised on error.
+    """
+    transcode_args.make_output_dir(os.path.dirname(output_file))
+    partial_output_file = get_partial_output_file(output_file)
+
+    codec_args = ["-c", "copy"]
+    subtitle_codec = REMUX_SUBTITLE_CODECS.get(transcode_args.get_container_ext())
+    if media_info is not None and subtitle_codec is not None:
+        for index, stream in enumerate(media_info.get_streams("subtitle")):
+            if stream.codec_name == "mov_text":
+                codec_args += ["-c:s:%d" % (index), subtitle_codec]
+
+    encoder_args = transcode_args.get_transcoder_encoder_args()
+    cmd = [ffmpeg_path, "-i", source_filename] + split_args(encoder_args.map_args) + codec_args + ["-y"] + ffmpeg_progress_args + [partial_output_file]
+    transcoder_results.info("remux_file running %s" % (cmd))
+    logging.info("remux_file running %s", cmd)
+
+    record_job_state(transcode_args, output_file, source_filename, TranscoderJournal.RUNNING)
+
+    if progress is None:
+        progress = TranscodeProgress(0.0)
+
+    progress.start()
+    try:
+        returncode, output_tail = run_ffmpeg(cmd, transcode_args, output_file, progress)
+    except Exception:
+        record_job_state(transcode_args, output_file, source_filename, TranscoderJournal.FAILED)
+        raise
+    finally:
+        progress.finish()
+
+    if returncode != 0:
+        logging.error("remux_file error running %s returncode: %d output:\n%s", cmd, returncode, output_tail)
+        transcoder_results.error("remux_file ffmpeg output:\n%s" % (output_tail))
+        remove_file(partial_output_file)
+        record_job_state(transcode_args, output_file, source_filename, TranscoderJournal.FAILED)
+        raise RuntimeError("remux_file error running %s returncode: %d" % (cmd, returncode))
+
+    return cmd
+
+def run_probe_json(path:str, probe_args:list) -> dict:
+    """
+    run ffprobe with probe_args on a media file and return its json output
+    """
+    check_output_cmd = probe_cmd + probe_args + ["-of", "json", path]
+
+    start_time = time.monotonic()
+    results = subprocess.run(check_output_cmd, stdout=subprocess.PIPE, check=False)
+    transcoder_metrics.observe_probe(time.monotonic() - start_time)
+
+    if results.returncode != 0:
+        raise RuntimeError("Cannot run ffprobe on %s error: %d" % (path, results.returncode))
+
+    try:
+        return json.loads(results.stdout.decode('utf-8'))
+    except ValueError as error:
+        raise RuntimeError("Cannot parse ffprobe output on %s error: %s" % (path, error)) from error
+
+def probe_interval_size(path:str, start:float, duration:float) -> int:
+    """
+    return the size in bytes of the packets of all streams of a media file presented
+    between start and start + duration seconds from the file start
+    """
+    file_start_time = parse_float(run_probe_json(path, ["-show_entries", "format=start_time"]).get("format", {}).get("start_time"))
+
+    # intervals are absolute timestamps
+    interval = "%.6f%%%.6f" % (file_start_time + start, file_start_time + start + duration)
+    probe = run_probe_json(path, ["-read_intervals", interval, "-show_entries", "packet=pts_time,size"])
+
+    size = 0
+    for packet in probe.get("packets", []):
+        if packet.get("pts_time") is None:
+            continue
+        if start <= parse_float(packet["pts_time"]) - file_start_time < start + duration:
+            size += parse_int(packet.get("size"))
+    return size
+
+def is_forecast_in_range(transcode_args, save_in_percent:float) -> bool:
+    """
+    return True if a forecast saving is high enough and within the percent tolerance to transcode a file
+    """
+    return transcode_args.get_forecast_min_saving() <= save_in_percent <= transcode_args.get_percent_tolerance()
+
+def get_forecast_args(transcode_args) -> list:
+    """
+    return the encoder arguments and the samples a cached low yield forecast was made with
+    """
+    return [transcode_args.get_encoder_args(), transcode_args.get_forecast_samples(), transcode_args.get_forecast_sample_duration()]
+
+def forecast_file(source_filename, transcode_args, output_file, media_info:MediaInfo) -> TranscodeForecast:
+    """
+    encode short samples spread across a media file and extrapolate its output size and encode time.
+    Forecasts are cached with the encoder arguments. returns None if the file is too short to forecast.
+    """
+    if media_info is None:
+        return None
+
+    duration = media_info.get_duration()
+    samples = transcode_args.get_forecast_samples()
+    sample_duration = transcode_args.get_forecast_sample_duration()
+
+    # samples covering most of the file cost about as much as encoding it
+    if sample_duration <= 0.0 or samples * sample_duration * 2 > duration:
+        logging.debug("Not forecasting %s duration %2.2fs is too short for samples", source_filename, duration)
+        return None
+
+    cache = transcode_args.get_cache()
+    source_key = cache.file_key(source_filename) if cache is not None else None
+    encoder_args = transcode_args.get_encoder_args(0, media_info)
+    if cache is not None:
+        cached = cache.get(TranscoderCache.FORECAST, source_filename, source_key)
+        if cached is not None and cached["encoder_args"] == encoder_args and cached["samples"] == [samples, sample_duration]:
+            return TranscodeForecast.from_dict(cached["forecast"])
+
+    output_name, ext = os.path.splitext(output_file)
+    directory, name = os.path.split(output_name)
+    sample_file = os.path.join(directory, "." + name + FORECAST_SAMPLE_SUFFIX + ext)
+    transcode_args.make_output_dir(directory)
+
+    cpu_slots = transcode_args.get_cpu_slots()
+    cpus = cpu_slots.acquire() if cpu_slots is not None else None
+    threads = len(cpus) if cpus is not None else 0
+
+    forecast = TranscodeForecast(media_info.size, duration, samples, samples * sample_duration)
+    try:
+        for i in range(samples):
+            start = duration * (i + 0.5) / samples - sample_duration / 2
+
+            cmd = [ffmpeg_path] + get_input_thread_args(threads) + ["-ss", "%.6f" % (start), "-t", "%.6f" % (sample_duration), "-i", source_filename]
+            cmd += split_args(transcode_args.get_encoder_args(threads, media_info)) + ["-y", sample_file]
+            logging.debug("forecast_file running sample %s", cmd)
+
+            sample_start_time = time.monotonic()
+            returncode, output_tail = run_ffmpeg(cmd, transcode_args, output_file + ".forecast", None, cpus)
+            forecast.sample_encode_time += time.monotonic() - sample_start_time
 
+            if returncode != 0:
+                logging.error("forecast_file error running %s returncode: %d output:\n%s", cmd, returncode, output_tail)
+                raise RuntimeError("forecast_file error running %s returncode: %d" % (cmd, returncode))
 
-            def export_stats_on_root_logger():
-                """Attaches an ExportingLogHandler to the root logger.
-                This should be sufficient to get metrics about all logging in a
-                Python application, unless a part of the application defines its
-                own logger and sets this logger's `propagate` attribute to
-                False. The `propagate` attribute is True by default, which means
-                that by default all loggers propagate all their logged messages to
-                the root logger.
-                """
-                logger.addHandler(ExportingLogHandler())
+            forecast.input_sample_size += probe_interval_size(source_filename, start, sample_duration)
+            forecast.output_sample_size += probe_interval_size(sample_file, 0.0, sample_duration)
+    finally:
+        remove_file(sample_file)
+        if cpu_slots is not None:
+            cpu_slots.release(cpus)
 
+    logging.info("Forecast %s saving %2.2f%% output %s encode time %s", source_filename, forecast.get_save_in_percent(),
+                 format_size(forecast.get_output_file_size()), format_duration(forecast.get_encode_time()))
 
-            export_stats_on_root_logger()
+    if cache is not None:
+        cache.put(TranscoderCache.FORECAST, source_filename, source_key, dict(encoder_args=encoder_args, samples=[samples, sample_duration], forecast=forecast.as_dict()))
 
-        except ImportError as error: # pragma: no cover
-            print("Error setting prometheus logging: %s" % (error))
-            sys.exit(1)
+    return forecast
 
-    # end prometheus
+def verify_file(job, transcode_args):
+    """
+    verify the encoded partial output of a job against its source, set the file stats and rename it to the job output file.
+    The partial output is removed and a RuntimeError raised if it is unusable.
+    """
+    source_filename = job.source_filename
+    output_file = job.output_file
+    media_info = job.media_info
+    transcoder_file_result = job.file_result
+    cmd = job.cmd
+
+    partial_output_file = get_partial_output_file(output_file)
+    output_media_info = try_probe_media(partial_output_file)
+
+    if output_media_info is None or fetch_duration_in_frames(partial_output_file, output_media_info) == 0:
+        logging.error("transcode_file error running %s: zero duration for %s", cmd, output_file)
+        remove_file(partial_output_file)
+        record_job_state(transcode_args, output_file, source_filename, TranscoderJournal.FAILED)
+        raise RuntimeError("transcode_file error running %s: zero duration for %s" % (cmd, output_file))
+
+    transcoder_file_stats = compare_input_output(job, transcode_args, partial_output_file, output_media_info)
+    commit_output_file(partial_output_file, output_file)
+    record_job_state(transcode_args, output_file, source_filename, TranscoderJournal.VERIFIED)
+
+    transcoder_file_result.set_file_stats(transcoder_file_stats)
+
+    progress = transcoder_file_result.get_progress()
+    if transcoder_file_result.is_remuxed() is True:
+        transcoder_metrics.file_remuxed(transcoder_file_stats)
+    else:
+        transcoder_metrics.file_transcoded(transcode_args.get_output_main_codec(), transcoder_file_stats, progress)
+        if progress is not None and media_info is not None:
+            transcoder_results.get_transcoder_stats().add_encoded(estimate_encode_cost(media_info), progress.get_cpu_time())
 
-    # create file handler which logs even debug message
-    file_handler = logging.FileHandler(args.log_path)
-    file_handler.setLevel(logging.DEBUG)
-    # set formatter
-    file_handler.setFormatter(formatter)
-    # add handlers
-    logger.addHandler(file_handler)
+    job_stats_string = format_input_output(transcoder_file_stats)
 
-    # create console handler with a higher log level
-    if args.stdout_path is None and args.stderr_path is None:
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
-        # set formatter
-        console_handler.setFormatter(formatter)
-        # set formatter
-        logger.addHandler(console_handler)
+    if progress is not None:
+        job_stats_string += " Encode Time: %s Speed: %2.2fx" % (format_duration(progress.get_elapsed_time()), progress.duration / max(progress.get_elapsed_time(), 0.001))
 
-def close_logging(args):
+    job_name = "remux_file" if transcoder_file_result.is_remuxed() is True else "transcode_file"
+    transcoder_results.info("%s job done: %s %s" % (job_name, output_file, job_stats_string))
+    logging.info("%s job done: %s %s", job_name, output_file, job_stats_string)
+
+def transcode_file(source_filename, codec_name, transcode_args, output_file, remux:bool = False):
     """
-    close logging. If prometheus is enabaled, dump the REGISTRY to file
+    transcode a single media file.
+    If remux is True, the file is remuxed to the output container instead.
     """
-    if args.use_prometheus:
-        from prometheus_client import REGISTRY, write_to_textfile
-        write_to_textfile('transcode.prom', REGISTRY)
+    job = TranscodeJob(os.path.basename(source_filename), source_filename, os.path.dirname(output_file))
+    job.codec_name = codec_name
+    job.output_file = output_file
+    job.media_info = try_probe_media(source_filename)
 
-def signal_handler(signal_number, _):
+    # set current file result to transcoder results
+    job.file_result = TrancodeFileResult(source_filename)
+    transcoder_results.set_file_result(job.file_result)
+
+    duration = job.media_info.get_duration() if job.media_info is not None else 0.0
+    job.file_result.set_progress(TranscodeProgress(duration))
+
+    record_job_state(transcode_args, output_file, source_filename, TranscoderJournal.QUEUED)
+    job.file_result.set_remuxed(remux)
+
+    with transcoder_results:
+        if remux is True:
+            job.cmd = remux_file(source_filename, transcode_args, output_file, job.file_result.get_progress(), job.media_info)
+        else:
+            job.cmd = encode_file(source_filename, transcode_args, output_file, job.file_result.get_progress(), job.media_info)
+        verify_file(job, transcode_args)
+
+def scan_dir(path:str):
     """
-    signal handler for the transcoder
+    scan a directory bottom up in os.walk(topdown=False) order and yield the
+    directory and DirEntry of each file. Symbolic links to directories are not followed.
     """
-    logging.error("Interupted %d", signal_number)
-    transcoder_results.print_summary()
+    try:
+        with os.scandir(path) as scan_entries:
+            entries = list(scan_entries)
+    except OSError as error:
+        logging.warning("Cannot scan %s:%s", path, error)
+        return
 
-    # SIGUSR1 is used in tests
-    if signal_number != signal.SIGUSR1:
-        sys.exit(1)
+    files = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
 
-def remove_file(output_file):
+        if is_dir is False:
+            files.append(entry)
+        elif entry.is_symlink() is False:
+            yield from scan_dir(entry.path)
+
+    for entry in files:
+        yield path, entry
+
+def walk_jobs(transcode_args):
     """
-    remove a file and ignore exception
+    walk into the input directory and yield a transcode job for each non hidden file
     """
-    transcoder_results.info("Removing %s" % (output_file))
-    try:
-        if os.path.exists(output_file):
-            os.remove(output_file)
-    except IsADirectoryError as error:
-        logging.error("Cannot remove %s:%s", output_file, error)
+    input_dir = transcode_args.get_input_dir()
+
+    # output directory of the directory being scanned
+    root_path = None
+    output_dir = None
+
+    for root, entry in scan_dir(input_dir):
+        # skip hidden files
+        if entry.name.startswith("."):
+            continue
 
-def fetch_codec_name_with_fprobe(path:str, args:list) -> str:
+        if root != root_path:
+            root_path = root
+            output_dir = transcode_args.get_output_dir(input_dir, root)
+
+        job = TranscodeJob(entry.name, entry.path.replace("./",""), output_dir)
+        job.dir_entry = entry
+        yield job
+
+def use_skip_decision(transcode_args, source_filename:str, skip_decision:dict) -> bool:
     """
-    fetch codec name using fprobe argument list
+    return True if a cached skip decision applies to the current options. Skip decisions of
+    the main codec do not apply to per stream copy or remuxes. Low yield forecasts only apply
+    while forecasts are enabled with the same arguments and their saving is still out of range.
     """
-    check_output_cmd = args.copy()
-    check_output_cmd += [path]
+    if skip_decision["output_codec"] != transcode_args.get_output_main_codec():
+        return False
 
-    results = subprocess.run(check_output_cmd, stdout=subprocess.PIPE, check=False)
-    if results.returncode != 0:
-        raise RuntimeError("Cannot run ffprobe on %s error: %d" % (path, results.returncode))
-    codec = results.stdout.decode('utf-8').replace("\n","")
+    if "forecast_saving" in skip_decision:
+        if transcode_args.get_forecast() is False or skip_decision["forecast_args"] != get_forecast_args(transcode_args):
+            return False
+        return is_forecast_in_range(transcode_args, skip_decision["forecast_saving"]) is False
 
-    return codec
+    return transcode_args.get_transcoder_encoder_args().stream_copy is None and use_remux(transcode_args, source_filename) is False
 
-def fetch_codec_name(path):
+def probe_job(job, transcode_args):
     """
-    return codec name of a media file giving its path
+    probe the source of a transcode job using cached skip decisions and probe results.
+    It runs in probe threads: errors are kept in the job and reported by the caller.
     """
-    _, ext = os.path.splitext(path)
-    if ext in skip_ext:
-        return ""
+    cache = transcode_args.get_cache()
+    try:
+        # files that are clearly not media are never probed
+        if is_media_file(job.source_filename, transcode_args.get_prefilter()) is False:
+            logging.debug("Skipping %s not a media file", job.source_filename)
+            return job
+
+        if cache is not None:
+            job.source_key = cache.file_key(job.source_filename, job.get_stat())
+            skip_decision = cache.get(TranscoderCache.SKIP, job.source_filename, job.source_key)
+            if skip_decision is not None and use_skip_decision(transcode_args, job.source_filename, skip_decision) is True:
+                job.skip_decision = skip_decision
+                return job
+
+        job.media_info = fetch_media_info(job.source_filename, cache, job.source_key)
+    except Exception as error: # pylint: disable=broad-except
+        job.probe_error = error
+    return job
 
-    video_codec = fetch_codec_name_with_fprobe(path, probe_video_codec_cmd)
-    audio_codec = fetch_codec_name_with_fprobe(path, probe_audio_codec_cmd)
+#
+# watch mode
+#
+class InputDirWatcher:
+    """
+    watch the input directory hierarchy with linux inotify and yield a transcode job for
+    each file created or moved in once it stopped growing. Hidden files and directories are ignored.
+    """
+    # inotify event masks
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    # struct inotify_event header: wd, mask, cookie, len followed by the name
+    EVENT_HEADER = struct.Struct("iIII")
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, transcode_args):
+        self.transcode_args = transcode_args
+        self.input_dir = transcode_args.get_input_dir()
+        self.settle_time = transcode_args.get_watch_settle_time()
+        self.libc = None
+        self.fd = -1
+
+        # watched directory of each watch descriptor
+        self.watches = {}
+
+        # files waiting to stop growing: path -> (deadline, (size, mtime))
+        self.pending = {}
+
+    def open(self):
+        """
+        create the inotify instance and watch the input directory hierarchy
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            inotify_init1 = libc.inotify_init1
+        except (OSError, AttributeError) as error:
+            raise RuntimeError("--watch requires linux inotify: %s" % (error)) from error
 
-    valid_video_codec = video_codec in VIDEO_CODECS
-    valid_audio_codec = audio_codec in AUDIO_CODECS
+        self.fd = inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_init1: %s" % (os.strerror(errno)))
 
-    if not valid_audio_codec and not valid_audio_codec:
-        transcoder_results.error("Invalid codec video \"%s\" audio \"%s\" for %s" % (video_codec, audio_codec, path))
-        logging.error("Invalid video codec \"%s\" audio codec \"%s\" for %s", video_codec, audio_codec, path)
-        return ""
+        self.libc = libc
+        self.add_watches(self.input_dir)
+        logging.info("Watching %d directories in %s", len(self.watches), self.input_dir)
 
-    if valid_video_codec:
-        return video_codec
+    def close(self):
+        """
+        close the inotify instance
+        """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.watches = {}
 
-    return audio_codec
+    def add_watches(self, path:str) -> list:
+        """
+        watch a directory and its non hidden sub directories. return files found in them:
+        they may have been written before their directory was watched.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            logging.warning("Cannot watch %s:%s", path, os.strerror(ctypes.get_errno()))
+            return []
+        self.watches[wd] = path
 
-def fetch_duration_in_frames(path):
-    """
-    fetch duration in frames (int) of a media file giving its path
-    """
-    check_output_cmd = probe_duration_cmd.copy()
-    check_output_cmd += [path]
+        try:
+            with os.scandir(path) as scan_entries:
+                entries = list(scan_entries)
+        except OSError as error:
+            logging.warning("Cannot scan %s:%s", path, error)
+            return []
+
+        files = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                is_dir = False
 
-    results = subprocess.run(check_output_cmd, stdout=subprocess.PIPE, check=False)
-    if results.returncode != 0:
-        transcoder_results.error("Cannot run ffprobe on %s error: %d" % (path, results.returncode))
-        logging.error("Cannot run ffprobe on %s error: %d", path, results.returncode)
-        return 0
+            if is_dir is True:
+                files += self.add_watches(entry.path)
+            else:
+                files.append(entry.path)
+        return files
+
+    @staticmethod
+    def get_file_key(path:str) -> tuple:
+        """
+        return the size and modification time of a regular file or None
+        """
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return None
+        if stat.S_ISREG(stat_result.st_mode) is False:
+            return None
+        return (stat_result.st_size, stat_result.st_mtime_ns)
+
+    def set_pending(self, path:str):
+        """
+        wait for a file to stop growing
+        """
+        self.pending[path] = (time.monotonic() + self.settle_time, self.get_file_key(path))
 
-    duration = results.stdout.decode('utf-8').replace("\n","")
+    def pop_settled(self) -> list:
+        """
+        return files that did not change during the settle time. Removed files are forgotten.
+        """
+        now = time.monotonic()
+        settled = []
+        for path, (deadline, key) in list(self.pending.items()):
+            if deadline > now:
+                continue
 
-    frame_duration = 0.0
-    try:
-        frame_duration = math.ceil(float(duration))
-    except ValueError:
-        pass
+            current_key = self.get_file_key(path)
+            if current_key is None:
+                del self.pending[path]
+            elif current_key != key:
+                self.pending[path] = (now + self.settle_time, current_key)
+            else:
+                del self.pending[path]
+                settled.append(path)
+        return sorted(settled)
 
-    if int(frame_duration) == 0:
-        transcoder_results.error("ffprobe zero duuration for %s" % (path))
-        logging.error("ffprobe zero duuration for %s", path)
+    def read_events(self):
+        """
+        read inotify events and update pending files
+        """
+        data = os.read(self.fd, self.READ_SIZE)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            self.handle_event(wd, mask, name)
+
+    def handle_event(self, wd:int, mask:int, name:str):
+        """
+        handle a single inotify event
+        """
+        if mask & self.IN_Q_OVERFLOW:
+            logging.warning("Watch events lost, rescanning %s", self.input_dir)
+            for path in self.add_watches(self.input_dir):
+                self.set_pending(path)
+            return
+
+        if mask & self.IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+
+        directory = self.watches.get(wd)
+        if directory is None or not name or name.startswith("."):
+            return
+
+        path = os.path.join(directory, name)
+        if mask & self.IN_ISDIR:
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                for file_path in self.add_watches(path):
+                    self.set_pending(file_path)
+            return
+
+        # existing files modified in place are not transcoded again
+        if mask & self.IN_MODIFY and path not in self.pending:
+            return
+
+        self.set_pending(path)
+
+    def get_timeout(self, end_time:float) -> float:
+        """
+        return time to wait for events until the next pending file or the end of the watch.
+        None waits until an event is received.
+        """
+        deadlines = [deadline for deadline, _ in self.pending.values()]
+        if end_time is not None:
+            deadlines.append(end_time)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def watch_jobs(self):
+        """
+        yield a transcode job for each new file until the watch duration elapsed
+        """
+        duration = self.transcode_args.get_watch_duration()
+        end_time = time.monotonic() + duration if duration > 0 else None
 
-    return int(frame_duration)
+        while end_time is None or time.monotonic() < end_time:
+            readable, _, _ = select.select([self.fd], [], [], self.get_timeout(end_time))
+            if readable:
+                self.read_events()
 
-def format_size(num, suffix='B'):
+            for path in self.pop_settled():
+                logging.info("New file %s", path)
+                output_dir = self.transcode_args.get_output_dir(self.input_dir, os.path.dirname(path))
+                yield TranscodeJob(os.path.basename(path), path.replace("./",""), output_dir)
+
+def watch(transcode_args, copy_others):
     """
-    format num bytes to a readable human format
+    watch the input directory and transcode new files as they arrive
     """
-    for unit in ['','K','M','G','T','P','E','Z']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Y', suffix) # pragma: no cover
+    watcher = InputDirWatcher(transcode_args)
+    watcher.open()
+    try:
+        discard_interrupted_outputs(transcode_args)
+        TranscodePipeline(transcode_args, copy_others, watcher.watch_jobs()).run()
+    finally:
+        watcher.close()
 
-def format_input_output(transcoder_file_stats: TranscoderFileStats):
+#
+# job server
+#
+class TranscodeServer:
     """
-    format input and output size and stats for logging
+    job server: clients submit directories or files over http and query job states while
+    workers pull jobs and report their progress and results. Jobs of workers that stopped
+    reporting for the lease time are queued again.
     """
-    input_fmt = format_size(transcoder_file_stats.get_input_file_size())
-    output_fmt = format_size(transcoder_file_stats.get_output_file_size())
-    saved_fmt = format_size(transcoder_file_stats.get_save_in_bytes())
-    total_saved_fmt = format_size(transcoder_results.get_transcoder_stats().get_total_saved())
+    # job states
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
 
-    return "Input Size: %s Output Size: %s Saved: %s %2.2f percent Total %s" % (input_fmt, output_fmt, saved_fmt, transcoder_file_stats.get_save_in_percent(), total_saved_fmt)
+    def __init__(self, transcode_args):
+        self.transcode_args = transcode_args
+        self.lease_time = transcode_args.get_lease_time()
 
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.queue = collections.deque()
+        self.running = set()
+        self.next_id = 1
 
-def compare_input_output(input_file, output_file, input_codec_name, transcode_args):
-    """
-    compare an input media file to its output media file and returns a tuple of comparison stats
-    """
+        self.http_server : http.server.ThreadingHTTPServer = None
 
-    input_duration = fetch_duration_in_frames(input_file)
-    output_duration = fetch_duration_in_frames(output_file)
+    def start(self, host:str, port:int):
+        """
+        serve the job api over http on host and port from a background thread
+        """
+        self.http_server = http.server.ThreadingHTTPServer((host, port), TranscodeRequestHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.transcode_server = self
+        threading.Thread(target=self.http_server.serve_forever, name="job-server", daemon=True).start()
+        logging.info("Job server listening on %s:%d", host, self.http_server.server_address[1])
 
-    input_name = os.path.basename(input_file)
-    output_name = os.path.basename(output_file)
+    def close(self):
+        """
+        stop serving
+        """
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
 
-    duration_diff = abs(input_duration - output_duration)
-    if duration_diff > transcode_args.get_diff_tolerance_in_frames():
-        delta_in_frames = output_duration - input_duration
-        transcoder_results.fail_on_tolerance("compare_input_output duration differs input: %s:%d frames output %s:%d frames out duration - in duration:%d frames" % (input_name, input_duration, output_name, output_duration, delta_in_frames))
-        logging.error("compare_input_output duration differs input: %s:%d frames output %s:%d frames out duration - in duration:%d frames",
-                        input_name, input_duration, output_name, output_duration, delta_in_frames )
+    def submit(self, path:str) -> list:
+        """
+        queue a job for a file or for each non hidden file of a directory. return job ids.
+        """
+        # workers may not share the server working directory
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            input_dir = path
+            sources = [(root, entry.path) for root, entry in scan_dir(path) if not entry.name.startswith(".")]
+        elif os.path.isfile(path):
+            input_dir = os.path.dirname(path)
+            sources = [(input_dir, path)]
+        else:
+            raise ValueError("%s is not a file or a directory" % (path))
+
+        job_ids = []
+        with self.lock:
+            for root, source_filename in sources:
+                job = dict(id=self.next_id,
+                           source_filename=source_filename,
+                           output_dir=self.transcode_args.get_output_dir(input_dir, root),
+                           state=TranscodeServer.QUEUED,
+                           worker=None,
+                           action=None,
+                           output_file=None,
+                           progress=None,
+                           file_stats=None,
+                           errors=[],
+                           submit_time=time.time(),
+                           update_time=time.time())
+                self.jobs[job["id"]] = job
+                self.queue.append(job["id"])
+                job_ids.append(job["id"])
+                self.next_id += 1
+
+        logging.info("Job server queued %d jobs from %s", len(job_ids), path)
+        return job_ids
+
+    def get_job(self, job_id:int) -> dict:
+        """
+        return a job state. Raise KeyError if it does not exist.
+        """
+        with self.lock:
+            return dict(self.jobs[job_id])
 
-    input_file_size = 0
-    try:
-        input_file_size = os.path.getsize(input_file)
-    except FileNotFoundError:
-        pass
+    def get_jobs(self) -> dict:
+        """
+        return all job states with the number of jobs in each state and the total saved bytes
+        """
+        with self.lock:
+            jobs = [dict(job) for job in self.jobs.values()]
 
-    output_file_size = 0
-    try:
-        output_file_size = os.path.getsize(output_file)
-    except FileNotFoundError:
-        pass
+        counts = collections.Counter(job["state"] for job in jobs)
+        total_saved = sum(job["file_stats"]["input_file_size"] - job["file_stats"]["output_file_size"] for job in jobs if job["file_stats"] is not None)
+        return dict(jobs=jobs, counts=dict(counts), total_saved=total_saved)
 
-    transcoder_file_stats = TranscoderFileStats(input_file_size, output_file_size)
-    transcoder_results.get_transcoder_stats().increment_total_saved(transcoder_file_stats.get_save_in_bytes())
+    def next_job(self, worker:str) -> dict:
+        """
+        assign the next queued job to a worker or return None if no job is queued
+        """
+        with self.lock:
+            self.requeue_expired()
 
-    if transcoder_file_stats.get_save_in_percent() > transcode_args.get_percent_tolerance():
-        transcoder_results.fail_on_tolerance("compare_input_output file size percent difference is too high: %2.2f for file %s  Input codec %s" % (transcoder_file_stats.get_save_in_percent(), os.path.basename(output_file), input_codec_name))
-        logging.warning("compare_input_output file size percent difference is too high: %2.2f for file %s  Input codec %s",
-                        transcoder_file_stats.get_save_in_percent(), os.path.basename(output_file), input_codec_name)
+            while self.queue:
+                job = self.jobs[self.queue.popleft()]
+                if job["state"] != TranscodeServer.QUEUED:
+                    continue
 
-    return transcoder_file_stats
+                job.update(state=TranscodeServer.RUNNING, worker=worker, update_time=time.time())
+                self.running.add(job["id"])
+                return dict(job)
+        return None
+
+    def requeue_expired(self):
+        """
+        queue again jobs of workers that did not report for the lease time. Lock must be held.
+        """
+        now = time.time()
+        for job_id in list(self.running):
+            job = self.jobs[job_id]
+            if now - job["update_time"] > self.lease_time:
+                logging.warning("Job server requeuing %s: worker %s lease expired", job["source_filename"], job["worker"])
+                job.update(state=TranscodeServer.QUEUED, worker=None, progress=None)
+                self.running.discard(job_id)
+                self.queue.appendleft(job_id)
+
+    def update_job(self, job_id:int, report:dict, finished:bool) -> tuple:
+        """
+        update a running job from a worker report. return the http status code and the job.
+        """
+        with self.lock:
+            job = self.jobs[job_id]
+            if job["state"] != TranscodeServer.RUNNING or job["worker"] != report.get("worker"):
+                return 409, dict(error="job %d is not assigned to %s" % (job_id, report.get("worker")))
+
+            job.update(action=report.get("action"),
+                       output_file=report.get("output_file"),
+                       progress=report.get("progress"),
+                       file_stats=report.get("file_stats"),
+                       errors=report.get("errors", []),
+                       update_time=time.time())
+
+            if finished is True:
+                job["state"] = TranscodeServer.DONE if report.get("status") is True else TranscodeServer.FAILED
+                self.running.discard(job_id)
+                logging.info("Job server %s %s by %s", job["state"], job["source_filename"], job["worker"])
+            return 200, dict(job)
+
+    def route(self, method:str, parts:list, body:dict) -> tuple:
+        """
+        handle an api request. return the http status code and the response body.
 
-def transcode_file(source_filename, codec_name, transcode_args, output_file):
+        POST /jobs {"path": path}: submit a file or a directory
+        GET /jobs: all jobs, GET /jobs/<id>: a single job
+        POST /jobs/next {"worker": name}: pull the next job
+        POST /jobs/<id>/progress and POST /jobs/<id>/result: worker reports
+        """
+        if parts == ["jobs"] and method == "GET":
+            return 200, self.get_jobs()
+        if parts == ["jobs"] and method == "POST":
+            return 201, dict(jobs=self.submit(body["path"]))
+        if parts == ["jobs", "next"] and method == "POST":
+            job = self.next_job(body["worker"])
+            return (200, job) if job is not None else (204, None)
+        if len(parts) == 2 and parts[0] == "jobs" and method == "GET":
+            return 200, self.get_job(int(parts[1]))
+        if len(parts) == 3 and parts[0] == "jobs" and parts[2] in ["progress", "result"] and method == "POST":
+            return self.update_job(int(parts[1]), body, parts[2] == "result")
+        return 404, dict(error="unknown request %s %s" % (method, "/".join(parts)))
+
+class TranscodeRequestHandler(http.server.BaseHTTPRequestHandler):
     """
-    transcode a single media file
+    http request handler of the job server json api
     """
+    server_version = "tabarnak"
 
-    # set current file result to transcoder results
-    transcoder_file_result = TrancodeFileResult(source_filename)
-    transcoder_results.set_file_result(transcoder_file_result)
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        logging.debug("Job server %s %s", self.address_string(), format % args)
 
-    with transcoder_results:
-        encoder_args =  transcode_args.get_encoder_args().strip().split(" ")
-        encoder_args = list(filter(lambda a: a != '', encoder_args))
+    def do_GET(self): # pylint: disable=invalid-name
+        """
+        handle GET requests
+        """
+        self.handle_api("GET")
 
-        cmd = [ffmpeg_path, "-i", source_filename] + encoder_args + [output_file]
-        transcoder_results.info("transcode_file running %s" % (cmd))
-        logging.info("transcode_file running %s", cmd)
+    def do_POST(self): # pylint: disable=invalid-name
+        """
+        handle POST requests
+        """
+        self.handle_api("POST")
+
+    def handle_api(self, method:str):
+        """
+        decode the json request, route it to the job server and encode its json response
+        """
+        parts = [part for part in urllib.parse.urlparse(self.path).path.split("/") if part]
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length).decode("utf-8")) if length > 0 else {}
+            if not isinstance(body, dict):
+                raise ValueError("request body must be a json object")
+            code, response = self.server.transcode_server.route(method, parts, body)
+        except KeyError as error:
+            code, response = 404, dict(error="unknown job or missing field %s" % (error))
+        except (TypeError, ValueError) as error:
+            code, response = 400, dict(error=str(error))
+
+        self.send_response(code)
+        if response is None:
+            self.end_headers()
+            return
+
+        content = json.dumps(response).encode("utf-8")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+class TranscodeWorker:
+    """
+    worker pulling jobs from a job server and running them through the transcode pipeline
+    stages in its threads. Running jobs report their progress which also renews their lease.
+    """
+    POLL_INTERVAL = 1.0
+    REQUEST_TIMEOUT = 30.0
+
+    def __init__(self, transcode_args, copy_others:bool):
+        self.transcode_args = transcode_args
+        self.url = transcode_args.get_worker_url().rstrip("/")
+        self.name = "%s:%d" % (socket.gethostname(), os.getpid())
 
-        results = subprocess.run(cmd, capture_output=True, encoding="utf-8", check=False)
+        # pulled jobs are run one at a time by each worker thread
+        self.pipeline = TranscodePipeline(transcode_args, copy_others, [])
 
-        if results.stdout is not None:
-            transcode_args.stdout.write(results.stdout)
+        self.lock = threading.Lock()
+        self.running = {}
+        self.stopped = threading.Event()
+
+    def request(self, method:str, path:str, body:dict = None) -> dict:
+        """
+        send a json request to the job server and return its json response or None
+        """
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=TranscodeWorker.REQUEST_TIMEOUT) as response:
+            content = response.read()
+        return json.loads(content.decode("utf-8")) if content else None
+
+    def run(self):
+        """
+        pull and run jobs from --jobs threads until the worker is idle for the idle timeout
+        """
+        logging.info("Worker %s pulling jobs from %s", self.name, self.url)
+
+        reporter = threading.Thread(target=self.report_progress, name="worker-reporter", daemon=True)
+        reporter.start()
+
+        threads = [threading.Thread(target=self.pull, name="worker-%d" % (index)) for index in range(self.transcode_args.get_jobs())]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.stopped.set()
+        reporter.join()
+
+    def pull(self):
+        """
+        worker thread loop
+        """
+        idle_timeout = self.transcode_args.get_worker_idle_timeout()
+        idle_time = time.monotonic()
+
+        while True:
+            try:
+                server_job = self.request("POST", "/jobs/next", dict(worker=self.name))
+            except OSError as error:
+                logging.warning("Worker cannot reach %s: %s", self.url, error)
+                server_job = None
+
+            if server_job is not None:
+                self.run_job(server_job)
+                idle_time = time.monotonic()
+            elif 0 < idle_timeout < time.monotonic() - idle_time:
+                return
+            else:
+                time.sleep(TranscodeWorker.POLL_INTERVAL)
+
+    def run_job(self, server_job:dict):
+        """
+        probe, decide and run a job then report its result
+        """
+        source_filename = server_job["source_filename"]
+        job = TranscodeJob(os.path.basename(source_filename), source_filename, server_job["output_dir"])
 
-        if results.stderr is not None:
-            transcode_args.stderr.write(results.stderr)
+        with self.lock:
+            self.running[server_job["id"]] = job
 
-        if results.returncode != 0:
-            logging.error("transcode_file error running %s returncode: %d", cmd, results.returncode)
-            remove_file(output_file)
-            raise RuntimeError("transcode_file error running %s returncode: %d" % (cmd, results.returncode))
+        try:
+            probe_job(job, self.transcode_args)
+            self.pipeline.run_job(job)
+        except Exception as error: # pylint: disable=broad-except
+            fail_job(job, error)
+        finally:
+            with self.lock:
+                self.running.pop(server_job["id"], None)
 
-        if fetch_duration_in_frames(output_file) == 0:
-            logging.error("transcode_file error running %s: zero duration for %s", cmd, output_file)
-            remove_file(output_file)
-            raise RuntimeError("transcode_file error running %s: zero duration for %s" % (cmd, output_file))
+        self.report(server_job["id"], job, "result")
 
-        transcoder_file_stats = compare_input_output(source_filename, output_file, codec_name, transcode_args)
-        transcoder_file_result.set_file_stats(transcoder_file_stats)
+    def report(self, job_id:int, job:TranscodeJob, kind:str):
+        """
+        send the progress or the result of a job to the job server
+        """
+        report = dict(worker=self.name,
+                      action=job.action,
+                      output_file=job.output_file,
+                      status=True,
+                      progress=None,
+                      file_stats=None,
+                      errors=[])
+
+        # jobs that are neither encoded nor failed have no file result
+        file_result = job.file_result
+        if file_result is not None:
+            progress = file_result.get_progress()
+            file_stats = file_result.transcoder_file_stats
+            report.update(status=file_result.status(),
+                          progress=progress.as_dict() if progress is not None else None,
+                          file_stats=file_stats.as_dict() if file_stats is not None else None,
+                          errors=file_result.exceptions + file_result.fails_on_tolerance)
+        try:
+            self.request("POST", "/jobs/%d/%s" % (job_id, kind), report)
+        except urllib.error.HTTPError as error:
+            logging.warning("Worker %s report of %s rejected: %s", kind, job.source_filename, error)
+        except OSError as error:
+            logging.warning("Worker cannot report %s of %s: %s", kind, job.source_filename, error)
 
-        job_stats_string = format_input_output(transcoder_file_stats)
+    def report_progress(self):
+        """
+        reporter thread loop: report progress of running jobs and renew their lease
+        """
+        interval = self.transcode_args.get_lease_time() / 3
+        if self.transcode_args.get_progress_interval() > 0:
+            interval = min(interval, self.transcode_args.get_progress_interval())
 
-        transcoder_results.info("transcode_file job done: %s %s" % (output_file, job_stats_string))
-        logging.info("transcode_file job done: %s %s", output_file, job_stats_string)
+        while not self.stopped.wait(interval):
+            with self.lock:
+                running = list(self.running.items())
+            for job_id, job in running:
+                self.report(job_id, job, "progress")
 
+def serve(transcode_args):
+    """
+    run the job server until interrupted
+    """
+    server = TranscodeServer(transcode_args)
+    server.start(transcode_args.get_serve_host(), transcode_args.get_serve_port())
+    try:
+        while True:
+            time.sleep(3600)
+    finally:
+        server.close()
 
 def transcode(transcode_args, copy_others):
     """
     walk into a directory and transcode all media file to specified parameters
     """
-    input_dir = transcode_args.get_input_dir()
-    for root, _, files in os.walk(input_dir, topdown=False):
-        for name in files:
-            # skip hidden files
-            if name.startswith("."):
-                continue
-
-            source_filename = os.path.join(root,name).replace("./","")
-            output_dir = transcode_args.get_output_dir(input_dir, root)
-
-            os.makedirs(output_dir, exist_ok=True)
+    if transcode_args.get_serve_port() is not None:
+        serve(transcode_args)
+        return
 
-            codec_name = ""
-            with transcoder_results:
-                codec_name = fetch_codec_name(source_filename)
+    if transcode_args.get_worker_url() is not None:
+        TranscodeWorker(transcode_args, copy_others).run()
+        return
 
-            if codec_name in transcode_args.get_output_main_codec():
+    if transcode_args.get_watch() is True:
+        watch(transcode_args, copy_others)
+        return
 
-                logging.debug("Skipping %s codec \"%s\"", name, codec_name)
+    jobs = None
+    if transcode_args.get_from_manifest() is not None:
+        shard_index, shard_count = transcode_args.get_manifest_shard()
+        jobs = TranscodeManifest.read(transcode_args.get_from_manifest()).get_jobs(shard_index, shard_count)
+        logging.info("Executing %d jobs from manifest %s shard %d/%d", len(jobs), transcode_args.get_from_manifest(), shard_index + 1, shard_count)
 
-                if copy_others is True:
-                    dest_filename = os.path.join(output_dir, os.path.basename(source_filename))
-                    if os.path.exists(dest_filename) is False:
-                        logging.info("Copying %s", dest_filename)
-                        shutil.copyfile(source_filename, dest_filename)
+    pipeline = TranscodePipeline(transcode_args, copy_others, jobs)
 
-                continue
+    if transcode_args.get_dry_run() is True:
+        pipeline.manifest = TranscodeManifest(output_codec=transcode_args.get_output_main_codec())
+        pipeline.run()
 
-            output_filename, _ = os.path.splitext(source_filename)
-            output_filename += transcode_args.get_output_suffix() + transcode_args.get_container_ext()
+        manifest_path = transcode_args.get_manifest_path()
+        pipeline.manifest.write(manifest_path)
+        transcoder_results.info("Dry run manifest %s actions: %s" % (manifest_path, pipeline.manifest.get_action_counts()))
+        logging.info("Dry run manifest %s actions: %s", manifest_path, pipeline.manifest.get_action_counts())
+        return
 
-            output_file = os.path.join(output_dir, os.path.basename(output_filename))
+    discard_interrupted_outputs(transcode_args)
+    pipeline.run()
 
-            if os.path.exists(output_file) is True:
 
-                transcoder_file_stats = compare_input_output(source_filename,output_file, codec_name, transcode_args)
+def add_performance_args(parser):
+    """
+    add performance options to the argument parser
+    """
+    # performance
+    performance_group = parser.add_argument_group('performance options')
+    performance_group.add_argument("--jobs", type=int, default=1, dest="jobs", help="number of concurrent transcode jobs")
+    performance_group.add_argument("--probe-jobs", type=int, default=1, dest="probe_jobs", help="number of concurrent ffprobe jobs running ahead of the encoder and verifying outputs")
+    performance_group.add_argument("--order", type=str, default="walk", choices=JOB_ORDERS, dest="order",
+                                   help="job order: walk order, longest or shortest estimated encode first, or best estimated savings per encode time first")
+    performance_group.add_argument("--segment-encode", default=False, action="store_true", dest="segment_encode", help="split long videos at keyframes, encode segments in parallel and concatenate them")
+    performance_group.add_argument("--segments", type=int, default=4, dest="segments", help="number of segments encoded in parallel per video with --segment-encode")
+    performance_group.add_argument("--segment-min-duration", type=float, default=600.0, dest="segment_min_duration", help="minimum video duration in seconds to use segment encoding")
+    performance_group.add_argument("--pin-cpus", default=False, action="store_true", dest="pin_cpus", help="split cpus among concurrent jobs, pin each ffmpeg to the cpus of its job and limit encoder threads to match. Only threads are limited where cpu affinity is not available")
+    performance_group.add_argument("--nice", type=int, default=0, dest="nice", help="run ffmpeg with this niceness adjustment")
+    performance_group.add_argument("--ionice", type=str, default=None, choices=list(IONICE_CLASSES.keys()), dest="ionice", help="run ffmpeg in this io scheduling class")
+    performance_group.add_argument("--max-memory", type=int, default=0, dest="max_memory", help="limit the address space of each ffmpeg process to this value in MB, 0 to disable")
+    performance_group.add_argument("--max-cpu-time", type=int, default=0, dest="max_cpu_time", help="limit the cpu time of each ffmpeg process to this value in seconds, 0 to disable")
+    performance_group.add_argument("--resource-retries", type=int, default=2, dest="resource_retries", help="number of retries with half the threads, running alone, of encodes that ran out of memory or cpu time")
+    performance_group.add_argument("--max-load", type=float, default=0.0, dest="max_load", help="hold back new encodes while the one minute load average is above this value, 0 to disable")
+    performance_group.add_argument("--min-available-memory", type=int, default=0, dest="min_available_memory", help="hold back new encodes while available memory of the host or its memory cgroup is below this value in MB, 0 to disable")
+    performance_group.add_argument("--admission-interval", type=float, default=5.0, dest="admission_interval", help="interval in seconds between system pressure checks and between the first admissions after a hold back")
+    performance_group.add_argument("--pipeline-stats-interval", type=float, default=60.0, dest="pipeline_stats_interval", help="interval in seconds between pipeline queue depths logs, 0 to disable")
+
+def add_plan_args(parser):
+    """
+    add plan, forecast, triage and cache options to the argument parser
+    """
+    # plan
+    plan_group = parser.add_argument_group('plan options')
+    plan_group.add_argument("--dry-run", default=False, action="store_true", dest="dry_run", help="walk and probe the input directory and write the planned jobs to a manifest without transcoding")
+    plan_group.add_argument("--manifest-path", type=str, default=None, dest="manifest_path", help="dry run manifest path (default: %s in output directory)" % (TranscodeManifest.DEFAULT_NAME))
+    plan_group.add_argument("--from-manifest", type=str, default=None, dest="from_manifest", help="execute jobs planned in a manifest instead of walking and probing the input directory")
+    plan_group.add_argument("--manifest-shard", type=str, default="1/1", dest="manifest_shard", help="execute shard K of N of the manifest jobs as K/N")
+
+    forecast_group = parser.add_argument_group('forecast options')
+    forecast_group.add_argument("--forecast", default=False, action="store_true", dest="forecast", help="encode short samples of each file to forecast its output size and encode time and skip low yield transcodes, or copy them with --copy")
+    forecast_group.add_argument("--forecast-samples", type=int, default=3, dest="forecast_samples", help="number of samples spread across each file")
+    forecast_group.add_argument("--forecast-sample-duration", type=float, default=5.0, dest="forecast_sample_duration", help="duration in seconds of each sample")
+    forecast_group.add_argument("--forecast-min-saving", type=float, default=10.0, dest="forecast_min_saving", help="minimum forecast saving in percent to transcode a file")
+
+    triage_group = parser.add_argument_group('triage options')
+    triage_group.add_argument("--triage", default=False, action="store_true", dest="triage", help="skip files whose probe data shows they are already efficient using the triage thresholds of the output config, or copy them with --copy")
+
+    # cache
+    cache_group = parser.add_argument_group('cache options')
+    cache_group.add_argument("--use-cache", default=False, action="store_true", dest="use_cache", help="cache probe results, skip decisions and verified outputs between runs")
+    cache_group.add_argument("--cache-path", type=str, default=None, dest="cache_path", help="cache database path (default: %s in output directory)" % (TranscoderCache.DEFAULT_NAME))
+    cache_group.add_argument("--rebuild-cache", default=False, action="store_true", dest="rebuild_cache", help="discard the cache content and rebuild it. Implies --use-cache")
+
+def add_worker_args(parser):
+    """
+    add watch, shared queue and job server options to the argument parser
+    """
+    # watch
+    watch_group = parser.add_argument_group('watch options')
+    watch_group.add_argument("--watch", default=False, action="store_true", dest="watch", help="watch the input directory with inotify and transcode files as they are created or moved in")
+    watch_group.add_argument("--watch-settle-time", type=float, default=5.0, dest="watch_settle_time", help="time in seconds a new file must stop growing before it is transcoded")
+    watch_group.add_argument("--watch-duration", type=float, default=0.0, dest="watch_duration", help="time in seconds to watch the input directory, 0 to watch until interrupted")
+
+    worker_group = parser.add_argument_group('shared queue options')
+    worker_group.add_argument("--shared-queue", default=False, action="store_true", dest="shared_queue", help="claim outputs in a queue shared with workers on other hosts using the same output directory so each file is encoded once")
+    worker_group.add_argument("--claim-dir", type=str, default=None, dest="claim_dir", help="shared queue claims directory (default: %s in output directory)" % (TranscoderClaims.DEFAULT_NAME))
+    worker_group.add_argument("--lease-time", type=float, default=300.0, dest="lease_time", help="time in seconds after which claims or job server jobs of a worker that stopped renewing them are reclaimed")
+
+    server_group = parser.add_argument_group('job server options')
+    server_group.add_argument("--serve", type=int, default=None, dest="serve_port", help="serve a job api on this port: files and directories submitted over http are transcoded by workers with their own transcoding options")
+    server_group.add_argument("--serve-host", type=str, default="127.0.0.1", dest="serve_host", help="address the job server listens on, 0.0.0.0 to accept workers and clients of other hosts")
+    server_group.add_argument("--worker", type=str, default=None, dest="worker_url", help="pull jobs from the job server at this url and run --jobs of them concurrently")
+    server_group.add_argument("--worker-idle-timeout", type=float, default=0.0, dest="worker_idle_timeout", help="time in seconds a worker waits for jobs before exiting, 0 to wait until interrupted")
+
+def check_args(parser, arguments):
+    """
+    report options that cannot be used together as parser errors
+    """
+    if arguments.watch is True and (arguments.dry_run is True or arguments.from_manifest is not None or arguments.order != "walk"):
+        parser.error("--watch transcodes files as they arrive and cannot be used with --dry-run, --from-manifest or --order")
 
-                logging.info("Skipping %s exists. %s", output_file, format_input_output(transcoder_file_stats))
-                continue
+    if arguments.stream_copy is True and (arguments.map_args is not None or arguments.default_map is True):
+        parser.error("--stream-copy maps all streams and cannot be used with --map-args or --default-map")
 
-            transcode_file(source_filename, codec_name, transcode_args, output_file)
+    if [arguments.watch, arguments.serve_port is not None, arguments.worker_url is not None, arguments.dry_run].count(True) > 1:
+        parser.error("--watch, --serve, --worker and --dry-run cannot be used together")
 
+    if arguments.serve_port is not None and arguments.copy_others is True:
+        parser.error("--copy is applied by workers and cannot be used with --serve")
 
 def parse_args(argv):
     """
@@ -1008,18 +5464,29 @@ def parse_args(argv):
     io_group.add_argument("--output-suffix", type=str, default="", dest="output_suffix", help="suffix to add to the output file")
     io_group.add_argument("--stdout-path", type=str, default=None, dest="stdout_path", help="redirect stdout to path")
     io_group.add_argument("--stderr-path", type=str, default=None, dest="stderr_path", help="redirect stderr to path")
+    io_group.add_argument("--ffmpeg-log-dir", type=str, default=None, dest="ffmpeg_log_dir", help="write ffmpeg stdout and stderr of each job to its own file in this directory")
+    io_group.add_argument("--journal-path", type=str, default=None, dest="journal_path", help="job journal path used to resume interrupted runs (default: %s in output directory)" % (TranscoderJournal.DEFAULT_NAME))
+    io_group.add_argument("--no-journal", default=True, action="store_false", dest="use_journal", help="do not journal job states. Interrupted jobs are still written to temporary files")
+
+    add_performance_args(parser)
+    add_plan_args(parser)
+    add_worker_args(parser)
 
     # logging
     log_group = parser.add_argument_group('logging options')
     log_group.add_argument("--log-path", type=str, default="tabarnak.log", dest="log_path", help="log path")
+    log_group.add_argument("--progress-interval", type=float, default=10.0, dest="progress_interval", help="interval in seconds between encode progress logs, 0 to disable")
     log_group.add_argument("--prometheus-log-path", type=str, default="tabarnak.prom", dest="prometheus_log_path", help="prometheus log path")
     log_group.add_argument("--use-prometheus-logging", default=False, action="store_true", dest="use_prometheus", help="use prometheus for logging")
+    log_group.add_argument("--prometheus-port", type=int, default=None, dest="prometheus_port", help="serve live prometheus metrics over http on this port")
 
 
     stream_group = parser.add_argument_group('stream options')
     stream_group.add_argument("--default-map", default=False, action="store_true", dest="default_map", help="use ffmpeg default mapping instead of mapping all streams which might not be supported by mkv container")
     stream_group.add_argument("--map-args", type=str, default=None, dest="map_args", help="specify ffmpeg map arguments")
     stream_group.add_argument("--strip-metadata", default=False, action="store_true", dest="strip_metadata", help="remove most metadata from the file")
+    stream_group.add_argument("--remux", default=False, action="store_true", dest="remux", help="remux files already in the output codec to the output container with stream copy instead of skipping them")
+    stream_group.add_argument("--stream-copy", default=False, action="store_true", dest="stream_copy", help="pass through streams already in a codec of the output config and encode only the others")
 
     # error
     error_group = parser.add_argument_group('error options')
@@ -1052,6 +5519,7 @@ def parse_args(argv):
         parser.error = error
 
     arguments = parser.parse_args(argv)
+    check_args(parser, arguments)
 
     return arguments
 
@@ -1084,7 +5552,10 @@ def execute(args, cmd_stdout, cmd_stderr):
 
     # transcode
     transcoder_args = TranscoderArgs(args, config, stdout = cmd_stdout, stderr = cmd_stderr)
-    transcode(transcoder_args, args.copy_others)
+    try:
+        transcode(transcoder_args, args.copy_others)
+    finally:
+        transcoder_args.close()
 
     transcoder_results.print_summary(transcoder_args)
 
@@ -23,5 +23,11 @@ TEST_FAT_DNXHD_DIR = os.path.join(TEST_BAT_DIR, "dnxhd")
 TEST_H264_FILE_2_SECONDS = "H.264-720x480-1-audio-tracks-mono-vorbis-eng-2-seconds.mkv"
 TEST_H264_PATH_2_SECONDS = os.path.join(TEST_BAT_H264_DIR,TEST_H264_FILE_2_SECONDS)
 
+TEST_HEVC_FILE_2_SECONDS = "HEVC-720x480-1-audio-track-mono-opus-sub-eng-2-seconds.mkv"
+TEST_HEVC_PATH_2_SECONDS = os.path.join(TEST_BAT_HEVC_DIR,TEST_HEVC_FILE_2_SECONDS)
+
 TEST_H264_FILE_30_SECONDS = "H.264-720x480-1-audio-tracks-mono-vorbis-eng-30-seconds.mkv"
 TEST_H264_PATH_30_SECONDS = os.path.join(TEST_FAT_H264_DIR,TEST_H264_FILE_30_SECONDS)
+
+TEST_INVALID_HEADER_FILE = "H.264-720x480-1-audio-tracks-mono-vorbis-eng-2-seconds-header.mkv"
+TEST_INVALID_HEADER_PATH = os.path.join(TEST_BAT_INVALID_DIR, TEST_INVALID_HEADER_FILE)
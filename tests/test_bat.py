@@ -1,20 +1,33 @@
 """
 Basic Acceptance Test Module
 """
+import json
 import os
 import shutil
 import signal
+import socket
 import subprocess
+import threading
 import unittest
+import urllib.request
 
 from tests.test_case_base import TestCaseBase
 from tests.config import TEST_BAT_DIR, TEST_BAT_H264_DIR, TEST_BAT_INVALID_DIR
-from tests.config import TEST_H264_FILE_2_SECONDS, TEST_H264_PATH_2_SECONDS
+from tests.config import TEST_H264_FILE_2_SECONDS, TEST_H264_PATH_2_SECONDS, TEST_HEVC_PATH_2_SECONDS
+from tests.config import TEST_INVALID_HEADER_PATH
 
 from tabarnak import tabarnak
 
 test_dir = os.path.dirname(os.path.abspath(__file__))
 
+def get_free_port() -> int:
+    """
+    return a tcp port that is free on this host
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
 class TestBAT(TestCaseBase):
     """
     Basic Acceptance Test TestCase
@@ -91,6 +104,173 @@ class TestBAT(TestCaseBase):
         cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR]
         self.run_cmd(cmd)
 
+    def test_cache(self):
+        """
+        transcode twice using the cache. The second run should use cached probes and stats.
+        """
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--use-cache"]
+        result = self.run_cmd(cmd)
+        self.assertEqual(result.status(), True)
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, tabarnak.TranscoderCache.DEFAULT_NAME)))
+
+        result = self.run_cmd(cmd)
+        self.assertEqual(result.status(), True)
+        self.assertGreater(result.get_transcoder_stats().get_total_saved(), 0)
+        self.assert_codec_name(self.output_dir, "hevc", 1)
+
+        result = self.run_cmd(cmd + ["--rebuild-cache"])
+        self.assertEqual(result.status(), True)
+
+    def test_resume_interrupted_job(self):
+        """
+        transcode after an interrupted run. The partial output must be discarded and the job transcoded again.
+        """
+        output_file_path = os.path.join(self.output_dir, TEST_H264_FILE_2_SECONDS)
+        partial_output_file_path = tabarnak.get_partial_output_file(output_file_path)
+        with open(partial_output_file_path, "wb") as partial_output_file:
+            partial_output_file.write(b"truncated")
+
+        journal = tabarnak.TranscoderJournal(os.path.join(self.output_dir, tabarnak.TranscoderJournal.DEFAULT_NAME))
+        journal.record(output_file_path, TEST_H264_PATH_2_SECONDS, tabarnak.TranscoderJournal.RUNNING)
+        journal.close()
+
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assert_codec_name(self.output_dir, "hevc", 1)
+        self.assertFalse(os.path.exists(partial_output_file_path))
+        self.assertFalse(os.path.exists(journal.path))
+
+    def test_shared_queue(self):
+        """
+        transcode with a shared queue while another worker holds the output claim then once it released it
+        """
+        output_file_path = os.path.join(self.output_dir, TEST_H264_FILE_2_SECONDS)
+        claims = tabarnak.TranscoderClaims(os.path.join(self.output_dir, tabarnak.TranscoderClaims.DEFAULT_NAME), self.output_dir, 60.0)
+        self.assertTrue(claims.claim(output_file_path, TEST_H264_PATH_2_SECONDS))
+
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--shared-queue"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assert_codec_name(self.output_dir, "hevc", 0)
+
+        claims.close()
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assert_codec_name(self.output_dir, "hevc", 1)
+
+    def test_forecast(self):
+        """
+        forecast outputs from a sample and copy files below the minimum forecast saving
+        """
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--copy", "--forecast", "--forecast-samples", "1", "--forecast-sample-duration", "0.5", "--forecast-min-saving", "101"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assertEqual(len(result.file_results), 1)
+        self.assertIsNotNone(result.file_results[0].get_forecast())
+        self.assert_codec_name(self.output_dir, "hevc", 0)
+        self.assert_codec_name(self.output_dir, "h264", 1)
+
+    def test_triage(self):
+        """
+        triage files from probe data with the thresholds of the output config
+        """
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--triage", "--copy"]
+        result = self.run_cmd(cmd)
+        self.assertEqual(result.status(), True)
+
+        config = tabarnak.TranscoderConfiguration()
+        audio_stream = tabarnak.MediaStreamInfo(1, "audio", "aac", 60.0, 96000)
+
+        def media_info(codec_name, bit_rate):
+            video_stream = tabarnak.MediaStreamInfo(0, "video", codec_name, 60.0, bit_rate, 1280, 720, 25.0)
+            return tabarnak.MediaInfo("video.mkv", "matroska", 60.0, 0, bit_rate + 96000, [video_stream, audio_stream])
+
+        self.assertIsNotNone(tabarnak.triage_media(media_info("h264", 900000), config.get_triage("hevc")))
+        self.assertIsNotNone(tabarnak.triage_media(media_info("vp9", 8000000), config.get_triage("hevc")))
+        self.assertIsNone(tabarnak.triage_media(media_info("h264", 8000000), config.get_triage("hevc")))
+        self.assertIsNotNone(tabarnak.triage_media(tabarnak.MediaInfo("audio.m4a", "mov", 60.0, 0, 96000, [audio_stream]), config.get_triage("opus")))
+
+    def test_stream_copy(self):
+        """
+        encode the video stream and pass through the audio stream already in an output codec
+        """
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--stream-copy"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assert_codec_name(self.output_dir, "hevc", 1)
+
+        output_media_info = tabarnak.probe_media(os.path.join(self.output_dir, TEST_H264_FILE_2_SECONDS))
+        self.assertEqual(output_media_info.get_audio_codec(), "vorbis")
+
+    def test_remux(self):
+        """
+        remux a file already in the output codec to the output container
+        """
+        input_dir = os.path.join(self.output_dir, "input")
+        remux_dir = os.path.join(self.output_dir, "remuxed")
+        os.makedirs(input_dir)
+        shutil.copyfile(TEST_HEVC_PATH_2_SECONDS, os.path.join(input_dir, "hevc.mp4"))
+
+        cmd = self.cmd + ["--input-dir", input_dir, "--output-dir", remux_dir, "--remux"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assertEqual(len(result.file_results), 1)
+        self.assertTrue(result.file_results[0].is_remuxed())
+        self.assert_codec_name(remux_dir, "hevc", 1)
+        self.assertTrue(os.path.exists(os.path.join(remux_dir, "hevc.mkv")))
+
+    def test_dry_run_manifest(self):
+        """
+        plan jobs in a manifest without transcoding then execute the manifest
+        """
+        manifest_path = os.path.join(self.output_dir, tabarnak.TranscodeManifest.DEFAULT_NAME)
+
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--copy", "--dry-run"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assert_codec_name(self.output_dir, "hevc", 0)
+
+        manifest = tabarnak.TranscodeManifest.read(manifest_path)
+        self.assertEqual(manifest.get_action_counts(), {"transcode": 1, "copy": 1})
+
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--from-manifest", manifest_path]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assert_codec_name(self.output_dir, "hevc", 1)
+        self.assert_copy(self.output_dir, 1)
+
+    def test_probe_jobs(self):
+        """
+        transcode the entire BAT folder probing files from a thread pool
+        """
+        args = ["--input-dir", TEST_BAT_DIR, "--keep-relative-path", "--probe-jobs", "4"]
+        cmd = self.cmd + args
+
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), False) # invalid dir will cause status to fail
+        self.assert_count_sub_dir(self.output_dir, 3)
+
+    def test_ffmpeg_log_dir(self):
+        """
+        transcode writing ffmpeg outputs to per job log files
+        """
+        ffmpeg_log_dir = os.path.join(self.output_dir, "ffmpeg-logs")
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--ffmpeg-log-dir", ffmpeg_log_dir]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assertEqual(len(os.listdir(ffmpeg_log_dir)), 2)
+
     def test_enable_prometheus_logging(self):
         """
         Basic encoding test using BAT directory as source and enable prometheus logging
@@ -103,6 +283,125 @@ class TestBAT(TestCaseBase):
 
         self.assertEqual(result.status(), True)
         self.assert_codec_name(self.output_dir, "hevc")
+        self.assertTrue(os.path.exists(prometheus_log_path))
+
+    def test_prometheus_exporter(self):
+        """
+        Basic encoding test serving prometheus metrics over http
+        """
+        prometheus_port = get_free_port()
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--prometheus-port", str(prometheus_port)]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+
+        with urllib.request.urlopen("http://localhost:%d/metrics" % (prometheus_port)) as response:
+            metrics = response.read().decode("utf-8")
+
+        self.assertIn('tabarnak_files_total{outcome="transcoded"}', metrics)
+        self.assertIn("tabarnak_ffprobe_seconds_count", metrics)
+
+    def run_job_server(self, path:str) -> tuple:
+        """
+        submit a path to a job server and run its jobs with a worker.
+        return the submitted job ids, the worker result and the server jobs.
+        """
+        transcoder_args = tabarnak.TranscoderArgs(tabarnak.parse_args(self.cmd + ["--serve", "0"]), tabarnak.TranscoderConfiguration())
+        server = tabarnak.TranscodeServer(transcoder_args)
+        # port 0 binds a free port
+        server.start("127.0.0.1", 0)
+        server_url = "http://127.0.0.1:%d" % (server.http_server.server_address[1])
+
+        try:
+            request = urllib.request.Request(server_url + "/jobs", data=json.dumps(dict(path=path)).encode("utf-8"), method="POST")
+            with urllib.request.urlopen(request) as response:
+                job_ids = json.loads(response.read())["jobs"]
+
+            cmd = self.cmd + ["--worker", server_url, "--worker-idle-timeout", "1"]
+            result = self.run_cmd(cmd)
+
+            with urllib.request.urlopen(server_url + "/jobs") as response:
+                jobs = json.loads(response.read())
+        finally:
+            server.close()
+            transcoder_args.close()
+
+        return job_ids, result, jobs
+
+    def test_job_server(self):
+        """
+        submit a directory to a job server and transcode its jobs with a worker
+        """
+        job_ids, result, jobs = self.run_job_server(TEST_BAT_H264_DIR)
+
+        self.assertEqual(len(job_ids), 2)
+        self.assertEqual(result.status(), True)
+        self.assertEqual(jobs["counts"], {"done": 2})
+        self.assertGreater(jobs["total_saved"], 0)
+        self.assert_codec_name(self.output_dir, "hevc", 1)
+
+    def test_job_server_failure(self):
+        """
+        submit an invalid file to a job server and check that its job failed
+        """
+        job_ids, result, jobs = self.run_job_server(TEST_INVALID_HEADER_PATH)
+
+        self.assertEqual(len(job_ids), 1)
+        self.assertEqual(result.status(), False)
+        self.assertEqual(jobs["counts"], {"failed": 1})
+        self.assertNotEqual(jobs["jobs"][0]["errors"], [])
+
+    def test_probe_media(self):
+        """
+        probe a media file in a single pass and check its media info
+        """
+        media_info = tabarnak.probe_media(TEST_H264_PATH_2_SECONDS)
+
+        self.assertEqual(media_info.get_video_codec(), "h264")
+        self.assertEqual(media_info.get_audio_codec(), "vorbis")
+        self.assertEqual(media_info.get_duration_in_frames(), 2)
+        self.assertEqual(media_info.get_video_stream().width, 720)
+        self.assertEqual(media_info.get_video_stream().height, 480)
+        self.assertEqual(tabarnak.fetch_codec_name(TEST_H264_PATH_2_SECONDS, media_info), "h264")
+
+    def test_prefilter(self):
+        """
+        check that only media files pass the prefilter
+        """
+        prefilter = tabarnak.DEFAULT_PREFILTER_CONFIG
+        subtitle_path = os.path.splitext(TEST_H264_PATH_2_SECONDS)[0] + ".srt"
+
+        self.assertTrue(tabarnak.is_media_file(TEST_H264_PATH_2_SECONDS, prefilter))
+        self.assertFalse(tabarnak.is_media_file(subtitle_path, prefilter))
+
+        # files without a media extension are recognized by their magic bytes
+        media_path = os.path.join(self.output_dir, "media.bin")
+        shutil.copyfile(TEST_H264_PATH_2_SECONDS, media_path)
+        self.assertTrue(tabarnak.is_media_file(media_path, prefilter))
+        self.assertFalse(tabarnak.is_media_file(media_path, dict(prefilter, magic=False)))
+        self.assertTrue(tabarnak.is_media_file(subtitle_path, dict(prefilter, enabled=False)))
+
+    def test_watch(self):
+        """
+        watch an input directory and transcode a file moved in while watching
+        """
+        watch_dir = os.path.join(self.output_dir, "watch")
+        transcode_dir = os.path.join(self.output_dir, "transcoded")
+        os.makedirs(watch_dir)
+        arriving_path = os.path.join(self.output_dir, TEST_H264_FILE_2_SECONDS)
+        shutil.copyfile(TEST_H264_PATH_2_SECONDS, arriving_path)
+
+        mover = threading.Timer(1.0, os.rename, [arriving_path, os.path.join(watch_dir, TEST_H264_FILE_2_SECONDS)])
+        mover.start()
+
+        cmd = self.cmd + ["--input-dir", watch_dir, "--output-dir", transcode_dir]
+        cmd += ["--watch", "--watch-duration", "4", "--watch-settle-time", "0.5"]
+        result = self.run_cmd(cmd)
+        mover.join()
+
+        self.assertEqual(result.status(), True)
+        self.assertEqual(len(result.file_results), 1)
+        self.assert_codec_name(transcode_dir, "hevc", 1)
 
     def test_signal_handler(self):
         """
@@ -0,0 +1,50 @@
+"""
+Benchmark Test Module
+"""
+import os
+import unittest
+
+from tests.test_case_base import TestCaseBase
+
+from tabarnak import benchmark
+
+class TestBenchmark(TestCaseBase):
+    """
+    Benchmark TestCase
+    """
+
+    def test_benchmark(self):
+        """
+        run a short benchmark then compare it to itself
+        """
+        report_path = os.path.join(self.output_dir, "benchmark.json")
+        args = ["--duration", "1", "--size", "160x120", "--configs", "h264", "flac"]
+        args += ["--probe-count", "2", "--overhead-files", "2", "--throughput-files", "2", "--jobs", "2"]
+
+        report = benchmark.main(args + ["--output", report_path, "--work-dir", os.path.join(self.output_dir, "work")])
+
+        self.assertTrue(os.path.exists(report_path))
+        self.assertGreater(report["results"]["encode"]["h264"]["fps"], 0)
+        self.assertGreater(report["results"]["encode"]["flac"]["speed"], 0)
+        self.assertEqual(report["results"]["probe"]["latency_seconds"]["count"], 2)
+
+        compare_report_path = os.path.join(self.output_dir, "benchmark-compare.json")
+        report = benchmark.main(args + ["--output", compare_report_path, "--work-dir", os.path.join(self.output_dir, "work-compare"),
+                                        "--baseline", report_path, "--regression-threshold", "1000"])
+        self.assertEqual(report["regressions"], [])
+
+    def test_benchmark_scan_only(self):
+        """
+        run the directory walker benchmark on a small tree
+        """
+        report_path = os.path.join(self.output_dir, "benchmark-scan.json")
+        args = ["--scan-only", "--scan-files", "1000", "--scan-files-per-dir", "10"]
+        args += ["--output", report_path, "--work-dir", os.path.join(self.output_dir, "work")]
+
+        report = benchmark.main(args)
+
+        self.assertEqual(report["results"]["scan"]["files"], 1000)
+        self.assertGreater(report["results"]["scan"]["entries_per_second"], 0)
+
+if __name__ == '__main__':
+    unittest.main() # pragma: no cover
@@ -7,6 +7,8 @@ import unittest
 
 from tests.test_case_base import TestCaseBase
 
+from tabarnak import tabarnak
+
 test_dir = os.path.dirname(os.path.abspath(__file__))
 
 class TestConfiguration(TestCaseBase):
@@ -71,5 +73,21 @@ class TestConfiguration(TestCaseBase):
             yml_output_stream_from_input_config = yml_file.read()
         self.assertEqual(yml_output_stream, yml_output_stream_from_input_config)
 
+    def test_json_config_without_prefilter(self):
+        """
+        test json input configuration written before the prefilter configuration existed
+        """
+        json_input_path = os.path.join(self.output_dir, "config.json")
+        with open(json_input_path, "w+") as json_file:
+            json_file.write(json.dumps(dict(configs=tabarnak.TranscoderConfiguration().configs)))
+
+        input_cmd = self.cmd + ["--input-json-config", json_input_path]
+        input_cmd +=  ["--output-json-config"]
+        self.run_cmd(input_cmd)
+
+        with open(self.stdout_path, "r") as json_file:
+            json_output = json.loads(json_file.read())
+        self.assertEqual(json_output["prefilter"], tabarnak.DEFAULT_PREFILTER_CONFIG)
+
 if __name__ == '__main__':
     unittest.main() # pragma: no cover
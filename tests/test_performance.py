@@ -0,0 +1,128 @@
+"""
+Performance Options Test Module
+"""
+import os
+import unittest
+
+from tests.test_case_base import TestCaseBase
+from tests.config import TEST_BAT_DIR, TEST_BAT_H264_DIR
+
+from tabarnak import tabarnak
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+class TestPerformance(TestCaseBase):
+    """
+    Performance Options TestCase
+    """
+
+    def test_jobs(self):
+        """
+        transcode the entire BAT folder running concurrent transcode jobs
+        """
+        args = ["--input-dir", TEST_BAT_DIR, "--keep-relative-path", "--jobs", "3", "--probe-jobs", "4"]
+        cmd = self.cmd + args
+
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), False) # invalid dir will cause status to fail
+        self.assert_count_sub_dir(self.output_dir, 3)
+
+    def test_jobs_copy(self):
+        """
+        transcode and copy files running concurrent transcode jobs
+        """
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--copy", "--jobs", "2"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assert_codec_name(self.output_dir, "hevc", 1)
+        self.assert_copy(self.output_dir, 1)
+
+    def test_order(self):
+        """
+        transcode the entire BAT folder dispatching jobs in each order
+        """
+        for order in ["longest", "shortest", "savings"]:
+            cmd = self.cmd + ["--input-dir", TEST_BAT_DIR, "--keep-relative-path", "--jobs", "2", "--order", order]
+            result = self.run_cmd(cmd)
+
+            self.assertEqual(result.status(), False) # invalid dir will cause status to fail
+            self.assert_count_sub_dir(self.output_dir, 3)
+
+    def test_pin_cpus(self):
+        """
+        transcode concurrent jobs pinned to their own cpus with a lower priority
+        """
+        cmd = self.cmd + ["--input-dir", TEST_BAT_DIR, "--keep-relative-path", "--jobs", "2", "--pin-cpus", "--nice", "10", "--ionice", "idle"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), False) # invalid dir will cause status to fail
+        self.assert_count_sub_dir(self.output_dir, 3)
+
+        self.assertEqual(tabarnak.TranscoderCpuSlots.split([0, 1, 2, 3, 4], 2), [[0, 1, 2], [3, 4]])
+        self.assertEqual(tabarnak.TranscoderEncoderArgs.add_thread_args("-c:v libx265 -x265-params crf=28", 2), "-c:v libx265 -x265-params crf=28:pools=2")
+        self.assertEqual(tabarnak.TranscoderEncoderArgs.add_thread_args("-c:v libx264 -crf 30", 2), "-c:v libx264 -crf 30 -threads 2")
+
+    def test_admission(self):
+        """
+        transcode with admission control thresholds that are not reached and check held back thresholds
+        """
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--max-load", "1000", "--min-available-memory", "1", "--admission-interval", "0.1"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assert_codec_name(self.output_dir, "hevc", 1)
+
+        self.assertIsNone(tabarnak.TranscoderAdmission(1000.0, 1, 0.1).get_pressure())
+        self.assertIsNotNone(tabarnak.TranscoderAdmission(0.0, 2**60, 0.1).get_pressure())
+
+    def test_resource_limits(self):
+        """
+        transcode with a memory limit too low for ffmpeg and check the encode is retried
+        """
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--max-memory", "16", "--max-cpu-time", "600", "--resource-retries", "1"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), False)
+        with open(self.test_log_path, "r") as log_file:
+            self.assertIn("Retrying", log_file.read())
+
+    def test_pipeline_stats(self):
+        """
+        transcode logging pipeline queue depths frequently
+        """
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--copy", "--pipeline-stats-interval", "0.1"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        with open(self.test_log_path, "r") as log_file:
+            self.assertIn("Pipeline max queue depths", log_file.read())
+
+    def test_progress(self):
+        """
+        transcode logging encode progress frequently
+        """
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--progress-interval", "0.1"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assertEqual(len(result.file_results), 1)
+
+        progress = result.file_results[0].get_progress()
+        self.assertEqual(progress.get_percent(), 100.0)
+        self.assertGreater(progress.total_size, 0)
+        self.assertFalse(progress.is_running())
+
+    def test_segment_encode(self):
+        """
+        transcode splitting videos in segments encoded in parallel
+        """
+        cmd = self.cmd + ["--input-dir", TEST_BAT_H264_DIR, "--segment-encode", "--segments", "2", "--segment-min-duration", "0"]
+        result = self.run_cmd(cmd)
+
+        self.assertEqual(result.status(), True)
+        self.assert_codec_name(self.output_dir, "hevc", 1)
+
+if __name__ == '__main__':
+    unittest.main() # pragma: no cover